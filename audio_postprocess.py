@@ -0,0 +1,277 @@
+"""Post-processing of rendered chapters: what used to be left to the production team (README step 9).  Takes a
+joined .wav from save_polly_speech(output_format="pcm", join_chunks=True) and, using its manifest to find where
+each chunk starts and ends:
+
+  - trims the silence Polly leaves at the start and end of every chunk
+  - puts the same gap between every pair of chunks, and a longer one where a paragraph ends
+  - adds a lead-in and a tail of silence at the start and end of the file
+  - sets the loudness to a target RMS level, with a ceiling on the peaks (ACX's audiobook specs by default)
+
+and saves {basename}_mastered.wav, plus {basename}_mastered.mp3 if ffmpeg is installed to encode it.  The
+samples are processed with NumPy a block at a time, so memory use doesn't depend on the length of the chapter
+and it runs hundreds of times faster than real time.  Either enable it for a render with
+POSTPROCESS=1 python read_entire_book.py, or run it again on a rendered book with other settings:
+
+    python audio_postprocess.py books/hiroshima/ --target-rms -19 --paragraph-gap 1.5
+"""
+
+import argparse
+import math
+import os
+import shutil
+import subprocess
+import wave
+from time import monotonic
+
+from synthesis_manifest import SynthesisManifest, CHUNK_DONE
+from metrics import timed_stage
+
+# GLOBALS
+
+SILENCE_THRESHOLD_DB = -50      # dBFS.  Samples quieter than this at the ends of a chunk are trimmed off..
+TRIM_PAD_SECONDS = 0.05         # ..except for this much, so the start of the first word isn't clipped
+CHUNK_GAP_SECONDS = 0.6         # Between chunks, which always end on a sentence
+PARAGRAPH_GAP_SECONDS = 1.2     # Between chunks where a paragraph ends
+LEAD_IN_SECONDS = 0.75          # ACX: 0.5 - 1 s of silence at the start of every file..
+TAIL_SECONDS = 3.0              # ..and 1 - 5 s at the end
+
+TARGET_RMS_DB = -20             # dBFS.  ACX wants -23 to -18 dB RMS..
+PEAK_CEILING_DB = -3            # ..with no peak above -3 dB
+LOUDNESS_GATE_DB = -45          # 50 ms windows quieter than this are pauses, and don't count towards the loudness
+LOUDNESS_WINDOW_SECONDS = 0.05
+
+PROCESS_BLOCK_WINDOWS = 256     # Loudness windows read at a time, ~13 s of 16 kHz audio, 400 KB
+MASTERED_SUFFIX = "_mastered"
+
+# ACX's delivery format: 192 kbps constant bit rate, 44.1 kHz
+MP3_ENCODER_ARGS = ["-codec:a", "libmp3lame", "-b:a", "192k", "-ar", "44100", "-f", "mp3"]
+
+
+def _import_numpy():
+    # Only post-processing needs NumPy, so it's only imported (and only has to be installed) for that
+    try:
+        import numpy
+    except ImportError:
+        print("ERROR: Audio post-processing needs NumPy: pip install numpy")
+        quit()
+    return numpy
+
+
+def _db_to_amplitude(db):
+    # As a fraction of full scale, 32768 for 16-bit samples
+    return 32768 * 10 ** (db / 20)
+
+
+class _SampleReader:
+    """Blocks of 16-bit mono samples out of a .wav, as NumPy arrays."""
+
+    def __init__(self, wav, np):
+        self.wav = wav
+        self.np = np
+
+    def read(self, start, count):
+        self.wav.setpos(start)
+        return self.np.frombuffer(self.wav.readframes(count), dtype="<i2")
+
+    def blocks(self, start, end, block_size):
+        for block_start in range(start, end, block_size):
+            yield self.read(block_start, min(block_size, end - block_start))
+
+
+def find_speech(reader, start, end, threshold, block_size):
+    """(first, last + 1) sample between start and end that's louder than threshold, or None if it's all silence.
+    Scans in from both ends, so only the silence (and the block the speech starts in) is ever read."""
+
+    np = reader.np
+    first = None
+    for block_start in range(start, end, block_size):
+        loud = np.flatnonzero(np.abs(reader.read(block_start, min(block_size, end - block_start)).astype(np.int32)) > threshold)
+        if loud.size:
+            first = block_start + int(loud[0])
+            break
+    if first is None:
+        return None
+
+    for block_end in range(end, first, -block_size):
+        block_start = max(block_end - block_size, first)
+        loud = np.flatnonzero(np.abs(reader.read(block_start, block_end - block_start).astype(np.int32)) > threshold)
+        if loud.size:
+            return first, block_start + int(loud[-1]) + 1
+    return first, first + 1
+
+
+def measure_loudness(reader, segments, window, gate, block_size):
+    """(RMS level, peak level) of the samples in segments, in dBFS.  The RMS only counts windows louder than
+    gate, so it's the level of the speech, however much pause there is between it."""
+
+    np = reader.np
+    gate_power = (gate / 32768) ** 2
+    power_sum, gated_windows, peak = 0.0, 0, 0
+    for start, end in segments:
+        for block in reader.blocks(start, end, block_size):
+            peak = max(peak, int(np.abs(block.astype(np.int32)).max(initial=0)))
+            samples = block.astype(np.float64) / 32768
+            if len(samples) % window:
+                # The last window of a segment can be short.  Padding it with silence only makes it quieter.
+                samples = np.concatenate([samples, np.zeros(window - len(samples) % window)])
+            power = (samples.reshape(-1, window) ** 2).mean(axis=1)
+            loud = power > gate_power
+            power_sum += float(power[loud].sum())
+            gated_windows += int(loud.sum())
+
+    rms_db = 10 * math.log10(power_sum / gated_windows) if gated_windows else None
+    peak_db = 20 * math.log10(peak / 32768) if peak else None
+    return rms_db, peak_db
+
+
+def master_gain(rms_db, peak_db, target_rms_db=TARGET_RMS_DB, peak_ceiling_db=PEAK_CEILING_DB):
+    """Gain (a multiplier) that brings rms_db to target_rms_db, or as close as it gets without the peak going
+    over peak_ceiling_db."""
+    if rms_db is None:
+        return 1.0
+    gain_db = target_rms_db - rms_db
+    if peak_db is not None:
+        gain_db = min(gain_db, peak_ceiling_db - peak_db)
+    return 10 ** (gain_db / 20)
+
+
+@timed_stage("master_audio")
+def master_audio(wav_path, chunks, output_path, target_rms_db=TARGET_RMS_DB, peak_ceiling_db=PEAK_CEILING_DB,
+                 chunk_gap=CHUNK_GAP_SECONDS, paragraph_gap=PARAGRAPH_GAP_SECONDS, lead_in=LEAD_IN_SECONDS,
+                 tail=TAIL_SECONDS):
+    """Writes the mastered version of the joined wav_path to output_path (see the top of this file).  chunks are
+    the manifest entries of its chunks in order: offset/length (sample bytes after the WAV header) and
+    paragraph.  Returns (seconds of audio in, seconds out)."""
+
+    np = _import_numpy()
+    start_time = monotonic()
+
+    with wave.open(wav_path, "rb") as wav:
+        if wav.getsampwidth() != 2 or wav.getnchannels() != 1:
+            print(f"ERROR: {wav_path} isn't 16-bit mono, which is all Polly's pcm output ever is.")
+            quit()
+        rate = wav.getframerate()
+        reader = _SampleReader(wav, np)
+        window = max(1, round(LOUDNESS_WINDOW_SECONDS * rate))
+        block_size = window * PROCESS_BLOCK_WINDOWS
+        pad = round(TRIM_PAD_SECONDS * rate)
+
+        # Pass 1: where the speech is in each chunk, and how loud it is
+        segments = []   # (start, end, padding before, padding after, paragraph), in samples
+        for entry in chunks:
+            start = entry["offset"] // 2
+            end = start + entry["length"] // 2
+            speech = find_speech(reader, start, end, _db_to_amplitude(SILENCE_THRESHOLD_DB), block_size)
+            if speech is not None:
+                padded = (max(speech[0] - pad, start), min(speech[1] + pad, end))
+                segments.append((padded[0], padded[1], speech[0] - padded[0], padded[1] - speech[1],
+                                 entry.get("paragraph", False)))
+        rms_db, peak_db = measure_loudness(reader, [(start, end) for start, end, _, _, _ in segments], window,
+                                           _db_to_amplitude(LOUDNESS_GATE_DB), block_size)
+        gain = master_gain(rms_db, peak_db, target_rms_db, peak_ceiling_db)
+
+        # Pass 2: the speech, scaled, with even gaps between it.  Written to a temp file and renamed, so a
+        # half written file is never mistaken for a finished one.
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "wb") as fw, wave.open(fw, "wb") as out:
+            out.setnchannels(1)
+            out.setsampwidth(2)
+            out.setframerate(rate)
+
+            def silence(seconds, padding=0):
+                # Gaps are from the end of the speech to the start of the next, so the padding counts towards them
+                out.writeframesraw(b"\x00\x00" * max(round(seconds * rate) - padding, 0))
+
+            for i, (start, end, before, after, paragraph) in enumerate(segments):
+                if i == 0:
+                    silence(lead_in, before)
+                for block in reader.blocks(start, end, block_size):
+                    scaled = np.clip(np.rint(block.astype(np.float32) * gain), -32768, 32767).astype("<i2")
+                    out.writeframesraw(scaled.tobytes())
+                if i < len(segments) - 1:
+                    silence(paragraph_gap if paragraph else chunk_gap, after + segments[i + 1][2])
+                else:
+                    silence(tail, after)
+            if not segments:
+                silence(lead_in + tail)
+            seconds_out = out.getnframes() / rate
+        seconds_in = wav.getnframes() / rate
+    os.replace(tmp_path, output_path)
+
+    elapsed = monotonic() - start_time
+    level = f"{rms_db:.1f} dB RMS, peak {peak_db:.1f} dB" if rms_db is not None else "silent"
+    print(f"Mastered {output_path}: {seconds_in:.0f}s -> {seconds_out:.0f}s of audio, {level}, gain "
+          f"{20 * math.log10(gain):+.1f} dB, in {elapsed:.1f}s ({seconds_in / max(elapsed, 1e-9):.0f}x real time)")
+    return seconds_in, seconds_out
+
+
+def encode_mp3(wav_path, mp3_path):
+    """Encodes wav_path to mp3_path with ffmpeg.  Returns False (and says so) if ffmpeg isn't installed."""
+
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        print(f"ffmpeg not found, so {wav_path} wasn't encoded to mp3.  Install ffmpeg, or encode it yourself.")
+        return False
+    tmp_path = mp3_path + ".tmp"
+    try:
+        subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-i", wav_path] + MP3_ENCODER_ARGS + [tmp_path],
+                       check=True)
+    except subprocess.CalledProcessError as error:
+        print(f"ERROR: Could not encode {wav_path} to mp3.")
+        print(error)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, mp3_path)
+    print(f"Saved {mp3_path}")
+    return True
+
+
+def master_joined_file(output_path, basename, encode=True, **master_args):
+    """Masters {basename}.wav in output_path, as rendered by save_polly_speech(), into {basename}_mastered.wav
+    (and .mp3 if encode).  master_args go to master_audio().  Returns the mastered file's path, or None if
+    there isn't a finished .wav to master."""
+
+    wav_path = os.path.join(output_path, basename + ".wav")
+    manifest = SynthesisManifest.load(output_path, basename)
+    # The offsets are only good for the file the manifest was saved with
+    if not manifest.output_matches(wav_path) or any(entry["status"] != CHUNK_DONE for entry in manifest.chunks):
+        print(f"ERROR: {wav_path} isn't a finished pcm render (see {manifest.path}), nothing to master.")
+        return None
+
+    mastered_path = os.path.join(output_path, basename + MASTERED_SUFFIX + ".wav")
+    master_audio(wav_path, manifest.chunks, mastered_path, **master_args)
+    if encode:
+        encode_mp3(mastered_path, os.path.join(output_path, basename + MASTERED_SUFFIX + ".mp3"))
+    return mastered_path
+
+
+def find_joined_wavs(book_dir):
+    """Basenames of every rendered .wav (one with a manifest) in book_dir, sorted."""
+    return sorted(name[:-len(".wav")] for name in os.listdir(book_dir)
+                  if name.endswith(".wav") and not name.endswith(MASTERED_SUFFIX + ".wav")
+                  and os.path.exists(os.path.join(book_dir, name[:-len(".wav")] + "_manifest.json")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("book_dir", help="book folder rendered with POSTPROCESS=1 (or output_format pcm)")
+    parser.add_argument("--target-rms", type=float, default=TARGET_RMS_DB, help="loudness to aim for, dBFS RMS")
+    parser.add_argument("--peak", type=float, default=PEAK_CEILING_DB, help="highest allowed peak, dBFS")
+    parser.add_argument("--gap", type=float, default=CHUNK_GAP_SECONDS, help="seconds of silence between chunks")
+    parser.add_argument("--paragraph-gap", type=float, default=PARAGRAPH_GAP_SECONDS,
+                        help="seconds of silence where a paragraph ends")
+    parser.add_argument("--no-encode", action="store_true", help="only save the .wav, don't encode an .mp3")
+    args = parser.parse_args()
+
+    basenames = find_joined_wavs(args.book_dir)
+    if not basenames:
+        print(f"ERROR: No rendered .wav files in {args.book_dir}.  Render the book with POSTPROCESS=1 first.")
+        quit()
+    for basename in basenames:
+        master_joined_file(args.book_dir, basename, encode=not args.no_encode, target_rms_db=args.target_rms,
+                           peak_ceiling_db=args.peak, chunk_gap=args.gap, paragraph_gap=args.paragraph_gap)
+
+
+if __name__ == "__main__":
+    main()
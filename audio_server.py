@@ -0,0 +1,259 @@
+"""Serves a book's audio over HTTP while it's still being synthesized, so it can be listened to within seconds
+of starting read_entire_book.py (or batch.py) instead of after the last chunk.  Run it alongside the render:
+
+    python audio_server.py books/hiroshima/ --port 8000
+
+then open http://localhost:8000/ for a page with a player per chapter.  A file that's still being written is
+streamed as it grows: everything up to the last chunk in its {basename}_playback.jsonl index (chunks land in
+text order, see save_polly_speech()), then each new chunk as soon as it's indexed, until the file is finished.
+
+If the book was rendered with speech marks (SPEECH_MARKS=1), http://localhost:8000/find?word=hiroshima lists every
+sentence the word is in, each with a player for just that sentence, e.g. to check a lexicon fix.
+"""
+
+import argparse
+import html
+import json
+import os
+import re
+import struct
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, parse_qs
+
+from audio_utils import AUDIO_COPY_BLOCK_SIZE, WAV_HEADER_SIZE, PARTIAL_SUFFIX, PLAYBACK_INDEX_SUFFIX
+from speech_marks import find_word, format_time
+
+# GLOBALS
+
+SERVER_POLL_INTERVAL = 0.25     # Seconds between checks for new chunks while streaming a growing file
+SERVER_IDLE_TIMEOUT = 600       # Give up on a file that hasn't grown in this long, the render probably died
+
+# Per output format, same keys as audio_utils.AUDIO_FILE_EXTENSIONS
+CONTENT_TYPES = {
+    "mp3": "audio/mpeg",
+    "pcm": "audio/wav",
+}
+
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class PlaybackIndex:
+    """What's in a joined file so far, read from its {basename}_playback.jsonl."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None        # Final file name, e.g. chapter_3.mp3
+        self.format = None
+        self.chunks = 0
+        self.end = 0            # Bytes of the file that hold whole chunks
+        self.complete = None    # True once the file is finished, False if the render failed
+        self.reload()
+
+    def reload(self):
+        self.chunks, self.end, self.complete = 0, 0, None
+        try:
+            with open(self.path, "r", encoding="utf8") as fr:
+                lines = fr.readlines()
+        except FileNotFoundError:
+            return self
+        for line in lines:
+            if not line.endswith("\n"):
+                break   # Still being written
+            record = json.loads(line)
+            if "file" in record:
+                self.file, self.format = record["file"], record["format"]
+            elif "chunk" in record:
+                self.chunks += 1
+                self.end = record["end"]
+            elif "complete" in record:
+                self.complete = record["complete"]
+        return self
+
+
+def _natural_key(name):
+    # chapter_2 before chapter_10
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def find_playback_indexes(book_dir):
+    """PlaybackIndex of every joined file in book_dir, in chapter order."""
+    names = [name for name in os.listdir(book_dir) if name.endswith(PLAYBACK_INDEX_SUFFIX)]
+    return [PlaybackIndex(os.path.join(book_dir, name)) for name in sorted(names, key=_natural_key)]
+
+
+def _streaming_wav_header(header):
+    # The real sizes are only written when the file is finished.  Until then, say "as long as it gets",
+    # the usual convention for streamed WAV.
+    return header[:4] + struct.pack("<I", 0xFFFFFFFF) + header[8:40] + struct.pack("<I", 0xFFFFFFFF - 36)
+
+
+def _read_range(path, start, end):
+    """Bytes start:end of path, or None if the file isn't there (e.g. mid-rename)."""
+    try:
+        with open(path, "rb") as fr:
+            fr.seek(start)
+            return fr.read(end - start)
+    except FileNotFoundError:
+        return None
+
+
+class AudioRequestHandler(BaseHTTPRequestHandler):
+    book_dir = "."      # Set by serve()
+
+    def log_message(self, format, *args):
+        print(f"[server] {self.address_string()} {format % args}")
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        name = unquote(path).lstrip("/")
+        if not name:
+            return self._send_page()
+        if name == "find":
+            return self._send_find(parse_qs(query).get("word", [""])[0].strip())
+
+        index = next((index for index in find_playback_indexes(self.book_dir) if index.file == name), None)
+        if index is None:
+            self.send_error(404, "No such audio file")
+            return
+
+        final_path = os.path.join(self.book_dir, index.file)
+        try:
+            if index.complete:
+                self._send_file(final_path, CONTENT_TYPES[index.format])
+            else:
+                self._send_growing(index, final_path)
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # The listener went away
+
+    def _send_html(self, title, rows):
+        search = ('<form action="/find"><input name="word" placeholder="Find a word (needs SPEECH_MARKS=1)">'
+                  '<button>Find</button></form>')
+        body = (f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{html.escape(title)}</title></head><body>"
+                + search + "".join(rows) + "</body></html>").encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_find(self, word):
+        # One player per sentence the word is in, playing just that sentence (a media fragment, so the browser
+        # seeks straight there with a Range request)
+        rows = []
+        for file, mark, (start, end, _, _), sentence in (find_word(self.book_dir, word) if word else []):
+            rows.append(f"<h3>{html.escape(file)} {format_time(mark['time'])}</h3><p>{html.escape(sentence)}</p>"
+                        f'<audio controls preload="none" src="/{html.escape(file)}#t={start / 1000:.3f},{end / 1000:.3f}"></audio>')
+        heading = f"<p>{len(rows)} occurrences of {html.escape(word)}.  <a href='/'>All files</a></p>"
+        self._send_html(f"Find {word}", [heading] + rows)
+
+    def _send_page(self):
+        rows = []
+        for index in find_playback_indexes(self.book_dir):
+            if index.file is None:
+                continue
+            status = {True: "finished", False: "failed"}.get(index.complete, "synthesizing")
+            rows.append(f"<h3>{html.escape(index.file)}</h3><p>{index.chunks} chunks, {status}</p>"
+                        f'<audio controls preload="none" src="/{html.escape(index.file)}"></audio>')
+        self._send_html("Audiobook", rows or ["<p>Nothing synthesized yet, reload in a bit.</p>"])
+
+    def _send_file(self, path, content_type):
+        # A finished file, with Range support so players can seek
+        size = os.path.getsize(path)
+        start, end = 0, size
+        m = RANGE_HEADER.match(self.headers.get("Range", ""))
+        if m and (m.group(1) or m.group(2)):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)) + 1, size) if m.group(2) else size
+            else:
+                start = max(size - int(m.group(2)), 0)     # Last N bytes
+            if start >= end:
+                self.send_error(416, "Requested range not satisfiable")
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        with open(path, "rb") as fr:
+            fr.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = fr.read(min(remaining, AUDIO_COPY_BLOCK_SIZE))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def _send_growing(self, index, final_path):
+        # Length unknown, so no Content-Length: the response ends when the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[index.format])
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        partial_path = final_path + PARTIAL_SUFFIX
+        sent = 0
+        last_growth = time.monotonic()
+        while True:
+            index.reload()
+            if index.complete is False:
+                return
+            # Until it's finished, the chunks are only in the .partial file.  Once it is, the .partial has been
+            # renamed to the final file, same bytes, so carry on from the same position.
+            available = os.path.getsize(final_path) if index.complete else index.end
+            if available > sent:
+                data = _read_range(final_path if index.complete else partial_path, sent, available)
+                if data is None:
+                    time.sleep(SERVER_POLL_INTERVAL)
+                    continue
+                if sent == 0 and index.format == "pcm" and not index.complete and len(data) >= WAV_HEADER_SIZE:
+                    data = _streaming_wav_header(data[:WAV_HEADER_SIZE]) + data[WAV_HEADER_SIZE:]
+                self.wfile.write(data)
+                self.wfile.flush()
+                sent += len(data)
+                last_growth = time.monotonic()
+            elif index.complete:
+                return
+            elif time.monotonic() - last_growth > SERVER_IDLE_TIMEOUT:
+                return
+            else:
+                time.sleep(SERVER_POLL_INTERVAL)
+
+
+def serve(book_dir, host="127.0.0.1", port=8000):
+    """Serves book_dir's joined audio files until interrupted."""
+
+    handler = type("BookRequestHandler", (AudioRequestHandler,), {"book_dir": book_dir})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving {book_dir} on http://{host}:{server.server_address[1]}/  (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("book_dir", help="book folder, e.g. books/hiroshima/")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: this machine only)")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.book_dir):
+        print(f"ERROR: No such book folder: {args.book_dir}")
+        quit()
+    serve(args.book_dir, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
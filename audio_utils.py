@@ -0,0 +1,270 @@
+"""Functions for writing synthesized audio to disk without holding whole chunks in memory."""
+
+import os
+import wave
+
+# GLOBALS
+
+AUDIO_COPY_BLOCK_SIZE = 64 * 1024   # Bytes copied at a time from the response/cache to the output file
+
+# Polly's "pcm" output is raw signed 16-bit little-endian mono.  Neural voices support 8000, 16000 or 24000 Hz.
+PCM_SAMPLE_RATE = 16000
+PCM_SAMPLE_WIDTH = 2
+PCM_CHANNELS = 1
+
+# What wave writes in front of the samples of a mono 16-bit PCM file
+WAV_HEADER_SIZE = 44
+
+# A joined file is written as {basename}.mp3.partial until it's finished, with {basename}_playback.jsonl
+# saying which chunks are in it so far, so audio_server.py can serve it while it's still growing
+PARTIAL_SUFFIX = ".partial"
+PLAYBACK_INDEX_SUFFIX = "_playback.jsonl"
+
+# File extension written for each Polly OutputFormat.  PCM gets wrapped in a WAV container.
+AUDIO_FILE_EXTENSIONS = {
+    "mp3": "mp3",
+    "pcm": "wav",
+}
+
+
+# MPEG audio frame header fields, see iter_mp3_frames().  Layer III only, which is all Polly makes.
+MP3_BITRATES = {   # kbps by bitrate index, for MPEG-1 and for MPEG-2/2.5
+    1: [None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, None],
+    2: [None, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, None],
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}  # By version bits
+
+
+def copy_stream(src, dst, block_size=AUDIO_COPY_BLOCK_SIZE):
+    """Copies a readable binary stream to a writable one in fixed-size blocks.  Returns bytes copied."""
+
+    copied = 0
+    for block in iter(lambda: src.read(block_size), b""):
+        dst.write(block)
+        copied += len(block)
+    return copied
+
+
+def _id3v2_size(header):
+    """Total length of an ID3v2 tag (header included) at the start of header, or 0 if there isn't one."""
+
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    # Tag size is 4 "syncsafe" bytes, 7 bits each
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    footer = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _mp3_frame_start(block):
+    """Index of the first MPEG frame sync (11 set bits) in block, or 0 if none is found."""
+
+    idx = block.find(b"\xff")
+    while idx != -1 and idx + 1 < len(block):
+        if block[idx + 1] & 0xE0 == 0xE0:
+            return idx
+        idx = block.find(b"\xff", idx + 1)
+    return 0
+
+
+def _mp3_frame_header(header):
+    """(frame length in bytes, seconds of audio) for the 4 byte MPEG Layer III frame header, or None if it isn't one."""
+
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x3         # 3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5
+    layer = (header[1] >> 1) & 0x3           # 1 = Layer III
+    bitrate_idx = header[2] >> 4
+    rate_idx = (header[2] >> 2) & 0x3
+    padding = (header[2] >> 1) & 0x1
+    if version == 1 or layer != 1 or rate_idx == 3:
+        return None
+    bitrate = MP3_BITRATES[1 if version == 3 else 2][bitrate_idx]
+    if bitrate is None:
+        return None
+    sample_rate = MP3_SAMPLE_RATES[version][rate_idx]
+    samples = 1152 if version == 3 else 576
+    return (samples // 8 * bitrate * 1000 // sample_rate + padding, samples / sample_rate)
+
+
+def iter_mp3_frames(path, start=0, end=None):
+    """Yields (byte offset, seconds from start) of every MP3 frame in bytes start:end of path, then one last
+    (end offset, total seconds).  Anything that isn't a frame header is skipped until the next frame sync."""
+
+    with open(path, "rb") as fr:
+        if end is None:
+            end = os.fstat(fr.fileno()).st_size
+        fr.seek(start)
+        buffer = fr.read(min(AUDIO_COPY_BLOCK_SIZE, end - start))
+        buffer_start = start
+        pos = start
+        seconds = 0.0
+        while pos < end:
+            if pos + 4 > buffer_start + len(buffer):
+                # Refill from pos, keeping whatever's left of the old buffer (nothing, if the last frame ran past it)
+                keep = buffer[pos - buffer_start:]
+                fr.seek(pos + len(keep))
+                buffer = keep + fr.read(min(AUDIO_COPY_BLOCK_SIZE, end - pos - len(keep)))
+                buffer_start = pos
+                if len(buffer) < 4:
+                    break
+            frame = _mp3_frame_header(buffer[pos - buffer_start:pos - buffer_start + 4])
+            if frame is None:
+                pos += 1
+                continue
+            yield (pos, seconds)
+            pos += frame[0]
+            seconds += frame[1]
+    yield (min(pos, end), seconds)
+
+
+def _mp3_info_frame_size(block):
+    """Length of the Xing/Info/VBRI header frame at the start of block (an encoder's summary of the file, which
+    would be wrong in the middle of another one), or 0 if block starts with an ordinary frame."""
+
+    frame = _mp3_frame_header(block[:4])
+    if frame is not None and any(marker in block[:64] for marker in (b"Xing", b"Info", b"VBRI")):
+        return frame[0]
+    return 0
+
+
+def mp3_audio_range(path):
+    """(start, end) bytes of path's MPEG frames: after any ID3v2 tag and Xing/Info/VBRI header frame (an encoder's
+    summary of the file, which would be wrong in the middle of another one), and before any ID3v1 tag."""
+
+    with open(path, "rb") as fr:
+        end = os.fstat(fr.fileno()).st_size
+        start = _id3v2_size(fr.read(10))
+        if end >= 128:
+            fr.seek(end - 128)
+            if fr.read(3) == b"TAG":
+                end -= 128
+
+        fr.seek(start)
+        start += _mp3_info_frame_size(fr.read(64))
+    return start, max(start, end)
+
+
+class AudioFileWriter:
+    """Writes one continuous audio file from any number of chunks, appended in order.
+
+    For mp3, each chunk is appended starting at its first MPEG frame (any ID3 tag or Xing/Info header frame in
+    front is dropped, same as mp3_audio_range()), so the result plays back as one gapless stream.  For pcm, the samples go into a WAV container whose
+    header sizes are filled in when the writer is closed."""
+
+    def __init__(self, path, output_format="mp3", sample_rate=PCM_SAMPLE_RATE):
+        if output_format not in AUDIO_FILE_EXTENSIONS:
+            raise ValueError(f"Unsupported output format for AudioFileWriter: {output_format}")
+
+        self.path = path
+        self.output_format = output_format
+        self.bytes_written = 0
+
+        self._file = open(path, "wb")
+        if output_format == "pcm":
+            # wave is handed our file, rather than the path, so flush() can get at it
+            self._wav = wave.open(self._file, "wb")
+            self._wav.setnchannels(PCM_CHANNELS)
+            self._wav.setsampwidth(PCM_SAMPLE_WIDTH)
+            self._wav.setframerate(sample_rate)
+        else:
+            self._wav = None
+
+    def append(self, stream):
+        """Appends one chunk of audio read from a binary stream, one block at a time."""
+
+        if self._wav is not None:
+            for block in iter(lambda: stream.read(AUDIO_COPY_BLOCK_SIZE), b""):
+                # writeframesraw() doesn't patch the header every call, close() does it once at the end
+                self._wav.writeframesraw(block)
+                self.bytes_written += len(block)
+            return
+
+        first_block = stream.read(AUDIO_COPY_BLOCK_SIZE)
+
+        # Skip a leading ID3 tag, even if it runs past the first block
+        tag_size = _id3v2_size(first_block)
+        if tag_size > len(first_block):
+            remaining = tag_size - len(first_block)
+            while remaining > 0:
+                skipped = stream.read(min(remaining, AUDIO_COPY_BLOCK_SIZE))
+                if not skipped:
+                    return
+                remaining -= len(skipped)
+            first_block = stream.read(AUDIO_COPY_BLOCK_SIZE)
+        else:
+            first_block = first_block[tag_size:]
+
+        def fill(block, size):
+            # Streams can come back short, read on until there's size bytes to look at (or the chunk ends)
+            while len(block) < size:
+                more = stream.read(AUDIO_COPY_BLOCK_SIZE)
+                if not more:
+                    break
+                block += more
+            return block
+
+        # Then start on a frame boundary
+        first_block = fill(first_block, 64)
+        first_block = first_block[_mp3_frame_start(first_block):]
+
+        # Past the encoder's header frame, if there is one.  Spliced chunks are copied from after it too (see
+        # mp3_audio_range()), so the joined file comes out the same either way.
+        first_block = fill(first_block, 64)
+        info_size = _mp3_info_frame_size(first_block)
+        first_block = fill(first_block, info_size)[info_size:]
+
+        self._file.write(first_block)
+        self.bytes_written += len(first_block) + copy_stream(stream, self._file)
+
+    def append_file(self, chunk_path):
+        """Appends one chunk of audio from a file on disk."""
+        with open(chunk_path, "rb") as fr:
+            self.append(fr)
+
+    def append_range(self, src_path, offset, length):
+        """Copies length bytes of audio starting at offset out of an earlier AudioFileWriter's output, as-is.
+        offset/length are in the same units as bytes_written: file bytes for mp3 (already frame-aligned, so
+        nothing is skipped), sample bytes after the WAV header for pcm."""
+
+        if self._wav is not None:
+            with wave.open(src_path, "rb") as src:
+                src.setpos(offset // PCM_SAMPLE_WIDTH)
+                remaining = length // PCM_SAMPLE_WIDTH
+                while remaining > 0:
+                    frames = src.readframes(min(remaining, AUDIO_COPY_BLOCK_SIZE // PCM_SAMPLE_WIDTH))
+                    if not frames:
+                        break
+                    self._wav.writeframesraw(frames)
+                    self.bytes_written += len(frames)
+                    remaining -= len(frames) // PCM_SAMPLE_WIDTH
+            return
+
+        with open(src_path, "rb") as src:
+            src.seek(offset)
+            remaining = length
+            while remaining > 0:
+                block = src.read(min(remaining, AUDIO_COPY_BLOCK_SIZE))
+                if not block:
+                    break
+                self._file.write(block)
+                self.bytes_written += len(block)
+                remaining -= len(block)
+
+    def flush(self):
+        """Pushes everything appended so far out to the file, so another process reading it sees whole chunks.
+        (A .wav's header sizes are still only filled in by close().)"""
+        self._file.flush()
+
+    def close(self):
+        if self._wav is not None:
+            # Doesn't close a file it was handed, just patches the header sizes
+            self._wav.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
@@ -0,0 +1,227 @@
+"""Runs tricky sentence previews (read_tricky_sentences.py) and full renders (read_entire_book.py) for every
+book in a directory, in one process.  Every job shares the same request rate and connection budget, so the
+account's throughput is used up without books throttling each other.  Jobs start in priority order (lower
+numbers first), and whenever requests are waiting on a connection the highest priority job's go first.
+
+    python batch.py books/
+    python batch.py books/ --jobs full --priority hiroshima=0 --priority hiroshima:full=5
+
+With --dry-run nothing is sent to Polly.  Instead every job's requests go into one plan (see synthesis_plan.py),
+reported at the end with the cost and how long the whole batch would take under these limits.
+"""
+
+import argparse
+import atexit
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from text_utils import find_chapter_files
+from metrics import METRICS
+from synthesis_plan import SynthesisPlan
+from read_tricky_sentences import read_tricky_sentences
+from read_entire_book import read_entire_book
+import tts_utils
+
+# GLOBALS
+
+# What each kind of job runs, and its default priority.  Previews first: they're short, and their clips need
+# listening to (and the lexicon fixing) before a full render is worth much anyway.
+JOB_KINDS = {
+    "preview": read_tricky_sentences,
+    "full": read_entire_book,
+}
+JOB_PRIORITIES = {
+    "preview": 10,
+    "full": 20,
+}
+
+MAX_PARALLEL_JOBS = 3       # Enough jobs going at once to keep every connection busy between their stages
+PROGRESS_INTERVAL = 30      # Seconds between progress reports
+
+
+class BatchJob:
+    """One job (a kind of run on one book) and how far along it is."""
+
+    def __init__(self, book_dir, kind, priority):
+        self.book_dir = book_dir
+        self.kind = kind
+        self.priority = priority
+        self.name = f"{os.path.basename(os.path.normpath(book_dir))}:{kind}"
+        self.status = "queued"
+        self.started = None
+        self.finished = None
+        self._progress = {}     # Output file/clip set -> (done, total or None)
+        self._lock = threading.Lock()
+
+    def report(self, label, done, total):
+        """progress callback for save_polly_speech()/save_polly_clips(), called from their threads."""
+        with self._lock:
+            self._progress[label] = (done, total)
+
+    def done_count(self):
+        """(chunks/clips done, total or None if some totals aren't known yet)"""
+        with self._lock:
+            done = sum(done for done, _ in self._progress.values())
+            totals = [total for _, total in self._progress.values()]
+        return done, (sum(totals) if None not in totals else None)
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def describe(self):
+        done, total = self.done_count()
+        if not self._progress:
+            count = "-"
+        else:
+            count = f"{done}/{total}" if total is not None else f"{done}/?"
+        return f"{self.name:<32} {self.priority:>8} {self.status:<8} {count:>12} {self.elapsed():>9.0f}s"
+
+
+def find_books(books_dir):
+    """Every directory directly under books_dir with an input.txt or chapter_N.txt files in it, sorted by name."""
+
+    books = []
+    for name in sorted(os.listdir(books_dir)):
+        book_dir = os.path.join(books_dir, name)
+        if os.path.isdir(book_dir) and (os.path.exists(os.path.join(book_dir, "input.txt")) or find_chapter_files(book_dir)):
+            books.append(book_dir)
+    return books
+
+
+def make_jobs(books, kinds, priorities=()):
+    """Jobs for each kind on each book.  priorities are (target, priority) overrides, where target is a book
+    name ("hiroshima") for all its jobs or book:kind ("hiroshima:full") for one.  Job specific ones win."""
+
+    book_priorities = {target: priority for target, priority in priorities if ":" not in target}
+    job_priorities = {target: priority for target, priority in priorities if ":" in target}
+
+    jobs = []
+    for book_dir in books:
+        book = os.path.basename(os.path.normpath(book_dir))
+        for kind in kinds:
+            priority = job_priorities.get(f"{book}:{kind}", book_priorities.get(book, JOB_PRIORITIES[kind]))
+            jobs.append(BatchJob(book_dir, kind, priority))
+
+    # Stable, so equal priorities keep book order
+    return sorted(jobs, key=lambda job: job.priority)
+
+
+def _run_job(job, plan=None):
+    job.status = "running"
+    job.started = time.monotonic()
+    print(f"[batch] Starting {job.name} (priority {job.priority})..")
+    extra_args = {"plan": plan} if plan is not None else {}
+    try:
+        JOB_KINDS[job.kind](job.book_dir, priority=job.priority, progress=job.report, **extra_args)
+        job.status = "done"
+    except SystemExit:
+        # The job quit on an error it couldn't get past.  Only that job stops, its manifest says what to redo.
+        job.status = "failed"
+    except Exception:
+        traceback.print_exc()
+        job.status = "failed"
+    job.finished = time.monotonic()
+    print(f"[batch] {job.name} {job.status} after {job.elapsed():.0f}s.")
+
+
+def print_progress(jobs):
+    print(f"[batch] {'job':<32} {'priority':>8} {'status':<8} {'done':>12} {'time':>10}")
+    for job in jobs:
+        print(f"[batch] {job.describe()}")
+
+
+def run_batch(jobs, max_parallel_jobs=MAX_PARALLEL_JOBS, progress_interval=PROGRESS_INTERVAL, plan=None):
+    """Runs the jobs, max_parallel_jobs at a time in priority order, printing everyone's progress every
+    progress_interval seconds.  They all share tts_utils' rate and connection limits.  Returns True if
+    every job finished.  Pass a SynthesisPlan as plan to dry run them all into it instead."""
+
+    stop = threading.Event()
+
+    def report_progress():
+        while not stop.wait(progress_interval):
+            print_progress(jobs)
+
+    reporter = threading.Thread(target=report_progress, daemon=True)
+    reporter.start()
+    try:
+        # Submitted in priority order, so they also start in priority order
+        with ThreadPoolExecutor(max_workers=max_parallel_jobs) as executor:
+            for job in jobs:
+                executor.submit(_run_job, job, plan)
+    finally:
+        stop.set()
+
+    print_progress(jobs)
+    return all(job.status == "done" for job in jobs)
+
+
+def _priority_arg(value):
+    target, sep, priority = value.rpartition("=")
+    if not sep or not target:
+        raise argparse.ArgumentTypeError(f"expected BOOK=N or BOOK:KIND=N, got {value}")
+    try:
+        return target, int(priority)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"priority must be a whole number, got {priority}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("books_dir", help="directory with one folder per book, e.g. books/")
+    parser.add_argument("--jobs", default="preview,full",
+                        help=f"comma separated kinds of job to run on each book, from: {', '.join(JOB_KINDS)}")
+    parser.add_argument("--priority", type=_priority_arg, action="append", default=[], metavar="BOOK[:KIND]=N",
+                        help="priority for a book's jobs, or one of them (lower goes first, defaults: "
+                             + ", ".join(f"{kind} {priority}" for kind, priority in JOB_PRIORITIES.items()) + ")")
+    parser.add_argument("--parallel-jobs", type=int, default=MAX_PARALLEL_JOBS, help="jobs to run at once")
+    parser.add_argument("--tps", type=float, help="override the shared synthesis rate limit (requests/second)")
+    parser.add_argument("--connections", type=int, help="override the shared limit on requests in flight")
+    parser.add_argument("--dry-run", action="store_true", help="plan every job's requests, cost and time without sending any")
+    parser.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL, help="seconds between progress reports")
+    args = parser.parse_args()
+
+    kinds = [kind.strip() for kind in args.jobs.split(",") if kind.strip()]
+    unknown = [kind for kind in kinds if kind not in JOB_KINDS]
+    if unknown:
+        parser.error(f"unknown job kind: {', '.join(unknown)}")
+
+    # One budget for the whole batch, whatever it's set to
+    if args.tps is not None:
+        tts_utils.POLLY_RATE_LIMITER = tts_utils.TokenBucket(rate=args.tps, capacity=args.tps)
+    if args.connections is not None:
+        tts_utils.POLLY_CONNECTION_LIMITER = tts_utils.PrioritySemaphore(args.connections)
+
+    books = find_books(args.books_dir)
+    if not books:
+        print(f"ERROR: No books (folders with an input.txt or chapter_N.txt files) found in {args.books_dir}")
+        quit()
+    jobs = make_jobs(books, kinds, args.priority)
+
+    # One metrics.jsonl for the whole batch, with the summary printed at the end
+    METRICS.configure(os.path.join(args.books_dir, "metrics.jsonl"))
+    atexit.register(lambda: print("\n" + METRICS.summary()))
+
+    print(f"[batch] {len(jobs)} jobs for {len(books)} books, {args.parallel_jobs} at a time:")
+    print_progress(jobs)
+
+    plan = SynthesisPlan() if args.dry_run else None
+    ok = run_batch(jobs, max_parallel_jobs=args.parallel_jobs, progress_interval=args.progress_interval, plan=plan)
+    if plan is not None:
+        # All the books' requests together, since they'd share the one rate limit (whatever jobs did plan, if some failed)
+        tts_utils.report_synthesis_plan(plan, args.books_dir)
+
+    if not ok:
+        failed = [job.name for job in jobs if job.status != "done"]
+        print(f"ERROR: {len(failed)}/{len(jobs)} jobs failed: {', '.join(failed)}.  Rerun to retry just what's missing.")
+        quit()
+
+    print("Finished.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""Times each text processing stage and end-to-end synthesis (against the offline FakeBackend) on a
+synthetic book, and saves the results as JSON so runs can be compared between commits.
+
+    python benchmark.py --preset novel --output bench_results.json
+    python benchmark.py --preset novel --compare bench_results.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# GLOBALS
+
+BENCHMARK_RESULTS_VERSION = 1
+
+# Corpus sizes in words, from a short story up to a big omnibus edition
+CORPUS_PRESETS = {
+    "short_story": 7_500,
+    "novella": 30_000,
+    "novel": 100_000,
+    "omnibus": 2_000_000,
+}
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Made-up words are built from syllables.  The English-ish ones all go in the benchmark's dictionary,
+# the foreign-ish ones never do, so find_non_dictionary_words() has a known number of hits.
+ENGLISH_SYLLABLES = ["an", "ber", "cal", "den", "er", "for", "gan", "hal", "in", "lo", "mer", "ness", "or",
+                     "pen", "ro", "ster", "ton", "un", "ver", "wick"]
+FOREIGN_SYLLABLES = ["ka", "shi", "mo", "tsu", "zu", "ya", "ki", "ryo", "hei", "nak"]
+
+
+def _make_words(rng, syllables, count, exclude=()):
+    words = set()
+    while len(words) < count:
+        word = "".join(rng.choice(syllables) for _ in range(rng.randint(1, 4)))
+        if word not in exclude:
+            words.add(word)
+    return sorted(words)
+
+
+def generate_corpus(book_dir, n_words, non_english_share=0.01, heteronym_share=0.02, line_words=(10, 120),
+                    vocabulary_size=20_000, seed=0, heteronyms_path=os.path.join(REPO_DIR, "heteronyms.txt")):
+    """Writes a synthetic input.txt of about n_words words into book_dir, plus the matching
+    words_english_dictionary.json (every word except the foreign ones).  Each line is one paragraph
+    of line_words (min, max) words.  Returns a dict describing the corpus."""
+
+    rng = random.Random(seed)
+
+    with open(heteronyms_path, "r", encoding="utf8") as fr:
+        heteronyms = [line.strip() for line in fr if line.strip() and not line.startswith("#")]
+
+    english = _make_words(rng, ENGLISH_SYLLABLES, vocabulary_size)
+    foreign = _make_words(rng, FOREIGN_SYLLABLES, max(10, vocabulary_size // 50), exclude=set(english))
+
+    os.makedirs(book_dir, exist_ok=True)
+    with open(os.path.join(book_dir, "words_english_dictionary.json"), "w", encoding="utf8") as fw:
+        json.dump({word: 1 for word in english + heteronyms}, fw)
+
+    written = 0
+    with open(os.path.join(book_dir, "input.txt"), "w", encoding="utf8") as fw:
+        while written < n_words:
+            paragraph_len = min(rng.randint(*line_words), n_words - written)
+            sentence = []
+            for i in range(paragraph_len):
+                roll = rng.random()
+                if roll < non_english_share:
+                    word = rng.choice(foreign).capitalize()    # Mostly names and places
+                elif roll < non_english_share + heteronym_share:
+                    word = rng.choice(heteronyms)
+                else:
+                    word = rng.choice(english)
+                sentence.append(word.capitalize() if not sentence else word)
+
+                # End sentences every 5-25 words, with the odd comma, quote or abbreviation thrown in
+                if len(sentence) >= rng.randint(5, 25) or i == paragraph_len - 1:
+                    text = " ".join(sentence)
+                    style = rng.random()
+                    if style < 0.1:
+                        text = f"“{text},” Mr. {rng.choice(foreign).capitalize()} said."
+                    elif style < 0.2:
+                        text += "?"
+                    else:
+                        text += "."
+                    fw.write(text + (" " if i < paragraph_len - 1 else "\n"))
+                    sentence = []
+                elif rng.random() < 0.05:
+                    sentence[-1] += ","
+            written += paragraph_len
+
+    return {"words": written, "non_english_share": non_english_share, "heteronym_share": heteronym_share,
+            "line_words": list(line_words), "vocabulary_size": vocabulary_size, "seed": seed,
+            "bytes": os.path.getsize(os.path.join(book_dir, "input.txt"))}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _timed(fn, repeat, setup=None):
+    """Runs fn() repeat times (calling setup() untimed before each) and returns (seconds of each run, last result).
+    Everything the stage prints is thrown away, it'd only drown out the results."""
+
+    runs = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            result = fn()
+            runs.append(time.perf_counter() - start)
+    return runs, result
+
+
+def run_benchmarks(book_dir, repeat=3, synthesis_chars=200_000, fake_latency=0.05, tps=None):
+    """Times every stage on the corpus in book_dir.  Must be run from book_dir, since the dictionary and
+    heteronym files are found relative to the working directory.  Returns a dict of stage -> result."""
+
+    import text_utils
+    import word_dictionary
+    import tts_utils
+    from tts_backends import FakeBackend
+
+    input_path = os.path.join(book_dir, "input.txt")
+    index_path = text_utils._book_index_path(input_path)
+    with open(input_path, "r", encoding="utf8") as fr:
+        text = fr.read()
+
+    stages = {}
+
+    def record(name, runs, **extra):
+        stages[name] = {"seconds": min(runs), "runs": runs, **extra}
+        print(f"  {name:<28} {min(runs):>9.3f}s  {json.dumps(extra) if extra else ''}")
+
+    def drop_index():
+        text_utils._book_indexes.clear()
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    def drop_dictionary():
+        word_dictionary._loaded_dictionaries.clear()
+        if os.path.exists(word_dictionary.ENGLISH_DICTIONARY_SORTED):
+            os.remove(word_dictionary.ENGLISH_DICTIONARY_SORTED)
+
+    runs, words = _timed(lambda: text_utils.get_unique_word_list(input_path), repeat, setup=drop_index)
+    record("index_cold", runs, unique_words=len(words))
+
+    runs, _ = _timed(lambda: text_utils.get_unique_word_list(input_path), repeat, setup=text_utils._book_indexes.clear)
+    record("index_load", runs)
+
+    runs, _ = _timed(word_dictionary.load_english_dictionary, repeat, setup=drop_dictionary)
+    record("dictionary_compile", runs)
+
+    runs, non_english = _timed(lambda: text_utils.find_non_dictionary_words(words), repeat)
+    record("find_non_dictionary_words", runs, found=len(non_english))
+
+    runs, heteronyms = _timed(lambda: text_utils.find_heteronyms(words), repeat)
+    record("find_heteronyms", runs, found=len(heteronyms))
+
+    def check_sentences(name, words, sentences, return_all_matches):
+        # The corpus always has tricky words in it, and there's no input_phonemes.json yet, so every occurrence
+        # should come back as a sentence.  A stage that quietly returns nothing would otherwise just look fast.
+        expected = sum(1 for _ in text_utils.find_tricky_contexts(input_path, words, return_all_matches))
+        if not expected or len(sentences) != expected:
+            print(f"ERROR: {name} returned {len(sentences)} sentences for {len(words)} words, expected {expected} (one per occurrence).")
+            quit()
+
+    runs, sentences = _timed(lambda: text_utils.get_tricky_sentences(book_dir, non_english, return_all_matches=False), repeat)
+    record("tricky_sentences_first", runs, sentences=len(sentences))
+    check_sentences("tricky_sentences_first", non_english, sentences, return_all_matches=False)
+
+    runs, sentences = _timed(lambda: text_utils.get_tricky_sentences(book_dir, heteronyms, return_all_matches=True), repeat)
+    record("tricky_sentences_all", runs, sentences=len(sentences))
+    check_sentences("tricky_sentences_all", heteronyms, sentences, return_all_matches=True)
+
+    # The scanner that get_word_occurrences() falls back on for words that aren't in the index
+    runs, _ = _timed(lambda: text_utils.find_word_occurrences(input_path, heteronyms), repeat)
+    record("find_word_occurrences", runs)
+
+    runs, chunks = _timed(lambda: text_utils.chunk_text_to_lists(char_limit=tts_utils.AWS_POLLY_BILLED_CHAR_LIMIT, text=text),
+                          repeat)
+    record("chunk_text_to_lists", runs, chars=len(text), chunks=len(chunks))
+
+    # End to end, but only on the start of the book: with the real rate limit the whole thing would just
+    # measure AWS_POLLY_MAX_TPS.  Pass tps to swap in a different limit.
+    if tps is not None:
+        tts_utils.POLLY_RATE_LIMITER = tts_utils.TokenBucket(rate=tps, capacity=tps)
+    sample = text[:synthesis_chars]
+    synthesis_dir = os.path.join(book_dir, "synthesis")
+    os.makedirs(synthesis_dir, exist_ok=True)
+    backend = FakeBackend(latency=fake_latency)
+
+    def synthesize():
+        tts_utils.save_polly_speech(basename="bench", text=sample, output_path=synthesis_dir, backend=backend,
+                                    use_cache=False, join_chunks=True)
+
+    def clean_synthesis():
+        shutil.rmtree(synthesis_dir)
+        os.makedirs(synthesis_dir)
+
+    requests_before = backend.requests
+    runs, _ = _timed(synthesize, repeat, setup=clean_synthesis)
+    n_chunks = (backend.requests - requests_before) // repeat
+    record("synthesis_end_to_end", runs, chars=len(sample), chunks=n_chunks, fake_latency=fake_latency,
+           chunks_per_second=round(n_chunks / min(runs), 2) if min(runs) else None)
+
+    return stages
+
+
+def compare_results(previous, current):
+    """Prints how each stage changed against an earlier results file."""
+
+    print(f"\nCompared with {previous.get('commit') or 'previous run'}:")
+    for name, stage in current["stages"].items():
+        before = previous.get("stages", {}).get(name)
+        if not before or not before["seconds"]:
+            print(f"  {name:<28} (new)")
+            continue
+        ratio = stage["seconds"] / before["seconds"]
+        print(f"  {name:<28} {before['seconds']:>9.3f}s -> {stage['seconds']:>9.3f}s  ({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=CORPUS_PRESETS, default="novel", help="corpus size")
+    parser.add_argument("--words", type=int, help="corpus size in words, overrides --preset")
+    parser.add_argument("--non-english-share", type=float, default=0.01, help="share of words not in the dictionary")
+    parser.add_argument("--heteronym-share", type=float, default=0.02, help="share of words that are heteronyms")
+    parser.add_argument("--line-words", type=int, nargs=2, default=(10, 120), metavar=("MIN", "MAX"),
+                        help="words per line (paragraph)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest is reported")
+    parser.add_argument("--synthesis-chars", type=int, default=200_000, help="characters of the book to synthesize")
+    parser.add_argument("--fake-latency", type=float, default=0.05, help="seconds per fake synthesis request")
+    parser.add_argument("--tps", type=float, help="override the synthesis rate limit (requests/second)")
+    parser.add_argument("--output", default="bench_results.json", help="where to save the results JSON")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the generated corpus directory")
+    args = parser.parse_args()
+
+    n_words = args.words or CORPUS_PRESETS[args.preset]
+    output_path = os.path.abspath(args.output)
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    # Stages read their dictionary/heteronyms/cache relative to the working directory, so run
+    # everything inside a scratch directory that's set up like the repo root
+    work_dir = tempfile.mkdtemp(prefix="tts_bench_")
+    shutil.copy(os.path.join(REPO_DIR, "heteronyms.txt"), work_dir)
+    sys.path.insert(0, REPO_DIR)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        print(f"Generating {n_words:,} word corpus in {work_dir}..")
+        corpus = generate_corpus(work_dir, n_words, non_english_share=args.non_english_share,
+                                 heteronym_share=args.heteronym_share, line_words=tuple(args.line_words), seed=args.seed)
+        print(f"Running benchmarks ({args.repeat} runs each, fastest shown)..")
+        stages = run_benchmarks(work_dir, repeat=args.repeat, synthesis_chars=args.synthesis_chars,
+                                fake_latency=args.fake_latency, tps=args.tps)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        "version": BENCHMARK_RESULTS_VERSION,
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": corpus,
+        "stages": stages,
+    }
+    with open(output_path, "w", encoding="utf8") as fw:
+        json.dump(results, fw, indent=2)
+    print(f"Saved {output_path}")
+
+    if compare_path:
+        with open(compare_path, "r", encoding="utf8") as fr:
+            compare_results(json.load(fr), results)
+
+
+if __name__ == "__main__":
+    main()
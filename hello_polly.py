@@ -10,8 +10,8 @@ from contextlib import closing
 import config # Loads secret environment variables as globals
 
 # Read secrets from environment variables
-polly = boto3.Session(  aws_access_key_id=AWS_ACCESS_KEY_ID,
-                        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+polly = boto3.Session(  aws_access_key_id=config.AWS_ACCESS_KEY_ID,
+                        aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
                         region_name='us-west-2').client('polly')
 
 # Generate two pairs of text to test.  
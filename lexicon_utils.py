@@ -0,0 +1,240 @@
+"""Applies the pronunciation lexicon (input_phonemes.json) to a whole book, either inline (rewriting the text
+to SSML with <phoneme> tags) or by uploading it to the TTS service as PLS lexicons."""
+
+import hashlib
+import json
+import os
+import re
+
+from metrics import timed_stage
+
+# GLOBALS
+
+PHONEME_LEXICON_FILE = "input_phonemes.json"
+PLS_LEXICON_STATE_FILE = "pls_lexicons.json"   # Next to the book: name -> hash of what was last uploaded under it
+
+# Service limits for uploaded (PLS) lexicons
+AWS_POLLY_LEXICON_MAX_CHARS = 4000          # Per lexicon document
+AWS_POLLY_MAX_LEXICONS_PER_REQUEST = 5      # LexiconNames on one synthesize_speech call
+AWS_POLLY_LEXICON_NAME_MAX_LEN = 20         # Names are [0-9A-Za-z]{1,20}, and shared by the whole account
+PLS_NAME_HASH_LEN = 8                       # Hex digits of the book's path hash in each name
+
+PLS_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<lexicon version="1.0" xmlns="http://www.w3.org/2005/01/pronunciation-lexicon" '
+              'alphabet={alphabet} xml:lang={lang}>\n')
+PLS_FOOTER = '</lexicon>\n'
+
+# Compiled lexicons, keyed on the sha256 of the lexicon file, so re-applying an unchanged lexicon
+# (every chapter of a book, or every rerun in one process) never rebuilds the matcher
+_compiled_lexicons = {}
+
+
+def xml_escape(text):
+    """Escapes &, < and > for XML text.  Same as xml.sax.saxutils.escape(), without importing urllib with it."""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def quoteattr(value):
+    """value escaped and quoted as an XML attribute value, same as xml.sax.saxutils.quoteattr()."""
+    value = xml_escape(value).replace("\n", "&#10;").replace("\r", "&#13;").replace("\t", "&#9;")
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return '"' + value.replace('"', "&quot;") + '"'
+
+
+def _trie_pattern(words):
+    """Regex alternation of words, shaped as a trie so shared prefixes are only matched once:
+    ['cat', 'car', 'dog'] -> '(?:ca(?:t|r)|dog)'.  At any position the regex engine then does work
+    proportional to the length of the word, not the number of words in the lexicon."""
+
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}   # end of a word
+
+    def build(node):
+        is_end = "" in node
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not is_end:
+            return branches[0]
+        # Greedy, so the longest word wins, but "?" still lets a shorter word match if the longer one doesn't fit
+        return "(?:" + "|".join(branches) + ")" + ("?" if is_end else "")
+
+    return build(trie)
+
+
+class PhonemeLexicon:
+    """Compiled lexicon: word -> <phoneme> tag, plus one regex that finds every lexicon word in a text.
+
+    Matching is case-insensitive (the lexicon words are lowercase) but the original text is kept inside
+    the tag.  A match can't start or end next to another letter or digit, so "pen" isn't found in "penny",
+    but "mizu" is still found in "“Mizu" or "Mizu’s"."""
+
+    def __init__(self, entries, lexicon_hash=None):
+        # Template entries that haven't been filled in yet are left for the TTS to pronounce on its own
+        self.entries = {word.lower(): entry for word, entry in entries.items() if entry.get("ph")}
+        self.words = {word.lower() for word in entries}     # Filled in or not
+        self.hash = lexicon_hash
+        self._open_tags = {word: f'<phoneme alphabet={quoteattr(entry.get("alphabet", "ipa"))} ph={quoteattr(entry["ph"])}>'
+                           for word, entry in self.entries.items()}
+
+        if self.entries:
+            self.pattern = re.compile(r"(?<![^\W_])(?:" + _trie_pattern(self.entries) + r")(?![^\W_])", re.IGNORECASE)
+        else:
+            self.pattern = None
+
+    def finditer(self, text):
+        """Yields (word, start, end) for every lexicon word in text, left to right, never overlapping."""
+        if self.pattern is None:
+            return
+        for m in self.pattern.finditer(text):
+            yield (m.group().lower(), m.start(), m.end())
+
+    def entry_hash(self, word):
+        """Short hash of a word's pronunciation, changes whenever its entry is edited."""
+        entry = self.entries[word]
+        return hashlib.sha256(f"{entry.get('alphabet', 'ipa')}\0{entry['ph']}".encode("utf8")).hexdigest()[:16]
+
+    def dependencies(self, text):
+        """Dict of word -> entry_hash() for every lexicon word in text.  A chunk's audio only depends on these
+        entries, so a lexicon edit only affects the chunks whose dependencies changed."""
+        return {word: self.entry_hash(word) for word in sorted({word for word, _, _ in self.finditer(text)})}
+
+    @timed_stage("apply_lexicon")
+    def to_ssml(self, text):
+        """Returns text as SSML body (no <speak> wrapper), every lexicon word wrapped in its <phoneme> tag
+        and everything else XML-escaped.  One pass over the text, built from slices so it stays linear."""
+
+        parts = []
+        last = 0
+        for word, start, end in self.finditer(text):
+            parts.append(xml_escape(text[last:start]))
+            parts.append(self._open_tags[word])
+            parts.append(xml_escape(text[start:end]))
+            parts.append("</phoneme>")
+            last = end
+        parts.append(xml_escape(text[last:]))
+        return "".join(parts)
+
+
+def load_phoneme_lexicon(filepath):
+    """Loads and compiles input_phonemes.json, or returns the already compiled copy if the file hasn't changed.
+    Returns None if there's no lexicon file."""
+
+    try:
+        with open(filepath, "rb") as fr:
+            data = fr.read()
+    except FileNotFoundError:
+        return None
+
+    lexicon_hash = hashlib.sha256(data).hexdigest()
+    if lexicon_hash not in _compiled_lexicons:
+        try:
+            entries = json.loads(data.decode("utf8"))
+        except json.JSONDecodeError as error:
+            print(f"ERROR: Could not parse lexicon file {filepath}.")
+            print(error)
+            quit()
+        _compiled_lexicons[lexicon_hash] = PhonemeLexicon(entries, lexicon_hash=lexicon_hash)
+
+    return _compiled_lexicons[lexicon_hash]
+
+
+def _pls_lexeme(word, ph):
+    # Polly matches graphemes case-sensitively, so list the casings a word shows up in
+    graphemes = "".join(f"<grapheme>{xml_escape(g)}</grapheme>" for g in dict.fromkeys([word, word.capitalize(), word.upper()]))
+    return f"<lexeme>{graphemes}<phoneme>{xml_escape(ph)}</phoneme></lexeme>\n"
+
+
+def build_pls_lexicons(lexicon, lang="en-US", max_chars=AWS_POLLY_LEXICON_MAX_CHARS):
+    """Turns a PhonemeLexicon into PLS documents to upload, each at most max_chars long.  A PLS document only
+    has one alphabet, so words are grouped by alphabet first and then split into as many documents as needed."""
+
+    by_alphabet = {}
+    for word, entry in sorted(lexicon.entries.items()):
+        by_alphabet.setdefault(entry.get("alphabet", "ipa"), []).append(_pls_lexeme(word, entry["ph"]))
+
+    documents = []
+    for alphabet, lexemes in sorted(by_alphabet.items()):
+        header = PLS_HEADER.format(alphabet=quoteattr(alphabet), lang=quoteattr(lang))
+        room = max_chars - len(header) - len(PLS_FOOTER)
+        current = []
+        current_len = 0
+        for lexeme in lexemes:
+            if len(lexeme) > room:
+                print(f"ERROR: Pronunciation is too long for a {max_chars} character lexicon: {lexeme}")
+                quit()
+            if current and current_len + len(lexeme) > room:
+                documents.append(header + "".join(current) + PLS_FOOTER)
+                current = []
+                current_len = 0
+            current.append(lexeme)
+            current_len += len(lexeme)
+        if current:
+            documents.append(header + "".join(current) + PLS_FOOTER)
+
+    return documents
+
+
+def pls_lexicon_names(book_dir, count):
+    """Service lexicon names for count documents of the book in book_dir.  Alphanumeric only, at most 20
+    characters.  Lexicons are account-wide, so the names are told apart by a hash of the book's full path;
+    the start of the folder name in front of it is only there to make them readable."""
+
+    book_dir = os.path.abspath(book_dir)
+    book_hash = hashlib.sha256(book_dir.encode("utf8")).hexdigest()[:PLS_NAME_HASH_LEN]
+    prefix = re.sub(r"[^A-Za-z]", "", os.path.basename(book_dir))
+    prefix = prefix[:AWS_POLLY_LEXICON_NAME_MAX_LEN - PLS_NAME_HASH_LEN - len(str(count - 1))]
+    return [f"{prefix}{book_hash}{idx}" for idx in range(count)]
+
+
+def _load_pls_state(state_path):
+    try:
+        with open(state_path, "r", encoding="utf8") as fr:
+            return json.load(fr)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+@timed_stage("sync_pls_lexicons")
+def sync_pls_lexicons(backend, lexicon, book_dir, lang="en-US"):
+    """Uploads the lexicon to the TTS service as PLS documents, for use with LexiconNames instead of
+    inline <phoneme> tags (which eat into each request's 6000 character total).  What was uploaded is
+    recorded in {book_dir}/pls_lexicons.json, so a document that hasn't changed costs no calls at all.
+    One that has is only uploaded (PutLexicon) if the service doesn't already have that exact content.
+    Delete pls_lexicons.json to check every document with the service again.
+
+    Returns the lexicon names to pass on every request.  (Chunks are keyed on the lexicon entries they use,
+    see PhonemeLexicon.dependencies(), so there's no version of the documents to add to the cache key.)"""
+
+    documents = build_pls_lexicons(lexicon, lang=lang)
+    if len(documents) > AWS_POLLY_MAX_LEXICONS_PER_REQUEST:
+        print(f"ERROR: The lexicon needs {len(documents)} uploaded lexicons, but only {AWS_POLLY_MAX_LEXICONS_PER_REQUEST} "
+              f"can be used per request.  Use inline <phoneme> tags for this book instead.")
+        quit()
+
+    names = pls_lexicon_names(book_dir, len(documents))
+    state_path = os.path.join(book_dir, PLS_LEXICON_STATE_FILE)
+    uploaded = _load_pls_state(state_path)
+    for name, content in zip(names, documents):
+        content_hash = hashlib.sha256(content.encode("utf8")).hexdigest()
+        if uploaded.get(name) == content_hash:
+            print(f"Lexicon {name} is up to date.")
+            continue
+        if backend.get_lexicon(name) == content:
+            print(f"Lexicon {name} is already uploaded.")
+        else:
+            print(f"Uploading lexicon {name} ({len(content)} chars)..")
+            backend.put_lexicon(name, content)
+        # Saved after every upload, so a failure partway through doesn't lose the ones that went up
+        uploaded[name] = content_hash
+        with open(state_path, "w", encoding="utf8") as fw:
+            json.dump(uploaded, fw, indent=2)
+
+    return names
@@ -0,0 +1,184 @@
+"""Run instrumentation: stage timings, synthesis request latencies, retries, billed characters, bytes
+written and peak memory.  Everything is aggregated in memory for the end-of-run summary, and, once
+configure() has been given a path, also appended one event per line to a JSONL file."""
+
+import bisect
+import functools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource     # Unix only
+except ImportError:
+    resource = None
+
+# GLOBALS
+
+# Upper bounds (seconds) of the request latency histogram buckets, the last one catches everything else
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10, 30]
+
+
+class MetricsRecorder:
+    """Thread-safe collector of run metrics.  Use the module-level METRICS rather than making your own."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}            # name -> [calls, total seconds]
+            self.latencies = []         # Seconds until each successful request's response came back
+            self.requests = 0
+            self.failed_requests = 0
+            self.retries = 0
+            self.cache_hits = 0
+            self.billed_chars = 0
+            self.bytes_written = 0
+            self.rate_limit_wait = 0.0  # Seconds spent waiting on the rate limiter..
+            self.backoff_wait = 0.0     # ..and backing off after transient errors
+            self.started = time.perf_counter()
+
+    def configure(self, path):
+        """Starts appending events to the JSONL file at path (None to stop)."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(path, "a", encoding="utf8") if path else None
+
+    def _write(self, event, fields):
+        # Called with the lock held
+        if self._file is not None:
+            self._file.write(json.dumps({"time": round(time.time(), 3), "event": event, **fields}) + "\n")
+            self._file.flush()
+
+    def event(self, event, **fields):
+        """Logs an event to the JSONL file without aggregating it."""
+        with self._lock:
+            self._write(event, fields)
+
+    def record_stage(self, name, seconds, **fields):
+        with self._lock:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += 1
+            stage[1] += seconds
+            self._write("stage", {"name": name, "seconds": round(seconds, 6), **fields})
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Times the body of a with block as one call of stage `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start, **fields)
+
+    def record_request(self, basename, chunk, attempt, latency, seconds=None, billed_chars=None, audio_bytes=None,
+                       rate_limit_wait=0.0, error=None):
+        """One synthesis request.  latency is the time until the response came back, seconds also
+        includes streaming the audio.  error is the error code if it failed."""
+        with self._lock:
+            self.requests += 1
+            self.rate_limit_wait += rate_limit_wait
+            if error is None:
+                self.latencies.append(latency)
+                self.billed_chars += billed_chars or 0
+            else:
+                self.failed_requests += 1
+            self._write("request", {"basename": basename, "chunk": chunk, "attempt": attempt,
+                                    "latency": round(latency, 6), "seconds": round(seconds, 6) if seconds is not None else None,
+                                    "billed_chars": billed_chars, "bytes": audio_bytes,
+                                    "rate_limit_wait": round(rate_limit_wait, 6), "error": error})
+
+    def record_retry(self, basename, chunk, attempt, delay, error):
+        with self._lock:
+            self.retries += 1
+            self.backoff_wait += delay
+            self._write("retry", {"basename": basename, "chunk": chunk, "attempt": attempt,
+                                  "delay": round(delay, 6), "error": error})
+
+    def record_cache_hit(self, basename, chunk):
+        with self._lock:
+            self.cache_hits += 1
+            self._write("cache_hit", {"basename": basename, "chunk": chunk})
+
+    def record_bytes_written(self, path, n_bytes):
+        with self._lock:
+            self.bytes_written += n_bytes
+            self._write("write", {"path": path, "bytes": n_bytes})
+
+    def latency_histogram(self):
+        """[(bucket upper bound or None for the overflow bucket, count)]"""
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        for latency in self.latencies:
+            counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        return list(zip(LATENCY_BUCKETS + [None], counts))
+
+    def summary(self):
+        """End-of-run summary table, as a string.  Also logged to the JSONL file."""
+
+        with self._lock:
+            wall = time.perf_counter() - self.started
+            peak = peak_memory_bytes()
+            latencies = sorted(self.latencies)
+
+            lines = [f"{'Stage':<40}{'calls':>8}{'seconds':>12}"]
+            for name, (calls, seconds) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+                lines.append(f"{name:<40}{calls:>8}{seconds:>12.3f}")
+            lines.append(f"{'(total wall time)':<40}{'':>8}{wall:>12.3f}")
+            lines.append("")
+            lines.append(f"Synthesis requests: {self.requests} ({self.retries} retries, {self.failed_requests} failed), "
+                         f"{self.cache_hits} chunks from cache")
+            lines.append(f"Billed characters: {self.billed_chars:,}")
+            lines.append(f"Waiting: {self.rate_limit_wait:.1f}s on the rate limit, {self.backoff_wait:.1f}s backing off")
+            if latencies:
+                p50 = latencies[len(latencies) // 2]
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                lines.append(f"Request latency: p50 {p50:.3f}s, p95 {p95:.3f}s, max {latencies[-1]:.3f}s")
+                most = max(count for _, count in self.latency_histogram())
+                for bound, count in self.latency_histogram():
+                    label = f"<= {bound}s" if bound is not None else f"> {LATENCY_BUCKETS[-1]}s"
+                    lines.append(f"  {label:>9} {'#' * round(40 * count / most):<40} {count}")
+            lines.append(f"Audio written: {self.bytes_written / 1024**2:,.1f} MB")
+            if peak is not None:
+                lines.append(f"Peak memory: {peak / 1024**2:,.1f} MB")
+
+            self._write("summary", {"wall_seconds": round(wall, 3),
+                                    "stages": {name: {"calls": calls, "seconds": round(seconds, 6)}
+                                               for name, (calls, seconds) in self.stages.items()},
+                                    "requests": self.requests, "retries": self.retries,
+                                    "failed_requests": self.failed_requests, "cache_hits": self.cache_hits,
+                                    "billed_chars": self.billed_chars, "bytes_written": self.bytes_written,
+                                    "rate_limit_wait": round(self.rate_limit_wait, 3),
+                                    "backoff_wait": round(self.backoff_wait, 3),
+                                    "latency_histogram": [[bound, count] for bound, count in self.latency_histogram()],
+                                    "peak_memory_bytes": peak})
+        return "\n".join(lines)
+
+
+def peak_memory_bytes():
+    """Peak resident memory of this process so far, or None where we can't tell (Windows)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def timed_stage(name):
+    """Decorator that records every call of the function as stage `name`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with METRICS.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Shared by everything in this process
+METRICS = MetricsRecorder()
@@ -0,0 +1,245 @@
+"""Packages a rendered book into one audiobook file, with a chapter marker and title for every chapter, so there's
+a single thing to ship instead of a folder of chapter files.  Nothing is decoded or re-encoded where it can be
+helped, so even a 10 hour book only takes as long as copying the files:
+
+  - mp3 (default): every chapter's MPEG frames are copied end to end, as-is, behind an ID3v2 tag with a CHAP
+    frame per chapter (and a CTOC table of contents).  No extra dependencies.
+  - m4b: muxed into an MP4 container with chapters by ffmpeg, which has to be installed.  mp3 chapters are
+    stream copied; .wav ones (POSTPROCESS=1 without ffmpeg's mp3 encode) have to be encoded to AAC.  Some
+    players (Apple Books..) only play AAC in an .m4b, pass --aac to encode mp3 chapters for those too.
+
+The mastered chapter files (see audio_postprocess.py) are used if there are any, the plain ones otherwise.
+
+    python package_audiobook.py books/hiroshima/ --title "Hiroshima" --author "John Hersey"
+"""
+
+import argparse
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import wave
+
+from audio_utils import mp3_audio_range, iter_mp3_frames, AUDIO_COPY_BLOCK_SIZE
+from audio_postprocess import MASTERED_SUFFIX
+from text_utils import stream_book_chapters
+from metrics import timed_stage
+
+# GLOBALS
+
+PACKAGE_FORMATS = ("mp3", "m4b")
+PACKAGE_SUFFIX = "_audiobook"           # books/hiroshima/ -> books/hiroshima/hiroshima_audiobook.mp3
+M4B_AAC_ARGS = ["-c:a", "aac", "-b:a", "64k"]   # Only when the chapters can't be stream copied
+ID3_MAX_TOC_ENTRIES = 255               # CTOC counts its entries in one byte
+ID3_NO_OFFSET = 0xFFFFFFFF              # CHAP byte offsets past 4 GB can't be written, players go by time instead
+
+
+class ChapterAudio:
+    """One chapter's finished audio file, and where its audio is in it."""
+
+    def __init__(self, title, path):
+        self.title = title
+        self.path = path
+        self.extension = os.path.splitext(path)[1][1:]
+        if self.extension == "mp3":
+            self.start, self.end = mp3_audio_range(path)
+            for _, seconds in iter_mp3_frames(path, self.start, self.end):
+                pass    # Only the total at the end matters
+            self.seconds = seconds
+        else:
+            with wave.open(path, "rb") as wav:
+                self.seconds = wav.getnframes() / wav.getframerate()
+            self.start, self.end = 0, os.path.getsize(path)
+
+    def mp3_format(self):
+        # MPEG version, sample rate and channel mode: chapters can only be joined as-is if they all match
+        with open(self.path, "rb") as fr:
+            fr.seek(self.start)
+            header = fr.read(4)
+        return (header[1] & 0x18, header[2] & 0x0C, header[3] & 0xC0) if len(header) == 4 else None
+
+
+def find_chapter_audio(input_dir, extensions=("mp3", "wav")):
+    """(title, path) of every chapter's audio, the same chapters read_entire_book.py renders, in order.  All of
+    them come from the same kind of file (mastered mp3, then mp3, then mastered wav, then wav), since they have
+    to be joined as one stream.  Returns None if some chapter doesn't have one of extensions."""
+
+    chapters = stream_book_chapters(input_dir)
+    if len(chapters) > 1:
+        names = [(name, title) for name, title, _ in chapters]
+    else:
+        names = [("full_text", _book_name(input_dir).replace("_", " ").title())]
+
+    for extension in extensions:
+        for suffix in (MASTERED_SUFFIX, ""):
+            paths = [os.path.join(input_dir, f"{name}{suffix}.{extension}") for name, _ in names]
+            if all(os.path.exists(path) for path in paths):
+                return [(title, path) for (_, title), path in zip(names, paths)]
+    return None
+
+
+def _book_name(input_dir):
+    return os.path.basename(os.path.normpath(input_dir))
+
+
+def _id3_frame(frame_id, data):
+    # ID3v2.3: plain 4 byte big-endian size, no flags
+    return frame_id.encode("latin1") + struct.pack(">I", len(data)) + b"\x00\x00" + data
+
+
+def _id3_text_frame(frame_id, text):
+    # Encoding 1 is UTF-16 with a BOM, which every ID3v2.3 reader understands (UTF-8 is v2.4 only)
+    return _id3_frame(frame_id, b"\x01" + text.encode("utf-16"))
+
+
+def _id3_chapter_tag(chapters, title, author, audio_offset):
+    """ID3v2.3 tag with book title/author and a CHAP frame per chapter (ID3v2 Chapter Frame Addendum), times in ms
+    and byte offsets from the start of the file, where audio_offset is the size of the tag itself."""
+
+    frames = [_id3_text_frame("TIT2", title), _id3_text_frame("TALB", title)]
+    if author:
+        frames.append(_id3_text_frame("TPE1", author))
+
+    element_ids = [f"chp{i}".encode("latin1") for i in range(len(chapters))]
+    if len(chapters) <= ID3_MAX_TOC_ENTRIES:
+        # Top level (0x02), ordered (0x01)
+        frames.append(_id3_frame("CTOC", b"toc\x00" + bytes([0x03, len(chapters)])
+                                 + b"".join(element_id + b"\x00" for element_id in element_ids)))
+
+    ms, offset = 0, audio_offset
+    for element_id, chapter in zip(element_ids, chapters):
+        length = chapter.end - chapter.start
+        end_ms = ms + round(chapter.seconds * 1000)
+        offsets = (offset, offset + length) if offset + length < ID3_NO_OFFSET else (ID3_NO_OFFSET, ID3_NO_OFFSET)
+        frames.append(_id3_frame("CHAP", element_id + b"\x00" + struct.pack(">IIII", ms, end_ms, *offsets)
+                                 + _id3_text_frame("TIT2", chapter.title)))
+        ms, offset = end_ms, offset + length
+
+    body = b"".join(frames)
+    size = len(body)
+    syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return b"ID3\x03\x00\x00" + syncsafe + body
+
+
+def write_chaptered_mp3(chapters, output_path, title, author=None):
+    """Joins the chapters' MPEG frames into output_path, byte for byte, behind an ID3 chapter tag."""
+
+    if len({chapter.mp3_format() for chapter in chapters}) > 1:
+        print("ERROR: The chapters aren't all the same kind of mp3 (sample rate, etc.), so they can't be joined as-is.")
+        print("Master them all again (see audio_postprocess.py) or package them as --format m4b --aac.")
+        quit()
+    if len(chapters) > ID3_MAX_TOC_ENTRIES:
+        print(f"WARNING: More than {ID3_MAX_TOC_ENTRIES} chapters, too many for a table of contents.  Only the chapter markers are saved.")
+
+    # The tag's size doesn't depend on the offsets in it, so one pass finds it and the next fills them in
+    tag = _id3_chapter_tag(chapters, title, author, 0)
+    tag = _id3_chapter_tag(chapters, title, author, len(tag))
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as fw:
+        fw.write(tag)
+        for chapter in chapters:
+            with open(chapter.path, "rb") as fr:
+                fr.seek(chapter.start)
+                remaining = chapter.end - chapter.start
+                while remaining > 0:
+                    block = fr.read(min(remaining, AUDIO_COPY_BLOCK_SIZE))
+                    if not block:
+                        break
+                    fw.write(block)
+                    remaining -= len(block)
+    os.replace(tmp_path, output_path)
+
+
+def _ffmetadata_escape(value):
+    return re.sub(r"([=;#\\\n])", r"\\\1", value)
+
+
+def write_m4b(chapters, output_path, title, author=None, aac=False):
+    """Muxes the chapters into an .m4b with ffmpeg, stream copying mp3 audio unless aac is set."""
+
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        print("ERROR: Packaging as m4b needs ffmpeg, which isn't installed.  Package as mp3 instead, it needs nothing.")
+        quit()
+
+    codec_args = ["-c", "copy"] if chapters[0].extension == "mp3" and not aac else M4B_AAC_ARGS
+    tmp_path = output_path + ".tmp"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The concat demuxer joins the files as one input, the ffmetadata file says where each chapter starts
+        list_path = os.path.join(tmp_dir, "chapters.txt")
+        with open(list_path, "w", encoding="utf8") as fw:
+            for chapter in chapters:
+                fw.write("file '" + os.path.abspath(chapter.path).replace("'", "'\\''") + "'\n")
+
+        metadata_path = os.path.join(tmp_dir, "metadata.txt")
+        with open(metadata_path, "w", encoding="utf8") as fw:
+            fw.write(";FFMETADATA1\n")
+            fw.write(f"title={_ffmetadata_escape(title)}\nalbum={_ffmetadata_escape(title)}\ngenre=Audiobook\n")
+            if author:
+                fw.write(f"artist={_ffmetadata_escape(author)}\n")
+            ms = 0
+            for chapter in chapters:
+                end_ms = ms + round(chapter.seconds * 1000)
+                fw.write(f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={ms}\nEND={end_ms}\ntitle={_ffmetadata_escape(chapter.title)}\n")
+                ms = end_ms
+
+        try:
+            subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+                            "-i", metadata_path, "-map", "0:a", "-map_metadata", "1", "-map_chapters", "1"]
+                           + codec_args + ["-f", "mp4", tmp_path], check=True)
+        except subprocess.CalledProcessError as error:
+            print(f"ERROR: ffmpeg could not package {output_path}.")
+            print(error)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            quit()
+    os.replace(tmp_path, output_path)
+
+
+@timed_stage("package_audiobook")
+def package_audiobook(input_dir, package_format="mp3", title=None, author=None, aac=False):
+    """Packages the rendered book in input_dir as {book}_audiobook.mp3 or .m4b, see the top of this file.
+    Returns the path it was saved to."""
+
+    if package_format not in PACKAGE_FORMATS:
+        print(f"ERROR: Unknown package format: {package_format}.  Choose from: {', '.join(PACKAGE_FORMATS)}")
+        quit()
+
+    found = find_chapter_audio(input_dir, extensions=("mp3",) if package_format == "mp3" else ("mp3", "wav"))
+    if found is None:
+        kind = "an .mp3" if package_format == "mp3" else "an .mp3 or .wav"
+        print(f"ERROR: Not every chapter in {input_dir} has {kind} yet.  Run read_entire_book.py first.")
+        quit()
+
+    chapters = [ChapterAudio(chapter_title, path) for chapter_title, path in found]
+    title = title or _book_name(input_dir).replace("_", " ").title()
+    output_path = os.path.join(input_dir, _book_name(input_dir) + PACKAGE_SUFFIX + "." + package_format)
+
+    print(f"Packaging {len(chapters)} chapters into {output_path}..")
+    if package_format == "mp3":
+        write_chaptered_mp3(chapters, output_path, title, author)
+    else:
+        write_m4b(chapters, output_path, title, author, aac=aac)
+
+    hours, seconds = divmod(round(sum(chapter.seconds for chapter in chapters)), 3600)
+    print(f"Saved {output_path} ({hours}h{seconds // 60:02d}m, {os.path.getsize(output_path) / 1e6:.1f} MB)")
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("book_dir", help="rendered book folder, e.g. books/hiroshima/")
+    parser.add_argument("--format", choices=PACKAGE_FORMATS, default="mp3", help="container to package into")
+    parser.add_argument("--title", help="book title (default: from the folder name)")
+    parser.add_argument("--author")
+    parser.add_argument("--aac", action="store_true", help="m4b only: encode to AAC even if the chapters are mp3")
+    args = parser.parse_args()
+
+    package_audiobook(args.book_dir, package_format=args.format, title=args.title, author=args.author, aac=args.aac)
+
+
+if __name__ == "__main__":
+    main()
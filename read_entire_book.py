@@ -1,19 +1,123 @@
 """Read out the entire book once the lexicon has been refined."""
 
-from tts_utils import save_polly_speech
+from text_utils import stream_book_chapters
+from tts_utils import save_polly_speech, save_chapters_polly_speech, get_default_backend, report_synthesis_plan
+from tts_backends import SynthesisError
+from lexicon_utils import load_phoneme_lexicon, sync_pls_lexicons, PHONEME_LEXICON_FILE
+from audio_postprocess import master_joined_file
+from package_audiobook import package_audiobook
+from synthesis_plan import SynthesisPlan
+from metrics import METRICS
+import atexit
 import os
 
-input_dir = input('Enter relative path to book folder containing input.txt file [e.g. books/hiroshima/]: ')   # e.g. books/hiroshima/
-input_path = os.path.join(input_dir, "input.txt")
 
-# Read in the entire book's text file
-with open(input_path, 'r') as fr:
-    entire_text = fr.read()   
+def read_entire_book(input_dir, **synthesis_args):
+    """Synthesizes the whole book in input_dir, one file per chapter (or one full_text.mp3 if there's only one).
+    synthesis_args go to save_polly_speech(), e.g. priority and progress when run from batch.py."""
 
-# Synthesize the book with AWS Polly
-print("Synthesizing entire book with AWS Polly, please wait..")
+    # DRY_RUN=1: work out every request the render would make, what it would cost and how long it would take,
+    # without sending any of them, see synthesis_plan.py.  (batch.py --dry-run passes in one plan for every book.)
+    own_plan = "plan" not in synthesis_args and os.environ.get("DRY_RUN", "0") == "1"
+    if own_plan:
+        synthesis_args["plan"] = SynthesisPlan()
+    dry_run = synthesis_args.get("plan") is not None
 
-# NOTE: save_polly_speech() will automatically chunk the text to reasonable sizes for synthesis passes
-save_polly_speech(basename="full_text", text=entire_text, output_path=input_dir)
+    # Use chapter_N.txt files if there are any, otherwise look for chapter headings inside input.txt.  Each
+    # chapter's text is streamed off disk as it's synthesized, so even a huge book is never read into memory.
+    chapters = stream_book_chapters(input_dir)
 
-print("Finished.")
\ No newline at end of file
+    # If there's a lexicon (see read_tricky_sentences.py), apply it one of two ways:
+    #   LEXICON_MODE=inline (default): every occurrence of every word in it gets its <phoneme> tag, in one pass
+    #                                  over each chapter, and the text is sent as SSML
+    #   LEXICON_MODE=pls: it's uploaded to Polly as pronunciation lexicons and applied by the service, so the
+    #                     tags don't take up room in every request
+    lexicon = load_phoneme_lexicon(os.path.join(input_dir, PHONEME_LEXICON_FILE))
+    lexicon_mode = os.environ.get("LEXICON_MODE", "inline")
+    if lexicon is not None and lexicon_mode == "pls" and dry_run:
+        # Nothing's uploaded either.  Chunks are keyed on the lexicon entries, not the uploaded names, so the plan's the same.
+        print(f"Dry run, not uploading {len(lexicon.entries)} pronunciations from {PHONEME_LEXICON_FILE}.")
+    elif lexicon is not None and lexicon_mode == "pls":
+        print(f"Uploading {len(lexicon.entries)} pronunciations from {PHONEME_LEXICON_FILE}..")
+        try:
+            lexicon_names = sync_pls_lexicons(get_default_backend(), lexicon, input_dir)
+        except SynthesisError as error:
+            print("ERROR: Could not upload lexicons.")
+            print(error)
+            quit()
+        synthesis_args["lexicon_names"] = lexicon_names
+    elif lexicon is not None:
+        print(f"Applying {len(lexicon.entries)} pronunciations from {PHONEME_LEXICON_FILE}..")
+        chapters = [(name, title, map(lexicon.to_ssml, blocks)) for name, title, blocks in chapters]
+        synthesis_args["text_type"] = "ssml"
+
+    # Either way, each chunk is keyed on the lexicon entries it actually uses, so after fixing a pronunciation
+    # only the chunks with that word in them are synthesized again and spliced into the existing chapter files
+    if lexicon is not None:
+        synthesis_args["lexicon"] = lexicon
+
+    # SPEECH_MARKS=1: also request each chunk's sentence/word speech marks and build a {chapter}_marks.idx seek
+    # index next to each file, for speech_marks.py and audio_server.py's /find page.  Billed as extra requests.
+    if os.environ.get("SPEECH_MARKS", "0") == "1":
+        synthesis_args.setdefault("speech_marks", True)
+
+    # POSTPROCESS=1: render pcm and master each file afterwards (trimmed, even gaps, normalized loudness) into
+    # {chapter}_mastered.wav/.mp3, see audio_postprocess.py.  The unmastered .wav is kept, later runs splice into it.
+    # Needs NumPy (see requirements.txt).
+    postprocess = os.environ.get("POSTPROCESS", "0") == "1"
+    if postprocess:
+        synthesis_args["output_format"] = "pcm"
+
+    # Synthesize the book with AWS Polly
+    print("Planning entire book, nothing will be sent to AWS Polly.." if dry_run else "Synthesizing entire book with AWS Polly, please wait..")
+
+    if len(chapters) > 1:
+        print(f"Found {len(chapters)} chapters:")
+        for name, title, _ in chapters:
+            print(f"  {name}: {title}")
+
+        # Each chapter is its own job (chapter_N.mp3), run several at a time under one shared rate limit
+        results = save_chapters_polly_speech(chapters=chapters, output_path=input_dir, **synthesis_args)
+
+        failed = [name for name, ok in results.items() if not ok]
+        if failed:
+            print(f"ERROR: {len(failed)}/{len(chapters)} chapters failed: {', '.join(failed)}.  Rerun to retry just those chunks.")
+            quit()
+    else:
+        # No chapters, read it all as one
+        entire_text = chapters[0][2] if chapters else ""   # Text blocks, read as they're needed
+
+        # NOTE: save_polly_speech() will automatically chunk the text to reasonable sizes for synthesis passes,
+        # and join them back together into a single full_text.mp3
+        save_polly_speech(basename="full_text", text=entire_text, output_path=input_dir, join_chunks=True,
+                          **synthesis_args)
+
+    if dry_run:
+        # No audio to master or package
+        if own_plan:
+            report_synthesis_plan(synthesis_args["plan"], input_dir)
+        return
+
+    if postprocess:
+        print("Mastering..")
+        for name in ([name for name, _, _ in chapters] if len(chapters) > 1 else ["full_text"]):
+            master_joined_file(input_dir, name)
+
+    # PACKAGE=mp3 (or m4b): join the finished chapters into one {book}_audiobook.mp3 with chapter markers,
+    # copying the audio as-is rather than encoding it again, see package_audiobook.py
+    package_format = os.environ.get("PACKAGE")
+    if package_format:
+        package_audiobook(input_dir, package_format=package_format)
+
+
+if __name__ == "__main__":
+    input_dir = input('Enter relative path to book folder containing input.txt file [e.g. books/hiroshima/]: ')   # e.g. books/hiroshima/
+
+    # Timings, request latencies and billed characters go to metrics.jsonl, with a summary printed at the end
+    # (even if something fails partway through)
+    METRICS.configure(os.path.join(input_dir, "metrics.jsonl"))
+    atexit.register(lambda: print("\n" + METRICS.summary()))
+
+    read_entire_book(input_dir)
+
+    print("Finished.")
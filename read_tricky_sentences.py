@@ -1,56 +1,91 @@
 """Read out the tricky sentences and refine lexicon until it sounds correct."""
 
-from text_utils import find_non_dictionary_words, get_unique_word_list, find_heteronyms, get_tricky_sentences, save_out_phoneme_dictionary
-from tts_utils import save_polly_speech
+from text_utils import find_non_dictionary_words, get_unique_word_list, find_heteronyms, get_tricky_sentences, save_out_phoneme_dictionary, \
+    count_word_occurrences, get_tricky_clips
+from tts_utils import save_polly_clips, report_synthesis_plan
+from synthesis_plan import SynthesisPlan
+from metrics import METRICS
+import atexit
 import os
 
-input_dir = input('Enter relative path to book folder containing input.txt file [e.g. books/hiroshima/]: ')   # e.g. books/hiroshima/
-input_path = os.path.join(input_dir, "input.txt")
 
-# get a unique list of words in the text
-all_words_list = get_unique_word_list(input_path)
+def read_tricky_sentences(input_dir, **synthesis_args):
+    """Finds the tricky words in the book in input_dir, saves the phoneme template for them and synthesizes a
+    clip of each one in context.  synthesis_args go to save_polly_clips(), e.g. priority and progress when run
+    from batch.py."""
 
-# get all non-English (tricky) words
-all_non_english_words = find_non_dictionary_words(all_words_list)
+    # DRY_RUN=1: plan the clips' requests without sending any, see synthesis_plan.py (batch.py --dry-run passes its own plan)
+    own_plan = "plan" not in synthesis_args and os.environ.get("DRY_RUN", "0") == "1"
+    if own_plan:
+        synthesis_args["plan"] = SynthesisPlan()
 
-# also get all heteronyms (words spelled the same that sound different) in the text
-# homophone - new vs. knew
-# homonym - pen (holding place for animals vs. writing instrument)
-# heteronym / homograph - bass vs. bass (more specifically, don't have to pronounce differently, also could be called heteronyms)
-# https://en.wiktionary.org/wiki/Category:English_heteronyms
-all_heteronyms = find_heteronyms(all_words_list)
+    input_path = os.path.join(input_dir, "input.txt")
 
-print(f"All tricky words in {input_path}:")
-print(all_non_english_words)
-print("")
-print(f"All heteronyms in {input_path}:")
-print(all_heteronyms)
-print("")
+    # get a unique list of words in the text
+    all_words_list = get_unique_word_list(input_path)
 
-# Saves output phoneme template file
-save_out_phoneme_dictionary(input_dir=input_dir, input_word_list=all_non_english_words + all_heteronyms)  # append the lists together
+    # get all non-English (tricky) words
+    all_non_english_words = find_non_dictionary_words(all_words_list)
 
-# debug
-# print(all_words_list)
+    # also get all heteronyms (words spelled the same that sound different) in the text
+    # homophone - new vs. knew
+    # homonym - pen (holding place for animals vs. writing instrument)
+    # heteronym / homograph - bass vs. bass (more specifically, don't have to pronounce differently, also could be called heteronyms)
+    # https://en.wiktionary.org/wiki/Category:English_heteronyms
+    all_heteronyms = find_heteronyms(all_words_list)
 
-tricky_sentences_list = get_tricky_sentences(file_dir=input_dir, words_to_check=all_non_english_words, return_all_matches=False)
-heteronym_sentences_list = get_tricky_sentences(file_dir=input_dir, words_to_check=all_heteronyms, return_all_matches=True)
+    print(f"All tricky words in {input_path}:")
+    print(all_non_english_words)
+    print("")
+    print(f"All heteronyms in {input_path}:")
+    print(all_heteronyms)
+    print("")
+    # Most common first, these are the ones that will make up most of the heteronym clips
+    print(f"Heteronym occurrence counts in {input_path}:")
+    for word, count in count_word_occurrences(input_path, all_heteronyms).items():
+        print(f"  {word}: {count}")
+    print("")
 
-# Synthesize hard sentences with AWS Polly
+    # Saves output phoneme template file
+    save_out_phoneme_dictionary(input_dir=input_dir, input_word_list=all_non_english_words + all_heteronyms)  # append the lists together
 
-# Build the text strings
-text = ""
-for line in tricky_sentences_list:
-    text += line
-print("Requesting and saving Non-English AWS Polly speech response..")
-save_polly_speech(basename="non_english", text=text, voice_id="Matthew", output_path=input_dir)
+    # debug
+    # print(all_words_list)
 
-print("")
+    # Also saved as non_english_text.txt and heteronyms_text.txt, to read along with
+    get_tricky_sentences(file_dir=input_dir, words_to_check=all_non_english_words, return_all_matches=False)
+    get_tricky_sentences(file_dir=input_dir, words_to_check=all_heteronyms, return_all_matches=True)
 
-text = ""
-for line in heteronym_sentences_list:
-    text += line
-print("Requesting and saving Heteronyms AWS Polly speech response..")
-save_polly_speech(basename="heteronyms", text=text, voice_id="Matthew", output_path=input_dir)
+    # Synthesize hard sentences with AWS Polly, one clip per word occurrence so each one can be found and
+    # listened to on its own.  clips/non_english_index.csv (and heteronyms_index.csv) say which clip is which.
+    clips_dir = os.path.join(input_dir, "clips")
 
-print("Finished.")
\ No newline at end of file
+    print("Requesting and saving Non-English AWS Polly speech clips..")
+    non_english_clips = get_tricky_clips(file_dir=input_dir, words_to_check=all_non_english_words, return_all_matches=False,
+                                         kind="non_english")
+    save_polly_clips(non_english_clips, output_path=clips_dir, index_basename="non_english", voice_id="Matthew",
+                     **synthesis_args)
+
+    print("")
+
+    print("Requesting and saving Heteronyms AWS Polly speech clips..")
+    heteronym_clips = get_tricky_clips(file_dir=input_dir, words_to_check=all_heteronyms, return_all_matches=True,
+                                       kind="heteronyms")
+    save_polly_clips(heteronym_clips, output_path=clips_dir, index_basename="heteronyms", voice_id="Matthew",
+                     **synthesis_args)
+
+    if own_plan:
+        report_synthesis_plan(synthesis_args["plan"], input_dir)
+
+
+if __name__ == "__main__":
+    input_dir = input('Enter relative path to book folder containing input.txt file [e.g. books/hiroshima/]: ')   # e.g. books/hiroshima/
+
+    # Timings, request latencies and billed characters go to metrics.jsonl, with a summary printed at the end
+    # (even if something fails partway through)
+    METRICS.configure(os.path.join(input_dir, "metrics.jsonl"))
+    atexit.register(lambda: print("\n" + METRICS.summary()))
+
+    read_tricky_sentences(input_dir)
+
+    print("Finished.")
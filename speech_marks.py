@@ -0,0 +1,254 @@
+"""Seek index of a joined audio file, built from Polly's speech marks: for every sentence and word, where it is in
+the text (chunk and offset) and where it's read out in the audio (time and byte offset).  Written by
+save_polly_speech(speech_marks=True) as {basename}_marks.idx, and memory-mapped to look words up in it, so finding
+every "Hiroshima" in a chapter is a binary search however long the book is.
+
+    python speech_marks.py books/hiroshima/ hiroshima
+
+lists every place the word is read out, with the span of the sentence around it.  audio_server.py's /find page
+plays just those spans.
+"""
+
+import argparse
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+
+from audio_utils import iter_mp3_frames, PCM_SAMPLE_RATE, PCM_SAMPLE_WIDTH, WAV_HEADER_SIZE
+
+# GLOBALS
+
+SPEECH_MARK_TYPES = ("sentence", "word")     # Marks requested for each chunk.  Billed like a second request!
+SPEECH_MARK_INDEX_SUFFIX = "_marks.idx"
+SPEECH_MARK_SPOOL_SUFFIX = "_marks.partial.jsonl"   # Each chunk's marks, in text order, until the file is finished
+
+# Layout of the index file, all little-endian:
+#   header: magic, version, marks, words, duration in ms, audio file bytes, file name length
+#   marks: one record per mark, in the order they're read out
+#   words: one record per word mark, sorted by lowercased word (then by mark), for binary searching
+#   strings: the audio file name, then every distinct word/sentence text, UTF-8
+SPEECH_MARK_INDEX_MAGIC = b"TTSMARKS"
+SPEECH_MARK_INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<8sIIIIQH")
+# type, chunk, text start, text end (UTF-8 bytes into the chunk's request text), time in ms, byte offset into the
+# audio file, index of the sentence mark it's in, and where its text is in the strings
+MARK_RECORD = struct.Struct("<BIIIIQIII")
+# strings offset and length of the lowercased word, index of the mark
+WORD_RECORD = struct.Struct("<IHI")
+
+MARK_TYPES = {"sentence": 0, "word": 1}
+NO_SENTENCE = 0xFFFFFFFF
+
+
+class _StringTable:
+    # Every distinct string once, as (offset, length) into one blob
+    def __init__(self):
+        self.blob = bytearray()
+        self._offsets = {}
+
+    def add(self, text):
+        data = text.encode("utf8")
+        if data not in self._offsets:
+            self._offsets[data] = len(self.blob)
+            self.blob += data
+        return self._offsets[data], len(data)
+
+
+def _pcm_locator(offset, length):
+    # Chunk start in seconds, and the byte a time in the chunk is at: whole samples, so always on a sample boundary
+    def locate(seconds):
+        sample = min(round(seconds * PCM_SAMPLE_RATE), length // PCM_SAMPLE_WIDTH)
+        return WAV_HEADER_SIZE + offset + sample * PCM_SAMPLE_WIDTH
+    return offset / (PCM_SAMPLE_RATE * PCM_SAMPLE_WIDTH), length / (PCM_SAMPLE_RATE * PCM_SAMPLE_WIDTH), locate
+
+
+def _mp3_locator(audio_path, offset, length):
+    # A time lands on the frame it's in, the first byte a player can start decoding at
+    frames = list(iter_mp3_frames(audio_path, offset, offset + length))
+    frame_offsets = [frame_offset for frame_offset, _ in frames]
+    frame_times = [seconds for _, seconds in frames]
+
+    def locate(seconds):
+        i = max(bisect.bisect_right(frame_times, seconds) - 1, 0)
+        return frame_offsets[min(i, len(frames) - 2)] if len(frames) > 1 else frame_offsets[0]
+    return None, frame_times[-1], locate
+
+
+def build_speech_mark_index(spool_path, audio_path, output_format, index_path):
+    """Builds index_path from the marks save_polly_speech() spooled for the joined audio_path.  Each spool line is
+    {"chunk", "offset", "length", "marks"}: where the chunk went in the file (offset/length as in the manifest)
+    and Polly's marks for it, times relative to the start of the chunk."""
+
+    strings = _StringTable()
+    strings.add(os.path.basename(audio_path))
+    words = []      # (lowercased word, mark index)
+    n_marks = 0
+    elapsed = 0.0   # Seconds of audio before the current chunk
+
+    # Written to a temp file and renamed, like everything else read back later
+    tmp_path = index_path + ".tmp"
+    with open(spool_path, "r", encoding="utf8") as fr, open(tmp_path, "wb") as fw:
+        fw.write(b"\0" * INDEX_HEADER.size)     # Filled in at the end, when the counts are known
+
+        for line in fr:
+            record = json.loads(line)
+            if output_format == "pcm":
+                start, seconds, locate = _pcm_locator(record["offset"], record["length"])
+            else:
+                start, seconds, locate = _mp3_locator(audio_path, record["offset"], record["length"])
+            start = elapsed if start is None else start
+
+            sentence = NO_SENTENCE
+            for mark in record["marks"]:
+                if mark["type"] not in MARK_TYPES:
+                    continue    # e.g. ssml or viseme marks, not indexed
+                mark_seconds = mark["time"] / 1000
+                if mark["type"] == "sentence":
+                    sentence = n_marks
+                else:
+                    words.append((mark["value"].lower(), n_marks))
+                value_offset, value_length = strings.add(mark["value"])
+                fw.write(MARK_RECORD.pack(MARK_TYPES[mark["type"]], record["chunk"], mark["start"], mark["end"],
+                                          round((start + mark_seconds) * 1000), locate(mark_seconds), sentence,
+                                          value_offset, value_length))
+                n_marks += 1
+            elapsed = start + seconds
+
+        # Sorting the str gives the same order as sorting the UTF-8 bytes, which is what find() compares
+        words.sort()
+        for word, mark_index in words:
+            word_offset, word_length = strings.add(word)
+            fw.write(WORD_RECORD.pack(word_offset, word_length, mark_index))
+        fw.write(strings.blob)
+
+        fw.seek(0)
+        fw.write(INDEX_HEADER.pack(SPEECH_MARK_INDEX_MAGIC, SPEECH_MARK_INDEX_VERSION, n_marks, len(words),
+                                   round(elapsed * 1000), os.path.getsize(audio_path),
+                                   len(os.path.basename(audio_path).encode("utf8"))))
+    os.replace(tmp_path, index_path)
+    return n_marks
+
+
+class SpeechMarkIndex:
+    """Read-only view of a {basename}_marks.idx file, memory-mapped so opening one costs next to nothing."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fr:
+            self._data = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_marks, self.n_words, self.duration_ms, self.audio_bytes, name_length = \
+            INDEX_HEADER.unpack_from(self._data, 0)
+        if magic != SPEECH_MARK_INDEX_MAGIC or version != SPEECH_MARK_INDEX_VERSION:
+            raise ValueError(f"{path} is not a version {SPEECH_MARK_INDEX_VERSION} speech mark index")
+        self._words_start = INDEX_HEADER.size + self.n_marks * MARK_RECORD.size
+        self._strings_start = self._words_start + self.n_words * WORD_RECORD.size
+        self.file = self._string(0, name_length).decode("utf8")    # Audio file name, next to the index
+
+    def close(self):
+        self._data.close()
+
+    def _string(self, offset, length):
+        return bytes(self._data[self._strings_start + offset:self._strings_start + offset + length])
+
+    def mark(self, i):
+        """Mark i as a dict: type, chunk, start/end (bytes into the chunk's request text), time (ms), byte
+        (offset into the audio file), sentence (index of its sentence mark) and value (the text read)."""
+        kind, chunk, start, end, time, byte, sentence, value_offset, value_length = \
+            MARK_RECORD.unpack_from(self._data, INDEX_HEADER.size + i * MARK_RECORD.size)
+        return {"type": "sentence" if kind == MARK_TYPES["sentence"] else "word", "chunk": chunk, "start": start,
+                "end": end, "time": time, "byte": byte, "sentence": None if sentence == NO_SENTENCE else sentence,
+                "value": self._string(value_offset, value_length).decode("utf8")}
+
+    def _word_at(self, i):
+        word_offset, word_length, mark_index = WORD_RECORD.unpack_from(self._data, self._words_start + i * WORD_RECORD.size)
+        return self._string(word_offset, word_length), mark_index
+
+    def find(self, word):
+        """Indexes of every mark for word (case-insensitive), in reading order."""
+
+        target = word.lower().encode("utf8")
+        lo, hi = 0, self.n_words
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word_at(mid)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        found = []
+        while lo < self.n_words:
+            candidate, mark_index = self._word_at(lo)
+            if candidate != target:
+                break
+            found.append(mark_index)
+            lo += 1
+        return found
+
+    def span(self, i):
+        """(start ms, end ms, start byte, end byte) of the sentence mark i is in, i.e. up to the next sentence."""
+
+        mark = self.mark(i)
+        first = mark["sentence"] if mark["sentence"] is not None else i
+        start = self.mark(first)
+        for j in range(first + 1, self.n_marks):
+            following = self.mark(j)
+            if following["type"] == "sentence":
+                return start["time"], following["time"], start["byte"], following["byte"]
+        return start["time"], self.duration_ms, start["byte"], self.audio_bytes
+
+
+def _natural_key(name):
+    # chapter_2 before chapter_10
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def find_speech_mark_indexes(book_dir):
+    """Paths of every speech mark index in book_dir, in chapter order."""
+    names = [name for name in os.listdir(book_dir) if name.endswith(SPEECH_MARK_INDEX_SUFFIX)]
+    return [os.path.join(book_dir, name) for name in sorted(names, key=_natural_key)]
+
+
+def find_word(book_dir, word):
+    """Every place word is read out in book_dir's audio: (audio file, word mark, (start ms, end ms, start byte,
+    end byte) of its sentence, sentence text)."""
+
+    found = []
+    for path in find_speech_mark_indexes(book_dir):
+        index = SpeechMarkIndex(path)
+        try:
+            for i in index.find(word):
+                mark = index.mark(i)
+                sentence = index.mark(mark["sentence"])["value"] if mark["sentence"] is not None else mark["value"]
+                found.append((index.file, mark, index.span(i), sentence))
+        finally:
+            index.close()
+    return found
+
+
+def format_time(ms):
+    minutes, ms = divmod(ms, 60000)
+    return f"{minutes}:{ms / 1000:06.3f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("book_dir", help="book folder, e.g. books/hiroshima/")
+    parser.add_argument("word", help="word to look for, any case")
+    args = parser.parse_args()
+
+    if not find_speech_mark_indexes(args.book_dir):
+        print(f"ERROR: No speech mark indexes ({SPEECH_MARK_INDEX_SUFFIX}) in {args.book_dir}.  Render the book with SPEECH_MARKS=1 first.")
+        quit()
+
+    found = find_word(args.book_dir, args.word)
+    for file, mark, (start, end, start_byte, end_byte), sentence in found:
+        print(f"{file} {format_time(mark['time'])}  sentence {format_time(start)}-{format_time(end)} "
+              f"(bytes {start_byte}-{end_byte}), chunk {mark['chunk']}: {sentence}")
+    print(f"{len(found)} occurrences of {args.word}.")
+
+
+if __name__ == "__main__":
+    main()
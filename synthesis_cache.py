@@ -0,0 +1,161 @@
+"""On-disk cache of synthesized audio, so unchanged chunks are never paid for twice."""
+
+import hashlib
+import threading
+import os
+
+from audio_utils import copy_stream
+
+# GLOBALS
+
+DEFAULT_CACHE_DIR = ".tts_cache"            # Relative to where the scripts are run, like heteronyms.txt
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024**3       # 2 GB.  Roughly 200 hours of neural mp3 audio.
+
+
+class SynthesisCache:
+    """Content-addressed store of audio bytes.  Entries are keyed on a hash of everything that
+    changes the audio (text, voice, engine, output format, lexicon version), and the least recently
+    used entries are evicted once the cache grows past max_bytes.  Safe to share between threads."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None    # Lazily counted on first put(), so a read-only run never walks the cache
+        self._pinned = {}           # key -> pin count.  Pinned entries are never evicted (still being read).
+
+    @staticmethod
+    def make_key(text, voice_id, engine, output_format, lexicon_version=None):
+        """Hash of every input that affects the synthesized audio."""
+
+        # NOTE: lexicon_version is only for lexicons applied OUTSIDE the text (e.g. uploaded to the service).
+        # Inline <phoneme> tags are already part of the text, so fixing one phoneme only misses the
+        # chunks that actually contain that word.
+        h = hashlib.sha256()
+        for part in (text, voice_id, engine, output_format, lexicon_version or ""):
+            h.update(part.encode("utf8"))
+            h.update(b"\0")     # separator, so ("ab", "c") and ("a", "bc") don't collide
+        return h.hexdigest()
+
+    def _path(self, key):
+        # Fan out into subdirectories so no single directory gets huge
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """Returns the cached audio bytes, or None on a miss."""
+
+        path = self.lookup(key)
+        if path is None:
+            return None
+        with open(path, "rb") as fr:
+            return fr.read()
+
+    def contains(self, key):
+        """True if key is cached.  Unlike lookup(), doesn't count as a use, so it's safe for a dry run."""
+        return os.path.exists(self._path(key))
+
+    def lookup(self, key, pin=False):
+        """Returns the path of the cached audio file, or None on a miss.  With pin=True the entry can't be
+        evicted until unpin(key) is called, so it's safe to read the file later."""
+
+        path = self._path(key)
+        with self._lock:
+            try:
+                # Touch it so eviction sees it as recently used
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+            except OSError:
+                pass
+            if pin:
+                self._pinned[key] = self._pinned.get(key, 0) + 1
+        return path
+
+    def unpin(self, key):
+        with self._lock:
+            count = self._pinned.get(key, 0) - 1
+            if count > 0:
+                self._pinned[key] = count
+            else:
+                self._pinned.pop(key, None)
+
+    def put(self, key, data):
+        """Stores audio bytes under key, then evicts old entries if over the size cap."""
+
+        tmp_path = self._tmp_path(key)
+        with open(tmp_path, "wb") as fw:
+            fw.write(data)
+        self._commit(key, tmp_path, len(data))
+
+    def put_stream(self, key, stream, pin=False):
+        """Stores audio read from a binary stream under key, copying one block at a time so the
+        whole chunk is never held in memory.  Returns the path of the cached file (see lookup() for pin)."""
+
+        tmp_path = self._tmp_path(key)
+        try:
+            with open(tmp_path, "wb") as fw:
+                size = copy_stream(stream, fw)
+        except BaseException:
+            # Connection dropped mid-stream or similar, don't leave the partial file lying around
+            os.remove(tmp_path)
+            raise
+        return self._commit(key, tmp_path, size, pin=pin)
+
+    def _tmp_path(self, key):
+        # Write to a temp file and rename, so a crash mid-write never leaves a truncated entry behind
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return f"{path}.{threading.get_ident()}.tmp"
+
+    def _commit(self, key, tmp_path, size, pin=False):
+        path = self._path(key)
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._disk_usage()
+            try:
+                self._total_bytes -= os.path.getsize(path)     # overwriting an existing entry
+            except OSError:
+                pass
+            os.replace(tmp_path, path)
+            self._total_bytes += size
+
+            if pin:
+                self._pinned[key] = self._pinned.get(key, 0) + 1
+
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+        return path
+
+    def _entries(self):
+        """(mtime, size, path) of every entry in the cache."""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _disk_usage(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Deletes least recently used entries until the cache is back under 90% of max_bytes.
+        Going a bit under the cap means we don't walk the whole cache again on the very next put()."""
+
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(self._entries()):
+            if self._total_bytes <= target:
+                break
+            if os.path.basename(path) in self._pinned:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._total_bytes -= size
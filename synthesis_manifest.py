@@ -0,0 +1,147 @@
+"""Checkpoint manifest of a multi-chunk synthesis run, so an interrupted book can pick up where it left off."""
+
+import json
+import os
+import time
+
+# GLOBALS
+
+MANIFEST_VERSION = 1
+MANIFEST_SAVE_INTERVAL = 1.0    # Seconds.  Throttle for saves after every chunk, see save()
+
+# Chunk statuses
+CHUNK_PENDING = "pending"
+CHUNK_DONE = "done"
+CHUNK_FAILED = "failed"
+
+
+class SynthesisManifest:
+    """Records each chunk's hash, status and output path in {basename}_manifest.json next to the output.
+    Saved after every chunk, so a crash or a failed chunk never loses the ones that already finished."""
+
+    def __init__(self, output_path, basename):
+        self.path = os.path.join(output_path, basename + "_manifest.json")
+        self.chunks = []    # One dict per chunk, in text order
+        self.output = None  # Size/mtime of the joined output file the chunks' offsets point into
+        self._previous = None   # hash -> entry from the last run, while chunks are still being added
+        self._seen = set()
+        self._last_save = 0.0
+
+    @classmethod
+    def load(cls, output_path, basename):
+        """Loads the manifest from the last run, or an empty one if there wasn't one."""
+
+        manifest = cls(output_path, basename)
+        try:
+            with open(manifest.path, "r", encoding="utf8") as fr:
+                saved = json.load(fr)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return manifest
+
+        if saved.get("version") == MANIFEST_VERSION:
+            manifest.chunks = saved.get("chunks", [])
+            manifest.output = saved.get("output")
+        return manifest
+
+    def reset(self, chunk_hashes):
+        """Lines the manifest up with this run's chunks.  Chunks whose hash still matches keep their old
+        entry (so finished ones are known to be finished), everything else starts out pending.  That includes
+        chunks that failed last time: add() puts them back to pending, so a rerun retries them."""
+
+        self.begin()
+        for chunk_hash in chunk_hashes:
+            self.add(chunk_hash)
+        self.finish()
+
+    def begin(self):
+        """Starts lining the manifest up with this run's chunks one at a time, as they're streamed in, see add().
+        Until finish(), saves still carry the last run's entries that haven't been added again yet, so an
+        interrupted run doesn't forget about chunks it never got to."""
+
+        self._previous = {}
+        for entry in self.chunks:
+            self._previous.setdefault(entry["hash"], entry)
+        self._seen = set()
+        self.chunks = []
+
+    def add(self, chunk_hash):
+        """Appends the next chunk, keeping its entry from the last run if the hash matches.  Returns the entry."""
+
+        entry = self._previous.get(chunk_hash)
+        if entry is None:
+            entry = {"hash": chunk_hash, "status": CHUNK_PENDING, "path": None, "attempts": 0, "error": None,
+                     "offset": None, "length": None}
+        else:
+            entry = dict(entry)
+            if entry["status"] != CHUNK_DONE:
+                # Failed last time, it's up for another try this run
+                entry["status"] = CHUNK_PENDING
+        entry["index"] = len(self.chunks) + 1
+        self.chunks.append(entry)
+        self._seen.add(chunk_hash)
+        return entry
+
+    def finish(self):
+        """All of this run's chunks are in, drop whatever's left over from the last run."""
+        self._previous = None
+        self._seen = set()
+
+    def is_done(self, idx, path):
+        """True if chunk idx (0-based) finished on an earlier run, into path, and that file is still there."""
+
+        entry = self.chunks[idx]
+        return entry["status"] == CHUNK_DONE and entry["path"] == path and os.path.exists(path)
+
+    def mark(self, idx, status, path=None, attempts=None, error=None):
+        entry = self.chunks[idx]
+        entry["status"] = status
+        entry["path"] = path
+        if attempts is not None:
+            entry["attempts"] = attempts
+        entry["error"] = str(error) if error is not None else None
+        # Its place in the joined file is only known once the whole file has been written
+        entry["offset"] = entry["length"] = None
+
+    def set_output(self, path):
+        """Records which joined file the chunk offsets refer to."""
+        st = os.stat(path)
+        self.output = {"path": path, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    def output_matches(self, path):
+        """True if path is still exactly the joined file the chunk offsets were recorded for."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if self.output is None or os.path.abspath(self.output["path"]) != os.path.abspath(path):
+            return False
+        # Same path however it's spelled (books/x/ vs ./books/x), as long as the file itself hasn't changed
+        return (self.output["size"], self.output["mtime_ns"]) == (st.st_size, st.st_mtime_ns)
+
+    def dependencies(self):
+        """word -> lexicon entry hash, for every lexicon word the chunks depended on (see PhonemeLexicon.dependencies())."""
+        words = {}
+        for entry in self.chunks:
+            words.update(entry.get("words") or {})
+        return words
+
+    def failed_chunks(self):
+        return [entry for entry in self.chunks if entry["status"] == CHUNK_FAILED]
+
+    def save(self, min_interval=0):
+        """Writes the manifest out.  With min_interval, skips the write if the last one was less than that many
+        seconds ago, so saving after every chunk of a huge book doesn't rewrite the file thousands of times."""
+
+        if min_interval and time.monotonic() - self._last_save < min_interval:
+            return
+
+        chunks = self.chunks
+        if self._previous is not None:
+            chunks = chunks + [entry for chunk_hash, entry in self._previous.items() if chunk_hash not in self._seen]
+
+        # Write to a temp file and rename, so a crash mid-save never leaves a corrupt manifest behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as fw:
+            json.dump({"version": MANIFEST_VERSION, "output": self.output, "chunks": chunks}, fw, indent=2)
+        os.replace(tmp_path, self.path)
+        self._last_save = time.monotonic()
@@ -0,0 +1,156 @@
+"""Dry run planning: what a render would send to Polly, what it would cost and how long it would take, worked out
+by running the whole text pipeline (chapters, chunking, lexicon, cache and manifest lookups) without sending a
+single request or writing any audio.  Run read_entire_book.py or read_tricky_sentences.py with DRY_RUN=1, or
+batch.py with --dry-run, to get the report and a per-chunk {input_dir}/dry_run_plan.csv."""
+
+import csv
+import heapq
+import json
+import os
+import threading
+
+# GLOBALS
+
+# What would happen to each chunk/clip
+PLAN_REQUEST = "request"    # Sent to Polly, and billed
+PLAN_CACHED = "cached"      # Copied out of SYNTHESIS_CACHE
+PLAN_SPLICED = "spliced"    # Unchanged, copied across from the last joined file
+PLAN_RESUMED = "resumed"    # Already done by an earlier run, left alone
+
+PLAN_FIELDS = ["label", "chunk", "kind", "action", "billed_chars", "ssml_chars", "total_chars"]
+
+# Request time model when there's no history in metrics.jsonl to go on: seconds = base + per_char * billed chars.
+# Rough neural voice numbers, about 3 s for a full 3000 character chunk.
+PLAN_LATENCY_BASE = 0.4
+PLAN_LATENCY_PER_CHAR = 0.0008
+PLAN_MIN_HISTORY = 5        # Past requests needed before they're used instead
+
+# Neural voice price in USD per million billed characters, for the cost estimate.  Check current AWS pricing!
+AWS_POLLY_NEURAL_PRICE_PER_MILLION = 16.00
+
+PLAN_SMALL_CHUNK_RATIO = 0.1    # Chunks under this fraction of the billed limit are flagged, requests wasted on crumbs
+PLAN_SSML_HEAVY_RATIO = 0.5     # ..and chunks that are more than this fraction markup, they come out short
+
+
+class SynthesisPlan:
+    """Everything a dry run would have requested, added to from any thread by save_polly_speech()/save_polly_clips()."""
+
+    def __init__(self):
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def add(self, label, chunk, kind, action, billed_chars, total_chars):
+        """One chunk or clip.  kind is "audio", "marks" (speech marks) or "clip"."""
+        with self._lock:
+            self.rows.append({"label": label, "chunk": chunk, "kind": kind, "action": action,
+                              "billed_chars": billed_chars, "ssml_chars": total_chars - billed_chars,
+                              "total_chars": total_chars})
+
+    def requests(self):
+        return [row for row in self.rows if row["action"] == PLAN_REQUEST]
+
+    def save_csv(self, path):
+        with open(path, "w", encoding="utf8", newline="") as fw:
+            writer = csv.DictWriter(fw, fieldnames=PLAN_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def summary(self, rate, burst, connections, latency_model, char_limit):
+        """Human readable report, see the top of this file."""
+
+        lines = ["Dry run, nothing was sent to Polly:"]
+        counts = {action: sum(1 for row in self.rows if row["action"] == action)
+                  for action in (PLAN_REQUEST, PLAN_CACHED, PLAN_SPLICED, PLAN_RESUMED)}
+        lines.append(f"  {len(self.rows)} requests' worth of chunks/marks/clips: {counts[PLAN_REQUEST]} to request, {counts[PLAN_CACHED]} from cache, "
+                     f"{counts[PLAN_SPLICED]} spliced from the last render, {counts[PLAN_RESUMED]} already done")
+
+        requests = self.requests()
+        billed = sum(row["billed_chars"] for row in requests)
+        ssml = sum(row["ssml_chars"] for row in requests)
+        lines.append(f"  Billed characters: {billed} (about ${billed / 1e6 * AWS_POLLY_NEURAL_PRICE_PER_MILLION:.2f}), "
+                     f"plus {ssml} characters of SSML markup that aren't billed")
+        if requests:
+            sizes = sorted(row["billed_chars"] for row in requests)
+            lines.append(f"  Billed characters per request: min {sizes[0]}, median {sizes[len(sizes) // 2]}, "
+                         f"max {sizes[-1]} (limit {char_limit})")
+
+        # Degenerate chunking: lots of tiny requests, or requests that are mostly markup
+        small = [row for row in requests if row["kind"] != "clip" and row["billed_chars"] < PLAN_SMALL_CHUNK_RATIO * char_limit]
+        heavy = [row for row in requests if row["total_chars"] and row["ssml_chars"] > PLAN_SSML_HEAVY_RATIO * row["total_chars"]]
+        for rows, problem in ((small, f"under {PLAN_SMALL_CHUNK_RATIO:.0%} of the billed limit"),
+                              (heavy, f"more than {PLAN_SSML_HEAVY_RATIO:.0%} SSML markup")):
+            if rows:
+                examples = ", ".join(f"{row['label']} #{row['chunk']}" for row in rows[:5])
+                lines.append(f"  WARNING: {len(rows)} requests are {problem}: {examples}{'..' if len(rows) > 5 else ''}")
+
+        base, per_char, source = latency_model
+        lines.append(f"  Request time model: {base:.2f}s + {per_char * 1000:.2f}ms per billed character ({source})")
+        chars = [row["billed_chars"] for row in requests]
+        wall = estimate_wall_time(chars, rate, burst, connections, base, per_char)
+        lines.append(f"  Estimated synthesis time: {_format_seconds(wall)} at {rate:g} requests/s (burst {burst:g}), "
+                     f"{connections} connections")
+        # What more (or fewer) connections would buy, to size them before paying for it
+        options = sorted({1, 2, 4, 8, 16, connections})
+        lines.append("  With other connection limits: " + ", ".join(
+            f"{n}: {_format_seconds(estimate_wall_time(chars, rate, burst, n, base, per_char))}" for n in options))
+        return "\n".join(lines)
+
+
+def _format_seconds(seconds):
+    hours, seconds = divmod(round(seconds), 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def estimate_wall_time(request_chars, rate, burst, connections, base, per_char):
+    """Seconds to get through requests of request_chars billed characters each, in order, under a token bucket
+    of rate/burst (like POLLY_RATE_LIMITER) and at most connections in flight (POLLY_CONNECTION_LIMITER).
+    Simulated request by request, so it's right whether the rate limit or the connections are the bottleneck."""
+
+    free = [0.0] * max(1, connections)     # When each connection is next free
+    tokens, last = float(burst), 0.0
+    finished = 0.0
+    for chars in request_chars:
+        now = max(heapq.heappop(free), last)
+        tokens = min(burst, tokens + (now - last) * rate)
+        last = now
+        if tokens < 1:
+            now += (1 - tokens) / rate
+            tokens, last = 1.0, now
+        tokens -= 1
+        done = now + base + per_char * chars
+        heapq.heappush(free, done)
+        finished = max(finished, done)
+    return finished
+
+
+def load_latency_model(metrics_path):
+    """(base seconds, seconds per billed character, where it came from), fitted to the successful requests in
+    metrics_path from earlier runs if there are enough of them, otherwise the PLAN_LATENCY_* defaults."""
+
+    points = []
+    try:
+        with open(metrics_path, "r", encoding="utf8") as fr:
+            for line in fr:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("event") == "request" and record.get("error") is None and record.get("billed_chars"):
+                    # seconds includes streaming the audio, all of which holds a connection
+                    points.append((record["billed_chars"], record.get("seconds") or record["latency"]))
+    except FileNotFoundError:
+        pass
+
+    if len(points) < PLAN_MIN_HISTORY:
+        return PLAN_LATENCY_BASE, PLAN_LATENCY_PER_CHAR, "defaults"
+
+    # Least squares line through (chars, seconds), never below zero
+    n = len(points)
+    mean_chars = sum(chars for chars, _ in points) / n
+    mean_seconds = sum(seconds for _, seconds in points) / n
+    spread = sum((chars - mean_chars) ** 2 for chars, _ in points)
+    per_char = sum((chars - mean_chars) * (seconds - mean_seconds) for chars, seconds in points) / spread if spread else 0.0
+    per_char = max(per_char, 0.0)
+    base = max(mean_seconds - per_char * mean_chars, 0.0)
+    return base, per_char, f"fitted to {n} past requests in {os.path.basename(metrics_path)}"
@@ -3,7 +3,15 @@
 import regex    # NOT re, different library!
 import re
 import json
+import hashlib
+import functools
 import os
+import codecs
+import io
+
+from word_dictionary import load_english_dictionary
+from lexicon_utils import load_phoneme_lexicon, xml_escape, PHONEME_LEXICON_FILE
+from metrics import timed_stage
 
 # Globals
 
@@ -22,38 +30,132 @@ import os
 # TTS doesn't have issues with those, so just manually pruning those.
 REMOVE = regex.compile(r'[\p{C}|\p{M}|\p{Ps}|\p{Pe}|\p{Po}|\p{Pc}|\p{Pd}|\p{S}|\p{Z}]+', regex.UNICODE)
 
+# Exact opposite of REMOVE (same character class, negated), so finditer() gives the same words as
+# REMOVE.sub(" ", line).split() but keeps their character offsets in the original line.
+WORD_TOKEN = regex.compile(r'[^\p{C}|\p{M}|\p{Ps}|\p{Pe}|\p{Po}|\p{Pc}|\p{Pd}|\p{S}|\p{Z}]+', regex.UNICODE)
+
+# Bump if the layout of the saved *_index.json files changes, so old ones get rebuilt
+BOOK_INDEX_VERSION = 1
+
+# Chapter headings inside a single input.txt, e.g. "Chapter 3", "CHAPTER IV: The Fire", "Part Two" or
+# "II—The Fire" (how the Hiroshima article does it).  Only short lines that don't end like a sentence count,
+# so dialogue like "I—I can't." isn't taken for a heading.
+CHAPTER_HEADING = re.compile(r"^\s*(?:(?i:chapter|part|book)\s+(?:\d+|[IVXLCivxlc]+|(?i:one|two|three|four|five|six|seven"
+                             r"|eight|nine|ten|eleven|twelve|thirteen|fourteen|fifteen|sixteen|seventeen|eighteen"
+                             r"|nineteen|twenty))\b.*|[IVXLC]+\s*[—–.:-]\s*\w.*)$")
+CHAPTER_HEADING_MAX_LEN = 80
+
+# For chunking text to send to the TTS.  See chunk_text_to_lists().
+SSML_TAG = re.compile(r"<[^>]*>")
+SENTENCE_BOUNDARY = re.compile(r"(?<!\bMr)(?<!\bMrs)(?<!\bMs)(?<!\bDr)(?<!\bMiss)[.!?…]+[\"”’')\]]*\s+|\n+")
+WORD_BOUNDARY = re.compile(r"\s+")
+WHITESPACE_RUN = re.compile(r"\s*")
+CHAPTER_FILE = re.compile(r"^chapter_(\d+)\.txt$")
+
+# Streaming a book instead of reading it all in.  See iter_file_text() and iter_text_chunks().
+TEXT_READ_BLOCK_SIZE = 64 * 1024    # Bytes read from the book file at a time
+
 # How many words before/after a tricky word to have the TTS read
 CONTEXT_WORD_CNT = 7
 
 
-def get_unique_word_list(filepath):
-    '''Creates a list of unique words from a file path (plain text file)'''
+# In-process copies of loaded book indexes, keyed on absolute file path
+_book_indexes = {}
+
+
+def _file_sha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as fr:
+        for block in iter(lambda: fr.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _book_index_path(filepath):
+    '''input.txt -> input_index.json, chapter_1.txt -> chapter_1_index.json, next to the text file.'''
+    return os.path.splitext(filepath)[0] + "_index.json"
+
+
+@timed_stage("build_book_index")
+def build_book_index(filepath):
+    '''Tokenizes the text file once and returns a dict of normalized word -> list of [line_no, start, end]
+    positions, in file order.  Frequency of a word is just the length of its list.'''
 
     print("Tokenizing words in input text file..")
 
-    all_words_set = set()
+    words = {}
+
+    with open(filepath, 'r', encoding='utf8') as inp:
+        for line_no, line in enumerate(inp):
+            for m in WORD_TOKEN.finditer(line):
+                token = m.group()
+
+                # Lowercased word. Also strip off “
+                word = re.sub('[“”]', '', token).lower().strip()
+                if not word:
+                    continue
+
+                # Point the offsets at the word itself rather than any quotes stuck to it, so
+                # the phoneme tags can be wrapped around exactly the right characters later
+                start = m.start() + (len(token) - len(token.lstrip('“”')))
+                end = m.end() - (len(token) - len(token.rstrip('“”')))
+                if line[start:end].lower() != word:
+                    # Quote in the middle of a word, just use the whole token
+                    start, end = m.start(), m.end()
+
+                words.setdefault(word, []).append([line_no, start, end])
+
+    return words
+
+
+def load_book_index(filepath):
+    '''Returns the word index for a text file (see build_book_index()).  The index is saved next to the
+    file and reused on later runs until the file's contents change.'''
 
     try:
-        with open(filepath, 'r', encoding='utf8') as inp:
-            for line in inp:
-                # print(line)
-
-                depunctuated_line = REMOVE.sub(" ", line).strip()
-                # print(depunctuated_line)
-                
-                for word in depunctuated_line.split():
-                    # print(word)
-                    
-                    # Add lowercased word to set. Also strip off “
-                    all_words_set.add(re.sub('[“”]', '', word).lower().strip())
-                    # all_words_set.add(word.lower())
+        source_hash = _file_sha256(filepath)
     except FileNotFoundError:
         print(f"Cannot find file path: {filepath}")
         print("Ensure input file is named 'input.txt' and directory is spelled correctly.")
         quit()
 
-    # convert set to list so we can sort it by length
-    all_words_list = list(all_words_set)
+    abs_path = os.path.abspath(filepath)
+    cached = _book_indexes.get(abs_path)
+    if cached and cached["source_sha256"] == source_hash:
+        return cached["words"]
+
+    index_path = _book_index_path(filepath)
+    try:
+        with open(index_path, 'r', encoding='utf8') as fr:
+            saved = json.load(fr)
+    except (FileNotFoundError, json.JSONDecodeError):
+        saved = None
+
+    if saved and saved.get("version") == BOOK_INDEX_VERSION and saved.get("source_sha256") == source_hash:
+        index = saved
+    else:
+        index = {
+            "version": BOOK_INDEX_VERSION,
+            "source_sha256": source_hash,
+            "words": build_book_index(filepath),
+        }
+        try:
+            with open(index_path, 'w', encoding='utf8') as fw:
+                json.dump(index, fw, ensure_ascii=False, separators=(',', ':'))
+        except IOError as error:
+            # Not fatal, we just tokenize again next time
+            print(f"WARNING: Could not save book index {index_path}: {error}")
+
+    _book_indexes[abs_path] = index
+    return index["words"]
+
+
+@timed_stage("get_unique_word_list")
+def get_unique_word_list(filepath):
+    '''Creates a list of unique words from a file path (plain text file)'''
+
+    # Tokenized once per book and saved, see load_book_index()
+    all_words_list = list(load_book_index(filepath))
 
     # sort it, shortest to longest words, just cause
     all_words_sorted = list(sorted(all_words_list, key = len))
@@ -61,16 +163,18 @@ def get_unique_word_list(filepath):
     return all_words_sorted
 
 
+@timed_stage("find_non_dictionary_words")
 def find_non_dictionary_words(input_word_list):
     """Takes a list of words and returns a list of the ones that aren't English words,
     as defined by what's in an English dictionary"""
 
     # Got a JSON file of English words from this site
     # https://github.com/dwyl/english-words
+    # It's compiled once into a sorted, memory-mapped word file (see word_dictionary.py), so loading
+    # is instant and each `in` check is a binary search instead of a scan of a huge list/dict.
 
     print("Loading English word dictionary reference..")
-    with open('words_english_dictionary.json', 'r') as ed_file:
-        english_words = json.load(ed_file)
+    english_words = load_english_dictionary()
 
     non_english_words = []
 
@@ -130,26 +234,44 @@ def find_non_dictionary_words(input_word_list):
     return non_english_words
 
 
-def find_heteronyms(input_word_list):
-    '''Find heteronyms in the text.'''
+@functools.lru_cache(maxsize=None)
+def load_heteronyms(filepath="heteronyms.txt"):
+    '''Parses the heteronyms file once into a frozenset of words.'''
 
     print("Loading English heteronyms..")
-    heteronyms_found = []
-    with open("heteronyms.txt", 'r', encoding='utf8') as inp:
+    heteronyms = set()
+    with open(filepath, 'r', encoding='utf8') as inp:
         for hetero in inp:
-            if hetero[0] == '#':
+            if hetero.startswith('#'):
                 # Allow me to comment out heteronyms in file.  For example, 
                 # 'are' is a heteronym, like a hectare but a single one.  
                 # Super rare case and makes lots of noise for me.
                 continue    # skip this word
-            for input_word in input_word_list:
-                # all are lowercase already, one per line on file
-                # input_words already guaranteed stripped of space
-                if input_word == hetero.strip():
-                    heteronyms_found.append(input_word)
-                    break
-    
-    return heteronyms_found
+            # all are lowercase already, one per line on file
+            if hetero.strip():
+                heteronyms.add(hetero.strip())
+
+    return frozenset(heteronyms)
+
+
+@timed_stage("find_heteronyms")
+def find_heteronyms(input_word_list):
+    '''Find heteronyms in the text.'''
+
+    # input_words already guaranteed lowercase and stripped of space, so a set intersection does it
+    heteronyms_found = load_heteronyms().intersection(input_word_list)
+
+    # Alphabetical, same as the heteronyms file
+    return sorted(heteronyms_found)
+
+
+def count_word_occurrences(filepath, words):
+    '''Returns a dict of word -> number of times it appears in the text file, most frequent first.
+    Counts come straight from the book index, so this doesn't rescan the text.'''
+
+    book_index = load_book_index(filepath)
+    counts = {word: len(book_index.get(word, [])) for word in words}
+    return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
 
 
 def save_out_phoneme_dictionary(input_dir, input_word_list):
@@ -197,6 +319,159 @@ def save_out_phoneme_dictionary(input_dir, input_word_list):
         # print("")
 
     
+class WordMatcher:
+    '''Finds every occurrence of a whole set of words in a line with one compiled regex, instead of
+    compiling and running a separate pattern per word.'''
+
+    def __init__(self, words):
+        self.words = set(words)
+
+        if self.words:
+            # Longest first, so at any position the alternation picks the longest word that fits
+            alternation = "|".join(re.escape(w) for w in sorted(self.words, key=len, reverse=True))
+            # Zero-width lookahead so finditer() tries every start position, which lets words that start
+            # inside another match (or at the same spot) still be found.  \b for word boundary, same as before.
+            self.pattern = re.compile(f"(?=\\b({alternation})\\b)")
+        else:
+            self.pattern = None
+
+        # Shorter words that are also a prefix of a longer word, e.g. 'fujii' and "fujii’s".  The alternation
+        # only reports the longest one at a given position, so these get checked by hand.
+        self.prefixes = {w: [w[:i] for i in range(1, len(w)) if w[:i] in self.words] for w in self.words}
+
+    def finditer(self, line):
+        '''Yields (word, start, end) for every word found in line, in the order they appear.
+        Matching is done on the lowercased line, since the word lists are all lowercase.'''
+
+        if self.pattern is None:
+            return
+
+        lower_line = line.lower()
+        for m in self.pattern.finditer(lower_line):
+            word = m.group(1)
+            start = m.start(1)
+            yield (word, start, start + len(word))
+
+            for prefix in self.prefixes[word]:
+                if _is_word_boundary(lower_line, start + len(prefix)):
+                    yield (prefix, start, start + len(prefix))
+
+
+def _is_word_boundary(text, idx):
+    '''Same test as regex \\b: a word character on exactly one side of idx.'''
+
+    def is_word_char(i):
+        return 0 <= i < len(text) and (text[i].isalnum() or text[i] == '_')
+
+    return is_word_char(idx - 1) != is_word_char(idx)
+
+
+@timed_stage("find_word_occurrences")
+def find_word_occurrences(filepath, words, return_all_matches=True):
+    '''Scans the file once and returns a dict of word -> list of (line_no, start, end, line) hits,
+    in file order.  With return_all_matches=False only the first hit of each word is kept.'''
+
+    matcher = WordMatcher(words)
+    occurrences = {word: [] for word in matcher.words}
+    words_left = len(occurrences)     # words with no hit yet, only matters for first-match-only
+
+    try:
+        with open(filepath, 'r', encoding='utf8') as inp:
+            for line_no, line in enumerate(inp):
+                for word, start, end in matcher.finditer(line):
+                    hits = occurrences[word]
+                    if hits and not return_all_matches:
+                        continue
+                    if not hits:
+                        words_left -= 1
+                    hits.append((line_no, start, end, line))
+
+                if not return_all_matches and words_left == 0:
+                    # Found every word already, no need to read the rest of the book
+                    break
+
+    except FileNotFoundError:
+        print(f"Cannot find file path: {filepath}")
+        quit()
+
+    return occurrences
+
+
+def get_word_occurrences(filepath, words, return_all_matches=True):
+    '''Same result as find_word_occurrences(), but looks the positions up in the book index instead of
+    rescanning the text.  Only words the index doesn't know (i.e. not a token in the book) get scanned for.'''
+
+    book_index = load_book_index(filepath)
+
+    occurrences = {}
+    unindexed_words = []
+    for word in words:
+        if word in book_index:
+            positions = book_index[word] if return_all_matches else book_index[word][:1]
+            occurrences[word] = positions
+        else:
+            unindexed_words.append(word)
+
+    # Still need the lines themselves for context
+    if occurrences:
+        with open(filepath, 'r', encoding='utf8') as inp:
+            lines = inp.readlines()
+        for word, positions in occurrences.items():
+            occurrences[word] = [(line_no, start, end, lines[line_no]) for line_no, start, end in positions]
+
+    if unindexed_words:
+        occurrences.update(find_word_occurrences(filepath, unindexed_words, return_all_matches))
+
+    return occurrences
+
+
+def find_tricky_contexts(filepath, words_to_check, return_all_matches):
+    '''Yields (word, occurrence, line_no, context_start, start, end, context_end, line) for each occurrence of
+    each word (first only, unless return_all_matches), in words_to_check order.  occurrence counts from 1, and
+    line[context_start:context_end] is the word with about CONTEXT_WORD_CNT words of context either side.'''
+
+    # This is the key usage different right here.
+    # For heteronyms, they can be used multiple times in the file and each time pronounced differently.
+    # The non-English words are likely to be pronounced the same each time.
+    occurrences = get_word_occurrences(filepath, words_to_check, return_all_matches)
+
+    for word in words_to_check:
+        for occurrence, (line_no, start, end, line) in enumerate(occurrences.get(word, []), 1):
+            # Try a line-by-line basis and just grab X *characters* around the words instead of on 
+            # word boundaries.  That way, wherever the word is in the line, it'll replace it.
+            context_start = max(0, start - (CONTEXT_WORD_CNT*5))
+            context_end = end + (CONTEXT_WORD_CNT*5)
+            yield (word, occurrence, line_no, context_start, start, end, context_end, line)
+
+
+def _clip_name(word):
+    '''Filename-safe version of a word, e.g. "fujii’s" -> "fujii_s".'''
+    return re.sub(r"\W+", "_", word).strip("_") or "word"
+
+
+@timed_stage("get_tricky_clips")
+def get_tricky_clips(file_dir, words_to_check, return_all_matches, kind):
+    '''Same occurrences as get_tricky_sentences(), but as one clip per (word, occurrence) to synthesize on its
+    own: a list of dicts with the word, occurrence number, line number, clip name ({kind}_{word}_{occurrence})
+    and SSML text.  Once input_phonemes.json exists its pronunciations are applied to the clip text, and words
+    that have been deleted from it are skipped (the TTS already says them right).'''
+
+    filepath = os.path.join(file_dir, "input.txt")
+    lexicon = load_phoneme_lexicon(os.path.join(file_dir, PHONEME_LEXICON_FILE))
+
+    clips = []
+    for word, occurrence, line_no, context_start, _, _, context_end, line in find_tricky_contexts(filepath, words_to_check,
+                                                                                                 return_all_matches):
+        if lexicon is not None and word not in lexicon.words:
+            continue
+        context = line[context_start:context_end].strip()
+        clips.append({"word": word, "occurrence": occurrence, "line": line_no + 1,
+                      "name": f"{kind}_{_clip_name(word)}_{occurrence}",
+                      "text": lexicon.to_ssml(context) if lexicon is not None else xml_escape(context)})
+    return clips
+
+
+@timed_stage("get_tricky_sentences")
 def get_tricky_sentences(file_dir, words_to_check, return_all_matches):
     '''Takes a list of words and returns the words around it in that line 
     of the file that contains it, to see context.  Returns either just the
@@ -225,66 +500,32 @@ def get_tricky_sentences(file_dir, words_to_check, return_all_matches):
 
     all_sentences_list = []
     
-    # iterate over tricky words
-    for word in words_to_check:
+    # iterate over tricky words, keeping the same word order as the input list
+    for word, _, _, context_start, start, end, context_end, line in find_tricky_contexts(filepath, words_to_check,
+                                                                                         return_all_matches):
         try:
-            # reopen the file each time for each word, otherwise cursor just continues to end of file
-            with open(filepath, 'r', encoding='utf8') as inp:
-            
-                # iterate over every line in file
-                for line in inp:
-                    # print(line)
-
-                    # Try a line-by-line basis and just grab X *characters* around the words instead of on 
-                    # word boundaries.  That way, wherever the word is in the line, it'll replace it.
-                    lower_line = line.lower()
-
-                    # Tries to find if the word in this line, if it's there
-                    pattern = re.compile(f"\\b{word}\\b")   # \b for word boundary, but need double escape, or get \x08 (backspace char)
-                    m = pattern.search(lower_line)
-
-                    if m:
-                        # was a match
-                        start = m.start()   # index of match start
-                        end = m.end()       # index of match end
-                    else:
-                        # no match in this line, skip it and move on to next one
-                        continue
-
-                    try:
-                        # NOTE: Will have to hear how these sound, then just define the ones that need help.
-                        # On the first run, puts ** ** around the word.  After you've defined an input_phonemes.json
-                        # file, then it uses those.  
-                        if first_run:
-                            phonemed_sentence = (line[start-(CONTEXT_WORD_CNT*5):start] + '**' + word \
-                                + "**" + line[end:end+(CONTEXT_WORD_CNT*5)]).strip()        # Strip newlines off for consistency
-                        else:
-                            phonemed_sentence = (line[start-(CONTEXT_WORD_CNT*5):start] + '<phoneme alphabet="' \
-                            + phonemes[word]['alphabet'] + '" ph="' + phonemes[word]['ph'] + '">' + word \
-                            + "</phoneme>" + line[end:end+(CONTEXT_WORD_CNT*5)]).strip()
-
-                    except KeyError:
-                        # If a KeyError occurs, then that means that there is no entry for phonemes[word].
-                        # This most likely means that we deleted that as a tricky word, and want the TTS
-                        # to just pronounce it as its default method.
-                        # Just skip this line of the file (effectively skips this word) and don't have 
-                        # any sentences with this word in the output files.
-                        continue
-
-                    # print(f"{word}:  {context_sentence}")
-                    # print(f"{phonemed_sentence}")
-                    # all_sentences_list.append(f"{word}:  {context_sentence}")
-                    all_sentences_list.append(f"{phonemed_sentence}")
-                    
-                    # This is the key usage different right here.
-                    # For heteronyms, they can be used multiple times in the file and each time pronounced differently.
-                    # The non-English words are likely to be pronounced the same each time.
-                    if not return_all_matches:
-                        break
-
-        except FileNotFoundError:
-            print(f"Cannot find file path: {filepath}")
-            quit()
+            # NOTE: Will have to hear how these sound, then just define the ones that need help.
+            # On the first run, puts ** ** around the word.  After you've defined an input_phonemes.json
+            # file, then it uses those.  
+            if first_run:
+                phonemed_sentence = (line[context_start:start] + '**' + word \
+                    + "**" + line[end:context_end]).strip()        # Strip newlines off for consistency
+            else:
+                phonemed_sentence = (line[context_start:start] + '<phoneme alphabet="' \
+                + phonemes[word]['alphabet'] + '" ph="' + phonemes[word]['ph'] + '">' + word \
+                + "</phoneme>" + line[end:context_end]).strip()
+
+        except KeyError:
+            # If a KeyError occurs, then that means that there is no entry for phonemes[word].
+            # This most likely means that we deleted that as a tricky word, and want the TTS
+            # to just pronounce it as its default method.
+            # Just skip this word and don't have any sentences with this word in the output files.
+            continue
+
+        # print(f"{word}:  {context_sentence}")
+        # print(f"{phonemed_sentence}")
+        # all_sentences_list.append(f"{word}:  {context_sentence}")
+        all_sentences_list.append(f"{phonemed_sentence}")
 
     # print("")
 
@@ -305,68 +546,351 @@ def get_tricky_sentences(file_dir, words_to_check, return_all_matches):
     return all_sentences_list
 
 
-def chunk_text_to_lists(char_limit, text):
-    """Returns an array of text broken on sentence boundaries, with max=char_limit lengths"""
+def _is_chapter_heading(line):
+    stripped = line.strip()
+    return (0 < len(stripped) <= CHAPTER_HEADING_MAX_LEN) and not stripped.endswith(('.', ',', ';', '!', '?', '"', '”', '’')) \
+        and CHAPTER_HEADING.match(stripped) is not None
+
+
+def find_chapter_files(input_dir):
+    '''Returns the paths of any chapter_0.txt, chapter_1.txt, etc. files in input_dir, in chapter order.'''
+
+    chapter_files = []
+    for filename in os.listdir(input_dir):
+        m = CHAPTER_FILE.match(filename)
+        if m:
+            chapter_files.append((int(m.group(1)), os.path.join(input_dir, filename)))
+
+    # Numeric sort, so chapter_10 comes after chapter_9
+    return [path for _, path in sorted(chapter_files)]
+
+
+def split_into_chapters(text):
+    '''Splits a whole book's text on chapter heading lines.  Returns a list of (title, text) tuples, with
+    the heading line kept at the start of its chapter's text.  Anything before the first heading (a preface,
+    foreword, title page..) becomes its own chapter with title None.'''
+
+    chapters = []
+    title = None
+    lines = []
+    for line in text.splitlines(keepends=True):
+        if _is_chapter_heading(line):
+            if lines and ''.join(lines).strip():
+                chapters.append((title, ''.join(lines)))
+            title = line.strip()
+            lines = []
+        lines.append(line)
+
+    if ''.join(lines).strip():
+        chapters.append((title, ''.join(lines)))
+
+    return chapters
+
+
+def _block_end(text):
+    """Where to end a block of streamed text: after the last newline, else at the last whitespace that isn't
+    inside an SSML tag.  0 if there's nowhere safe yet (keep reading)."""
+
+    end = text.rfind("\n") + 1
+    if end:
+        return end
+    idx = len(text)
+    while True:
+        space = max(text.rfind(ch, 0, idx) for ch in " \t\r\f\v")
+        if space == -1:
+            return 0
+        # Whitespace inside a tag, like <phoneme alphabet="ipa" ...>, doesn't count, look before the tag
+        tag_start = text.rfind("<", 0, space)
+        if tag_start > text.rfind(">", 0, space):
+            idx = tag_start
+            continue
+        return space + 1
+
+
+def iter_file_text(filepath, start=0, end=None, block_size=TEXT_READ_BLOCK_SIZE):
+    """Yields the text of a UTF-8 file (or of bytes start:end of it) in blocks of about block_size, without
+    ever reading the whole file in.  Each block ends on a line or word boundary, so no word or SSML tag is
+    split between two blocks.  Line endings are normalized, same as reading the file in text mode."""
+
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf8")(), translate=True)
+    carry = ""
+    with open(filepath, "rb") as fr:
+        fr.seek(start)
+        remaining = end - start if end is not None else None
+        while remaining is None or remaining > 0:
+            data = fr.read(block_size if remaining is None else min(block_size, remaining))
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            text = carry + decoder.decode(data)
+            cut = _block_end(text)
+            if cut == 0 and len(text) > 4 * block_size:
+                # A huge run of text with no whitespace at all, no choice but to cut it anywhere
+                cut = len(text)
+            if cut:
+                yield text[:cut]
+            carry = text[cut:]
+    carry += decoder.decode(b"", final=True)
+    if carry:
+        yield carry
+
+
+@timed_stage("get_book_chapters")
+def get_book_chapters(input_dir):
+    """Finds the chapters of the book in input_dir.  Uses chapter_N.txt files if there are any (see README),
+    otherwise looks for chapter headings inside input.txt.  Returns a list of (name, title, text) tuples,
+    where name is like "chapter_3" and is used to name that chapter's output files."""
+
+    return [(name, title, "".join(blocks)) for name, title, blocks in stream_book_chapters(input_dir)]
+
+
+@timed_stage("stream_book_chapters")
+def stream_book_chapters(input_dir):
+    """Same as get_book_chapters(), but without reading the book into memory.  Returns a list of
+    (name, title, blocks) tuples, where blocks is a generator of the chapter's text (see iter_file_text()).
+    input.txt is scanned for chapter headings once, a line at a time, and each chapter is read back out of
+    its byte range of the file only when its blocks are consumed."""
+
+    chapter_files = find_chapter_files(input_dir)
+    if chapter_files:
+        chapters = []
+        for path in chapter_files:
+            name = os.path.splitext(os.path.basename(path))[0]
+            # Only as far as the first line with anything on it
+            with open(path, 'r', encoding='utf8') as fr:
+                first_line = next((line.strip() for line in iter(lambda: fr.readline(TEXT_READ_BLOCK_SIZE), "")
+                                   if line.strip()), "")
+            title = first_line if _is_chapter_heading(first_line) else name.replace("_", " ").title()
+            chapters.append((name, title, iter_file_text(path)))
+        return chapters
+
+    input_path = os.path.join(input_dir, "input.txt")
+    headings = []               # (byte offset of the heading line, title)
+    preface = False             # Anything but whitespace before the first heading?
+    offset = 0
+    at_line_start = True
+    try:
+        with open(input_path, 'rb') as fr:
+            # readline() with a limit, so even a book that's all one line is never read in whole
+            for line in iter(lambda: fr.readline(TEXT_READ_BLOCK_SIZE), b""):
+                if at_line_start and len(line) <= 4 * CHAPTER_HEADING_MAX_LEN:
+                    text_line = line.decode("utf8", errors="replace")
+                    if _is_chapter_heading(text_line):
+                        headings.append((offset, text_line.strip()))
+                if not headings and line.strip():
+                    preface = True
+                offset += len(line)
+                at_line_start = line.endswith(b"\n")
+    except FileNotFoundError:
+        print(f"Cannot find file path: {input_path}")
+        print("Ensure input file is named 'input.txt' and directory is spelled correctly.")
+        quit()
 
-    # NOTE: If char_limit is unreasonably small, function breaks
+    # (start, end, title) of each chapter, with anything before the first heading (a preface, foreword,
+    # title page..) as its own chapter.  Heading lines are kept at the start of their chapter's text.
+    ranges = [(0, headings[0][0] if headings else offset, None)] if preface else []
+    for n, (start, title) in enumerate(headings):
+        ranges.append((start, headings[n + 1][0] if n + 1 < len(headings) else offset, title))
+
+    # Use _0 for a preface/foreword before the first heading, same as the manual chapter_N.txt convention
+    first_number = 0 if preface else 1
+    chapters = []
+    for number, (start, end, title) in enumerate(ranges, start=first_number):
+        name = f"chapter_{number}"
+        chapters.append((name, title or name.replace("_", " ").title(), iter_file_text(input_path, start, end)))
+    return chapters
+
+
+def count_billed_chars(text):
+    """Characters Polly bills for.  SSML tags aren't billed, everything else is."""
+    return len(text) - sum(len(m.group()) for m in SSML_TAG.finditer(text))
+
+
+def _protected_spans(text):
+    """(start, end) spans a chunk must never be split inside: every SSML tag, and everything from an
+    opening tag to its closing tag (so a <phoneme ...>word</phoneme> always stays in one piece)."""
+
+    spans = []
+    depth = 0
+    element_start = None
+    for m in SSML_TAG.finditer(text):
+        tag = m.group()
+        spans.append((m.start(), m.end()))
+
+        if tag.startswith('</'):
+            depth = max(depth - 1, 0)
+            if depth == 0 and element_start is not None:
+                spans.append((element_start, m.end()))
+                element_start = None
+        elif not tag.endswith('/>') and not tag.startswith(('<!', '<?')):
+            if depth == 0:
+                element_start = m.start()
+            depth += 1
+
+    return sorted(spans)
+
+
+def _cut_points(text, spans, pattern, start=0, end=None):
+    """Offsets in text[start:end] right after each pattern match, skipping any that land inside a protected span."""
+
+    cuts = []
+    span_idx = 0
+    for m in pattern.finditer(text, start, len(text) if end is None else end):
+        cut = m.end()
+        while span_idx < len(spans) and spans[span_idx][1] <= cut:
+            span_idx += 1
+        # spans are sorted by start, so the first one that hasn't ended yet encloses cut if it started before it
+        if span_idx < len(spans) and spans[span_idx][0] < cut:
+            continue
+        cuts.append(cut)
+    return cuts
+
+
+def _pack_pieces(billed, total, billed_limit, total_limit, target=None):
+    """Greedily packs consecutive pieces into chunks under both limits.  With a target, each chunk closes at
+    whichever piece leaves it closest to target billed characters.  Returns a list of (first, last+1) piece ranges."""
+
+    ranges = []
+    first = 0
+    chunk_billed = chunk_total = 0
+    for idx in range(len(billed)):
+        if idx > first:
+            over_limit = chunk_billed + billed[idx] > billed_limit or chunk_total + total[idx] > total_limit
+            past_target = target is not None and chunk_billed + billed[idx] > target \
+                and (chunk_billed + billed[idx] - target) > (target - chunk_billed)
+            if over_limit or past_target:
+                ranges.append((first, idx))
+                first = idx
+                chunk_billed = chunk_total = 0
+        chunk_billed += billed[idx]
+        chunk_total += total[idx]
+
+    if len(billed) > first:
+        ranges.append((first, len(billed)))
+    return ranges
+
+
+def _check_char_limit(char_limit):
+    # NOTE: If char_limit is unreasonably small, chunking breaks
     if char_limit < 50:
         print("ERROR: Use larger text chunking limit to support chunk_text_to_lists().")
         print(f"AWS Polly supports up to roughly 3000 characters at a time.  You used {char_limit}. Quitting.")
         quit()
-    
-    # https://www.regular-expressions.info/lookaround.html
-    # https://stackoverflow.com/questions/12689046/multiple-negative-lookbehind-assertions-in-python-regex/12689275
-    # s = """Hello. This sentence ends with a letter. It's good to meet you, Mr. Makamoto!  I've heard great things, and have you met my wife, Mrs. Baby, shes awesome and
-    # my name is Dr. Bob. Would you take a seat, please?  Please, Ms. Jane."""
-    # re.split(r"(?<!Mr)(?<!Dr)(?<!Mrs)(?<!Ms)[.\n]", s)
-    # ['Hello', ' This sentence ends with a letter', " It's good to meet you, Mr. Makamoto!  I've heard great things, and have you met my wife, Mrs. Baby, shes awesome and", 'my name is Dr. Bob', ' Would you take a seat, please?  Please, Ms. Jane', '']
-
-    # Split the sentences on dots AND newlines, UNLESS dot is preceded by an honorific title, like Mrs., Mr., or Dr.
-    sentences = re.split(r"(?<!Mr)(?<!Dr)(?<!Mrs)(?<!Ms)(?<!Miss)[.\n]", text)
-
-    # Split the sentences on dots ONLY (no newlines), UNLESS dot is preceded by an honorific title, like Mrs., Mr., or Dr.
-    # sentences = re.split(r"(?<!Mr)(?<!Dr)(?<!Mrs)(?<!Ms)(?<!Miss)[.]", text)
-
-    # Split text on periods first
-    # old way:
-    # sentences = text.split('.')
-    
-    # doesn't include the periods
-    # print(f"{sentences[0]}")
-    # print(f"{sentences[-1]}")
 
-    all_chunks = []
-  
-    # Iterate over all the sentences
-    cur_string = ''
-    for next_sentence in sentences:
-        # If adding the next sentence to the current string would exceed the limit,
-        # start a new string
-        if (len(cur_string) + len(next_sentence)) >= char_limit:
-            # First add the current string to list of chunks
-            all_chunks.append(cur_string)
-
-            # Start new list, seed it with this next sentence since we've already iterated on it, with period
-            cur_string = next_sentence + '.'
-        else:
-            # Otherwise, we can safely add it to the current string, plus trailing period which was stripped
-            cur_string += (next_sentence + '.')
-    else:
-        # This runs at the end of the for loop
-        # Don't forget to append final cur_string
-        all_chunks.append(cur_string)
 
-    # print(all_chunks[0][-60:])
-    # print("")
-    # print(all_chunks[1][-60:])
-    # print("")
-    # print(all_chunks[2][-60:])
-    # print("")
-    # print(all_chunks[-2][-60:])
-    # print("")
-    # print(all_chunks[-1][-60:])
+def _chunk_ranges(text, char_limit, total_char_limit, balance):
+    """(start, end) offsets of each chunk in text, see chunk_text_to_lists().  The ranges are back to back and
+    cover all of text, surrounding whitespace included."""
+
+    # Sentences end at . ! ? (plus any closing quotes) followed by whitespace, UNLESS the dot is preceded by an
+    # honorific title, like Mrs., Mr., or Dr.  Newlines end a sentence too.  The text itself is left as-is,
+    # and never split inside an SSML tag or element, e.g. the dot in ph="ˈpi.kæn".
+    spans = _protected_spans(text)
+    cuts = [0] + _cut_points(text, spans, SENTENCE_BOUNDARY) + [len(text)]
+
+    # Break up any sentence that's too long on its own at whitespace, and worst case anywhere at all
+    pieces = []
+    for start, end in zip(cuts, cuts[1:]):
+        if start == end:
+            continue
+        if count_billed_chars(text[start:end]) <= char_limit and end - start <= total_char_limit:
+            pieces.append((start, end))
+            continue
+        sub_cuts = [start] + _cut_points(text, spans, WORD_BOUNDARY, start, end) + [end]
+        for sub_start, sub_end in zip(sub_cuts, sub_cuts[1:]):
+            for hard_start in range(sub_start, sub_end, char_limit):
+                pieces.append((hard_start, min(hard_start + char_limit, sub_end)))
+
+    # Billed/total size of each piece, via tag spans so the whole text is only walked once
+    tag_spans = [(m.start(), m.end()) for m in SSML_TAG.finditer(text)]
+    billed = []
+    total = []
+    tag_idx = 0
+    for start, end in pieces:
+        tag_chars = 0
+        while tag_idx < len(tag_spans) and tag_spans[tag_idx][0] < end:
+            tag_chars += min(tag_spans[tag_idx][1], end) - max(tag_spans[tag_idx][0], start)
+            if tag_spans[tag_idx][1] > end:
+                break
+            tag_idx += 1
+        billed.append((end - start) - tag_chars)
+        total.append(end - start)
+
+    ranges = _pack_pieces(billed, total, char_limit, total_char_limit)
+
+    if balance and len(ranges) > 1:
+        # Same number of chunks, just evened out.  If evening out ever costs an extra request, don't.
+        target = sum(billed) / len(ranges)
+        balanced_ranges = _pack_pieces(billed, total, char_limit, total_char_limit, target=target)
+        if len(balanced_ranges) <= len(ranges):
+            ranges = balanced_ranges
+
+    return [(pieces[first][0], pieces[last - 1][1]) for first, last in ranges]
+
+
+def _range_chunk(text, start, end):
+    """The chunk text[start:end] is sent as, and whether a paragraph ends after it: a line break before the
+    next text, same as SENTENCE_BOUNDARY treats every line as its own paragraph."""
+    raw = text[start:end]
+    after = start + len(raw.rstrip())
+    return raw.strip(), "\n" in WHITESPACE_RUN.match(text, after).group()
+
+
+@timed_stage("chunk_text_to_lists")
+def chunk_text_to_lists(char_limit, text, total_char_limit=None, balance=True, with_breaks=False):
+    """Returns an array of text broken on sentence boundaries.  Each chunk has at most char_limit billed
+    characters (SSML tags aren't billed) and total_char_limit characters counting the tags (default 2x
+    char_limit, same ratio as Polly's 3000/6000).  With balance=True, chunks are evened out to about the
+    same size without using any more of them, so parallel requests finish at about the same time.
+    With with_breaks=True each one is a (chunk, ends a paragraph) tuple instead, for the gaps between chunks
+    (see audio_postprocess.py)."""
+
+    _check_char_limit(char_limit)
+
+    if total_char_limit is None:
+        total_char_limit = 2 * char_limit
+
+    # Slices of the original text, not string building, so this stays linear in the size of the book
+    all_chunks = []
+    for start, end in _chunk_ranges(text, char_limit, total_char_limit, balance):
+        chunk, paragraph = _range_chunk(text, start, end)
+        if chunk:
+            all_chunks.append((chunk, paragraph) if with_breaks else chunk)
 
     return all_chunks
+
+
+def iter_text_chunks(blocks, char_limit, total_char_limit=None, with_breaks=False):
+    """Generator version of chunk_text_to_lists() for text that's streamed in, e.g. from iter_file_text().
+    Yields each chunk as soon as the text after it has been read, so memory use only depends on the block
+    size, not the size of the book.  Blocks must end on a word boundary and outside any SSML element.
+
+    Chunks are packed greedily rather than balanced, since that would need the whole text up front."""
+
+    _check_char_limit(char_limit)
+
+    if total_char_limit is None:
+        total_char_limit = 2 * char_limit
+
+    buffer = ""
+    for block in blocks:
+        buffer += block
+        # Enough for at least two chunks, so the first one can't change with whatever is read next
+        if len(buffer) < 2 * total_char_limit:
+            continue
+        ranges = _chunk_ranges(buffer, char_limit, total_char_limit, balance=False)
+        # The last chunk could still grow (or its last sentence still be unfinished), so it stays in the buffer
+        for start, end in ranges[:-1]:
+            chunk, paragraph = _range_chunk(buffer, start, end)
+            if chunk:
+                yield (chunk, paragraph) if with_breaks else chunk
+        buffer = buffer[ranges[-1][0]:]
+
+    for start, end in _chunk_ranges(buffer, char_limit, total_char_limit, balance=False):
+        chunk, paragraph = _range_chunk(buffer, start, end)
+        if chunk:
+            yield (chunk, paragraph) if with_breaks else chunk
    
 
 
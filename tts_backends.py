@@ -0,0 +1,372 @@
+"""Speech synthesis backends.  save_polly_speech() talks to one of these instead of to boto3 directly,
+so the same pipeline can run against AWS Polly or against a local fake with no network or credentials."""
+
+import bisect
+import hashlib
+import io
+import json
+import math
+import re
+import struct
+import threading
+import time
+
+from audio_utils import PCM_SAMPLE_RATE, PCM_SAMPLE_WIDTH
+
+# GLOBALS
+
+AWS_POLLY_REGION = "us-west-2"
+AWS_POLLY_POOL_CONNECTIONS = 10     # HTTP connections the client keeps open, botocore's default.  Size it to
+                                    # the number of requests in flight, or the extras pay for a new TLS handshake.
+
+# Error codes worth retrying.  Anything else (bad SSML, text too long..) fails the same way every time.
+AWS_TRANSIENT_ERROR_CODES = {"ThrottlingException", "Throttling", "TooManyRequestsException", "RequestTimeout",
+                             "RequestTimeoutException", "ServiceFailureException", "ServiceUnavailableException",
+                             "ServiceUnavailable", "InternalFailure"}
+
+# Roughly how fast the neural voices read, used by FakeBackend to make audio of a realistic length
+FAKE_CHARS_PER_SECOND = 15
+
+# One silent MPEG-2 Layer III frame: 24000 Hz, 48 kbps, mono, same as Polly's neural mp3 output.
+# All-zero side info decodes to silence.  576 samples = 24 ms per frame, 72 * 48000 / 24000 = 144 bytes.
+SILENT_MP3_FRAME = b"\xff\xf3\x64\xc0" + b"\x00" * 140
+SILENT_MP3_FRAME_SECONDS = 576 / 24000
+
+# What FakeBackend calls a word in its speech marks.  Like Polly, punctuation isn't part of a word.
+FAKE_SPEECH_MARK_WORD = re.compile(r"[^\W_]+(?:['’.-][^\W_]+)*")
+
+
+class SynthesisError(Exception):
+    """A backend couldn't synthesize a chunk.  transient=True means trying again later may well work
+    (throttling, network blip), False means it'll fail the same way every time (bad SSML, etc.)."""
+
+    def __init__(self, message, code=None, transient=False):
+        super().__init__(message)
+        self.code = code
+        self.transient = transient
+        self.attempts = None    # Filled in by the caller once it gives up retrying
+
+
+class SynthesisResult:
+    """What a backend hands back for one chunk: a readable binary audio stream (close it when done!)
+    plus whatever the service told us about the request."""
+
+    def __init__(self, audio_stream, content_type, request_characters=None, request_id=None, metadata=None):
+        self.audio_stream = audio_stream
+        self.content_type = content_type
+        self.request_characters = request_characters  # Billed characters, as reported by the service
+        self.request_id = request_id
+        self.metadata = metadata or {}
+
+
+class PollyBackend:
+    """AWS Polly.  The boto3 client is only created on the first request, so nothing here needs
+    boto3 installed or AWS credentials set until audio is actually requested.  After that the one
+    client (and its pool of kept-alive connections) is shared by every request, from every thread."""
+
+    name = "polly"
+
+    def __init__(self, region_name=AWS_POLLY_REGION, client=None, max_pool_connections=AWS_POLLY_POOL_CONNECTIONS):
+        # Pass client to use one you made yourself, e.g. under moto's mock_aws() for testing
+        self.region_name = region_name
+        self.max_pool_connections = max_pool_connections
+        self._client = client
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                try:
+                    import boto3
+                    from botocore.config import Config
+                    import config   # Loads secret environment variables as globals
+                except (ImportError, RuntimeError) as error:
+                    # boto3 isn't installed, or the AWS keys aren't set.  No point retrying either.
+                    raise SynthesisError(f"Could not create the Polly client: {error}", code=type(error).__name__) from error
+
+                # Get the Polly client.  Connections are pooled and kept alive, so concurrent requests
+                # reuse them instead of each paying for a new TCP + TLS handshake.
+                self._client = boto3.Session(aws_access_key_id=config.AWS_ACCESS_KEY_ID,
+                                             aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
+                                             region_name=self.region_name).client(
+                    'polly', config=Config(max_pool_connections=self.max_pool_connections, tcp_keepalive=True))
+            return self._client
+
+    def synthesize(self, text, voice_id, output_format, engine="neural", sample_rate=None, text_type="text",
+                   lexicon_names=None, speech_mark_types=None):
+        """Requests speech for one chunk.  Returns a SynthesisResult, or None if the response had no audio.
+        With output_format "json", the stream is the chunk's speech marks of speech_mark_types (e.g. ["sentence",
+        "word"]) instead, one JSON object per line.  Raises SynthesisError if the request fails."""
+
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        args = {"Text": text, "Engine": engine, "OutputFormat": output_format, "VoiceId": voice_id,
+                "TextType": text_type}
+        if sample_rate is not None:
+            # Polly only takes SampleRate as a string
+            args["SampleRate"] = str(sample_rate)
+        if lexicon_names:
+            args["LexiconNames"] = list(lexicon_names)
+        if output_format == "json":
+            args["SpeechMarkTypes"] = list(speech_mark_types or ("sentence", "word"))
+
+        try:
+            # Request speech synthesis
+            response = self._get_client().synthesize_speech(**args)
+        except (BotoCoreError, ClientError) as error:
+            raise _polly_synthesis_error(error) from error
+
+        # Example response:
+        # {
+        #     'ResponseMetadata':
+        #         {
+        #             'RequestId': '260e15d3-1515-456a-aaca-1d5343fd90cf',
+        #             'HTTPStatusCode': 200,
+        #             'HTTPHeaders': {
+        #                             'x-amzn-requestid': '260e15d3-1515-456a-aaca-1d5343fd90cf',
+        #                             'x-amzn-requestcharacters': '12',
+        #                             'content-type': 'audio/mpeg',
+        #                             'transfer-encoding': 'chunked',
+        #                             'date': 'Fri, 17 Dec 2021 17:53:39 GMT'
+        #                             },
+        #             'RetryAttempts': 0
+        #         },
+        #     'ContentType': 'audio/mpeg',
+        #     'RequestCharacters': '12',
+        #     'AudioStream': <botocore.response.StreamingBody object at 0x00000237EE8D2B80>
+        # }
+
+        if "AudioStream" not in response:
+            return None
+
+        response_metadata = response.get("ResponseMetadata", {})
+        # Same number as the x-amzn-requestcharacters header, which is what we're billed for
+        request_characters = response.get("RequestCharacters") or \
+            response_metadata.get("HTTPHeaders", {}).get("x-amzn-requestcharacters")
+        return SynthesisResult(audio_stream=_PollyStream(response["AudioStream"]),
+                               content_type=response.get("ContentType"),
+                               request_characters=int(request_characters) if request_characters else None,
+                               request_id=response_metadata.get("RequestId"),
+                               metadata={"retry_attempts": response_metadata.get("RetryAttempts", 0)})
+
+    def get_lexicon(self, name):
+        """Content of the uploaded lexicon called name, or None if there isn't one."""
+
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            response = self._get_client().get_lexicon(Name=name)
+        except ClientError as error:
+            if error.response.get("Error", {}).get("Code") == "LexiconNotFoundException":
+                return None
+            raise _polly_synthesis_error(error) from error
+        except BotoCoreError as error:
+            raise _polly_synthesis_error(error) from error
+        return response.get("Lexicon", {}).get("Content")
+
+    def put_lexicon(self, name, content):
+        """Uploads (or replaces) a PLS lexicon document."""
+
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            self._get_client().put_lexicon(Name=name, Content=content)
+        except (BotoCoreError, ClientError) as error:
+            raise _polly_synthesis_error(error) from error
+
+
+class _PollyStream:
+    """Wraps botocore's StreamingBody so errors while reading the body (connection dropped, read timeout)
+    come out as SynthesisError too, and can be retried like any other."""
+
+    def __init__(self, body):
+        self._body = body
+
+    def read(self, amt=None):
+        from botocore.exceptions import BotoCoreError, ClientError
+        try:
+            return self._body.read(amt)
+        except (BotoCoreError, ClientError) as error:
+            raise _polly_synthesis_error(error) from error
+
+    def close(self):
+        self._body.close()
+
+
+def _polly_synthesis_error(error):
+    """Turns a BotoCoreError/ClientError into a SynthesisError, working out whether it's worth retrying."""
+
+    from botocore.exceptions import ClientError, ParamValidationError, NoCredentialsError
+
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        transient = code in AWS_TRANSIENT_ERROR_CODES or status == 429 or status >= 500
+    else:
+        # BotoCoreErrors are mostly connection errors, read timeouts and cut-off responses.
+        # Bad parameters or missing credentials won't fix themselves though.
+        code = type(error).__name__
+        transient = not isinstance(error, (ParamValidationError, NoCredentialsError))
+
+    return SynthesisError(str(error), code=code, transient=transient)
+
+
+class FakeBackend:
+    """Deterministic, in-process stand-in for Polly, for benchmarking and testing with no network.
+
+    Produces valid audio (silent mp3 frames, or pcm silence/tone) about as long as the real voice would
+    take to read the text.  Each request takes `latency` seconds (+ up to `latency_jitter`), and fails with
+    a transient error `error_rate` of the time, or always if its text contains one of `fail_on`.
+    Whether a given request fails only depends on its text and how many times it's been tried, so runs
+    are repeatable no matter what order the worker threads get to them in."""
+
+    name = "fake"
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0, fail_on=(), tone_hz=None,
+                 chars_per_second=FAKE_CHARS_PER_SECOND, seed=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.fail_on = tuple(fail_on)
+        self.tone_hz = tone_hz
+        self.chars_per_second = chars_per_second
+        self.seed = seed
+        self.requests = 0
+        self.lexicons = {}      # name -> PLS content, like the service's uploaded lexicons
+        self._attempts = {}     # text hash -> times requested
+        self._lock = threading.Lock()
+
+    def _draw(self, text_hash, attempt, salt):
+        """Repeatable pseudo-random number in [0, 1) for this text/attempt."""
+        digest = hashlib.sha256(f"{self.seed}:{salt}:{attempt}:{text_hash}".encode("utf8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2**64
+
+    def get_lexicon(self, name):
+        return self.lexicons.get(name)
+
+    def put_lexicon(self, name, content):
+        self.lexicons[name] = content
+
+    def synthesize(self, text, voice_id, output_format, engine="neural", sample_rate=None, text_type="text",
+                   lexicon_names=None, speech_mark_types=None):
+        from text_utils import count_billed_chars
+
+        text_hash = hashlib.sha256(text.encode("utf8")).hexdigest()
+        with self._lock:
+            self.requests += 1
+            attempt = self._attempts.get(text_hash, 0)
+            self._attempts[text_hash] = attempt + 1
+
+        time.sleep(self.latency + self.latency_jitter * self._draw(text_hash, attempt, "latency"))
+
+        missing = [name for name in lexicon_names or () if name not in self.lexicons]
+        if missing:
+            raise SynthesisError(f"Lexicon not found: {', '.join(missing)}", code="LexiconNotFoundException")
+        if any(marker in text for marker in self.fail_on):
+            raise SynthesisError("Fake permanent failure", code="InvalidSsmlException", transient=False)
+        if self._draw(text_hash, attempt, "error") < self.error_rate:
+            raise SynthesisError("Fake throttling", code="ThrottlingException", transient=True)
+
+        billed = count_billed_chars(text) if text_type == "ssml" else len(text)
+        seconds = billed / self.chars_per_second
+
+        if output_format == "json":
+            marks = _fake_speech_marks(text, text_type, self.chars_per_second, speech_mark_types or ("sentence", "word"))
+            audio = "".join(json.dumps(mark) + "\n" for mark in marks).encode("utf8")
+            content_type = "application/x-json-stream"
+        elif output_format == "pcm":
+            audio = _pcm_audio(seconds, int(sample_rate or PCM_SAMPLE_RATE), self.tone_hz)
+            content_type = "audio/pcm"
+        elif output_format == "mp3":
+            audio = SILENT_MP3_FRAME * max(1, math.ceil(seconds / SILENT_MP3_FRAME_SECONDS))
+            content_type = "audio/mpeg"
+        else:
+            raise SynthesisError(f"FakeBackend can't make {output_format} audio", code="ValidationException")
+
+        return SynthesisResult(audio_stream=io.BytesIO(audio), content_type=content_type, request_characters=billed,
+                               request_id=f"fake-{text_hash[:16]}-{attempt}", metadata={"retry_attempts": 0})
+
+
+def _pcm_audio(seconds, sample_rate, tone_hz=None):
+    """Signed 16-bit little-endian mono samples, silent or a quiet sine tone."""
+
+    n_samples = int(seconds * sample_rate)
+    if not tone_hz:
+        return b"\x00" * (n_samples * PCM_SAMPLE_WIDTH)
+
+    # One period, repeated.  Close enough for a test tone and far cheaper than computing every sample.
+    period = max(1, round(sample_rate / tone_hz))
+    cycle = struct.pack(f"<{period}h", *(int(3000 * math.sin(2 * math.pi * i / period)) for i in range(period)))
+    repeats, remainder = divmod(n_samples, period)
+    return cycle * repeats + cycle[:remainder * PCM_SAMPLE_WIDTH]
+
+
+def _fake_speech_marks(text, text_type, chars_per_second, types):
+    """Speech marks like Polly's for text read at chars_per_second: {"time": ms, "type", "start", "end", "value"},
+    start/end being UTF-8 byte offsets into the request text.  SSML tags are skipped, and don't take any time."""
+
+    from text_utils import SSML_TAG, SENTENCE_BOUNDARY
+
+    tags = [m.span() for m in SSML_TAG.finditer(text)] if text_type == "ssml" else []
+    tag_starts = [start for start, _ in tags]
+    tag_ends = [end for _, end in tags]
+    tag_chars = [0]     # Tag characters before the end of each tag
+    for start, end in tags:
+        tag_chars.append(tag_chars[-1] + end - start)
+
+    def in_tag(pos):
+        i = bisect.bisect_right(tag_starts, pos) - 1
+        return i >= 0 and pos < tag_ends[i]
+
+    def millis(pos):
+        return int((pos - tag_chars[bisect.bisect_right(tag_ends, pos)]) / chars_per_second * 1000)
+
+    # Sentences start after each boundary, words are runs of non-space outside the tags
+    spans = []
+    if "sentence" in types:
+        boundaries = [0] + [m.end() for m in SENTENCE_BOUNDARY.finditer(text)]
+        for start, end in zip(boundaries, boundaries[1:] + [len(text)]):
+            start = _first_text(text, start, in_tag)
+            while end > start and (text[end - 1].isspace() or in_tag(end - 1)):
+                end -= 1
+            if start < end:
+                spans.append((start, "sentence", end))
+    if "word" in types:
+        for m in FAKE_SPEECH_MARK_WORD.finditer(text):
+            if not in_tag(m.start()):
+                spans.append((m.start(), "word", m.end()))
+    spans.sort(key=lambda span: (span[0], span[1] == "word"))
+
+    # Byte offsets, counted up as the spans go by since they're in order
+    marks = []
+    pos, byte_pos = 0, 0
+    for start, kind, end in spans:
+        byte_pos += len(text[pos:start].encode("utf8"))
+        pos = start
+        value = text[start:end]
+        marks.append({"time": millis(start), "type": kind, "start": byte_pos,
+                      "end": byte_pos + len(value.encode("utf8")), "value": value})
+    return marks
+
+
+def _first_text(text, pos, in_tag):
+    # Where the text from pos on starts, past any whitespace and tags
+    while pos < len(text) and (text[pos].isspace() or in_tag(pos)):
+        pos += 1
+    return pos
+
+
+# Backends by name, for make_backend()
+BACKENDS = {
+    PollyBackend.name: PollyBackend,
+    FakeBackend.name: FakeBackend,
+}
+
+
+def make_backend(name, **kwargs):
+    """Creates a backend by name ("polly" or "fake").  kwargs go to its constructor."""
+
+    if name not in BACKENDS:
+        print(f"ERROR: Unknown synthesis backend: {name}.  Choose from: {', '.join(BACKENDS)}")
+        quit()
+    return BACKENDS[name](**kwargs)
@@ -1,12 +1,25 @@
-import boto3
-from botocore.exceptions import BotoCoreError, ClientError
-from contextlib import closing
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import closing, contextmanager
+from time import sleep, monotonic
+import random
+import heapq
+import itertools
+import tempfile
+import threading
+import json
+import csv
 import os
 
-from text_utils import chunk_text_to_lists
-
-import config # Loads secret environment variables as globals
+from text_utils import chunk_text_to_lists, iter_text_chunks, count_billed_chars
+from synthesis_cache import SynthesisCache
+from synthesis_manifest import SynthesisManifest, CHUNK_DONE, CHUNK_FAILED, MANIFEST_SAVE_INTERVAL
+from audio_utils import AudioFileWriter, copy_stream, AUDIO_FILE_EXTENSIONS, PCM_SAMPLE_RATE, WAV_HEADER_SIZE, \
+    PARTIAL_SUFFIX, PLAYBACK_INDEX_SUFFIX
+from tts_backends import PollyBackend, SynthesisError, make_backend
+from speech_marks import build_speech_mark_index, SPEECH_MARK_TYPES, SPEECH_MARK_INDEX_SUFFIX, SPEECH_MARK_SPOOL_SUFFIX
+from synthesis_plan import load_latency_model, PLAN_REQUEST, PLAN_CACHED, PLAN_SPLICED, PLAN_RESUMED
+from metrics import METRICS, timed_stage
 
 # import os
 # import sys
@@ -15,91 +28,764 @@ import config # Loads secret environment variables as globals
 
 # GLOBALS
 
-# Secrets are loaded from environment variables in config.py
+# Secrets are loaded from environment variables in config.py, but only once PollyBackend makes its first request
 AWS_DEFAULT_POLLY_VOICE = "Matthew"
-AWS_POLLY_TEXT_LIMIT = 2500 # 6000 characters, of which no more than 3000 can be "billed characters"
-                            # You aren't billed for lexicon/SSML markup, so like 3000 real characters.
-                            # So 3000 characters is the longest text you can send without a more complicated API.  
-                            # Set lower to accomodate for adding '.' back in and some margin.
+AWS_POLLY_BILLED_CHAR_LIMIT = 3000  # 6000 characters, of which no more than 3000 can be "billed characters"
+AWS_POLLY_TOTAL_CHAR_LIMIT = 6000   # You aren't billed for lexicon/SSML markup, so SSML-heavy text can still
+                                    # send a full 3000 real characters.  The chunker counts both exactly.
+SSML_WRAPPER = ("<speak>", "</speak>")  # Room to leave in the total for wrapping a chunk as SSML
+AWS_POLLY_MAX_TPS = 8       # Neural voice SynthesizeSpeech limit is 8 transactions / second..
+AWS_POLLY_BURST_TPS = 10    # ..with bursts of up to 10 allowed
+AWS_POLLY_MAX_CONNECTIONS = 8   # Concurrent requests in flight.  Service throttles on parallel connections,
+                                # and botocore's default connection pool is 10, so stay under both.
+AWS_POLLY_MAX_RETRIES = 6       # Retries of a chunk after a transient error (throttling, network blip)
+AWS_POLLY_BACKOFF_BASE = 0.5    # Seconds.  Backoff before retry N is random(0, base * 2^N)..
+AWS_POLLY_BACKOFF_CAP = 20      # ..but never more than this
+DEFAULT_PRIORITY = 0            # For POLLY_CONNECTION_LIMITER, lower numbers go first
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter.  Each request takes one token, tokens refill at
+    `rate` per second and up to `capacity` can be saved up for a burst."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then takes it.  Returns the seconds spent waiting."""
+        start = monotonic()
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return now - start
+                wait = (1 - self._tokens) / self.rate
+            # Sleep outside the lock so other workers can check in too
+            sleep(wait)
+
+
+class PrioritySemaphore:
+    """Like threading.BoundedSemaphore, except that when several threads are waiting, the one with the lowest
+    priority number gets the next slot (first come first served within a priority).  Used as a context
+    manager it waits at DEFAULT_PRIORITY, use slot() to pick the priority."""
+
+    def __init__(self, value):
+        self.value = value
+        self._free = value
+        self._waiting = []      # Heap of (priority, ticket) for the threads waiting on a slot
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, priority=DEFAULT_PRIORITY):
+        with self._cond:
+            waiter = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, waiter)
+            while self._free == 0 or self._waiting[0] != waiter:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._free -= 1
+            # If there's another free slot, the next in line can have it
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            if self._free >= self.value:
+                raise ValueError("PrioritySemaphore released too many times")
+            self._free += 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority=DEFAULT_PRIORITY):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _backoff_delay(attempt):
+    """Exponential backoff with full jitter, so throttled workers don't all retry at the same moment."""
+    return random.uniform(0, min(AWS_POLLY_BACKOFF_CAP, AWS_POLLY_BACKOFF_BASE * 2 ** attempt))
+
+
+# Shared by every synthesis call in this process, so running several books/chapters at once
+# still adds up to one account-wide request rate.
+POLLY_RATE_LIMITER = TokenBucket(rate=AWS_POLLY_MAX_TPS, capacity=AWS_POLLY_BURST_TPS)
+
+# Same idea for connections: however many save_polly_speech() calls run at once, no more than
+# AWS_POLLY_MAX_CONNECTIONS requests are in flight in total.  When they're all busy, the next free one goes
+# to the waiting request with the lowest priority number, so e.g. a batch's previews jump ahead of its
+# full renders (see batch.py).
+POLLY_CONNECTION_LIMITER = PrioritySemaphore(AWS_POLLY_MAX_CONNECTIONS)
+
+# How many chapters save_chapters_polly_speech() works on at once.  Requests are still limited by the
+# two limiters above, this just keeps enough chapters going to keep every connection busy.
+MAX_PARALLEL_CHAPTERS = 4
+
+# Chunks of a book read ahead per worker thread, see save_polly_speech().  Enough to keep every worker busy
+# while the oldest chunk is written out, without reading (and holding) any more of the book than that.
+STREAM_CHUNKS_PER_WORKER = 2
+
+# Audio for chunks we've already synthesized, so re-runs while iterating on the lexicon only pay
+# for the chunks whose text actually changed.
+SYNTHESIS_CACHE = SynthesisCache()
+
+# Backend used when save_polly_speech() isn't given one: Polly, or set TTS_BACKEND=fake to run the whole
+# pipeline offline.  Created on first use, so importing this module never needs AWS credentials.
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def get_default_backend():
+    global _default_backend
+    with _default_backend_lock:
+        if _default_backend is None:
+            name = os.environ.get("TTS_BACKEND", PollyBackend.name)
+            # Enough pooled connections for every request POLLY_CONNECTION_LIMITER lets through at once
+            kwargs = {"max_pool_connections": POLLY_CONNECTION_LIMITER.value} if name == PollyBackend.name else {}
+            _default_backend = make_backend(name, **kwargs)
+        return _default_backend
+
+
+def synthesize_chunk(text, cache_key, backend, voice_id, output_format="mp3", text_type="text", lexicon_names=None,
+                     use_cache=True, label="", chunk_no=1, total_chunks=1, priority=DEFAULT_PRIORITY,
+                     speech_mark_types=None):
+    """Synthesizes one request's worth of text to a file, from SYNTHESIS_CACHE if it's there, retrying transient
+    errors with backoff.  Returns (path, cache_key, attempts), or None if the response had no audio.  cache_key
+    is None when path is a temp file; either way hand the result to release_chunk() once it's been copied.
+    Raises SynthesisError if it still fails.  label and chunk_no/total_chunks are only for progress output.
+    priority is this request's place in line for a connection, see POLLY_CONNECTION_LIMITER.
+    With output_format="json" the file holds the text's speech marks of speech_mark_types instead of audio."""
+
+    if use_cache:
+        # Pinned, so it can't be evicted before the writer gets to it
+        path = SYNTHESIS_CACHE.lookup(cache_key, pin=True)
+        if path is not None:
+            print(f"  [{label}] cached synthesis of length: {len(text)} chars..  ({chunk_no}/{total_chunks})")
+            METRICS.record_cache_hit(label, chunk_no)
+            return (path, cache_key, 0)
+
+    for attempt in range(AWS_POLLY_MAX_RETRIES + 1):
+        try:
+            # Holds a connection slot until the response stream is closed
+            with POLLY_CONNECTION_LIMITER.slot(priority):
+                return _request_chunk(text, cache_key, backend, voice_id, output_format, text_type, lexicon_names,
+                                      use_cache, label, chunk_no, total_chunks, attempt, speech_mark_types)
+
+        except SynthesisError as error:
+            # Throttling and network blips are retried, anything else fails this chunk right away
+            if attempt == AWS_POLLY_MAX_RETRIES or not error.transient:
+                error.attempts = attempt + 1
+                raise
+            delay = _backoff_delay(attempt)
+            print(f"  [{label}] retrying chunk {chunk_no} in {delay:.1f}s after error: {error}")
+            METRICS.record_retry(label, chunk_no, attempt + 1, delay, error.code)
+            sleep(delay)
 
 
-def save_polly_speech(basename, text, output_path, voice_id=AWS_DEFAULT_POLLY_VOICE):
-    """Saves an .mp3 of speech corresponding to the text input."""
+def _request_chunk(text, cache_key, backend, voice_id, output_format, text_type, lexicon_names, use_cache,
+                   label, chunk_no, total_chunks, attempt, speech_mark_types=None):
+    """One synthesize_speech request, streamed to disk.  Same return value as synthesize_chunk()."""
 
-    # Get the Polly client
+    # Wait our turn.  Replaces the old fixed sleep(0.15) between sequential requests.
+    rate_limit_wait = POLLY_RATE_LIMITER.acquire()
+
+    print(f"  [{label}] requesting synthesis of length: {len(text)} chars..  ({chunk_no}/{total_chunks})")
+    start = monotonic()
+    latency = None
     try:
-        polly = boto3.Session(  aws_access_key_id=AWS_ACCESS_KEY_ID,
-                                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                                region_name='us-west-2').client('polly')
-    except:
-        print("ERROR: could not get polly client.")
-        quit()
+        # Request speech synthesis.  Neural mp3 defaults to 24000 Hz, pcm to 16000.
+        result = backend.synthesize(text=text, voice_id=voice_id, output_format=output_format, engine="neural",
+                                    sample_rate=PCM_SAMPLE_RATE if output_format == "pcm" else None,
+                                    text_type=text_type, lexicon_names=lexicon_names,
+                                    speech_mark_types=speech_mark_types)
+        latency = monotonic() - start
+        if result is None:
+            METRICS.record_request(label, chunk_no, attempt + 1, latency, rate_limit_wait=rate_limit_wait,
+                                   error="NoAudioStream")
+            return None
+
+        # Note: Closing the stream is important because the service throttles on the
+        # number of parallel connections. Here we are using contextlib.closing to
+        # ensure the close method of the stream object will be called automatically
+        # at the end of the with statement's scope.
+        with closing(result.audio_stream) as stream:
+            # Copy the body to disk a block at a time.  Reading the whole stream here would hold
+            # every chunk that finishes ahead of the writer in memory.
+            if use_cache:
+                path = SYNTHESIS_CACHE.put_stream(cache_key, stream, pin=True)
+            else:
+                with tempfile.NamedTemporaryFile(suffix="." + output_format, delete=False) as spool:
+                    try:
+                        copy_stream(stream, spool)
+                    except BaseException:
+                        spool.close()
+                        os.remove(spool.name)
+                        raise
+                path = spool.name
+    except SynthesisError as error:
+        METRICS.record_request(label, chunk_no, attempt + 1, latency if latency is not None else monotonic() - start,
+                               seconds=monotonic() - start, rate_limit_wait=rate_limit_wait,
+                               error=error.code or type(error).__name__)
+        raise
+
+    # Billed characters come from the response (x-amzn-requestcharacters), not our own count
+    METRICS.record_request(label, chunk_no, attempt + 1, latency, seconds=monotonic() - start,
+                           billed_chars=result.request_characters, audio_bytes=os.path.getsize(path),
+                           rate_limit_wait=rate_limit_wait)
+
+    return (path, cache_key if use_cache else None, attempt + 1)
+
+
+def release_chunk(path, cache_key):
+    """Done with a synthesize_chunk() result: unpin the cache entry, or delete the temp file."""
+    if cache_key is not None:
+        SYNTHESIS_CACHE.unpin(cache_key)
+    else:
+        os.remove(path)
+
+
+def _cache_engine(backend):
+    # Keep audio from other backends (e.g. the fake's silence) out of the real Polly cache entries
+    return "neural" if backend.name == PollyBackend.name else backend.name + "/neural"
+
+
+@timed_stage("save_polly_speech")
+def save_polly_speech(basename, text, output_path, voice_id=AWS_DEFAULT_POLLY_VOICE, max_workers=AWS_POLLY_MAX_CONNECTIONS,
+                      use_cache=True, lexicon_version=None, output_format="mp3", join_chunks=False, backend=None,
+                      text_type="text", lexicon_names=None, lexicon=None, priority=DEFAULT_PRIORITY, progress=None,
+                      speech_marks=False, plan=None):
+    """Saves an .mp3 of speech corresponding to the text input.  Chunks are synthesized concurrently
+    (max_workers requests in flight, rate limited by POLLY_RATE_LIMITER) but written out in text order.
+    Chunks found in SYNTHESIS_CACHE are not sent to Polly at all.  Pass lexicon_version if pronunciation
+    lexicons are applied outside the text, so a lexicon change invalidates the cached audio.
+
+    With join_chunks=True all chunks go into one continuous {basename}.mp3 instead of {basename}_N.mp3
+    files.  output_format="pcm" writes .wav files instead of .mp3.  Audio is streamed to disk a block at
+    a time, so no chunk is ever held in memory in full.
+
+    Progress is checkpointed to {basename}_manifest.json.  Transient errors are retried with backoff, and
+    if a chunk still fails the rest carry on; a rerun only synthesizes the chunks that are missing or failed.
+
+    backend is anything from tts_backends (default: AWS Polly).  Pass a FakeBackend to run offline.
+
+    text_type="ssml" means text is an SSML body, e.g. from PhonemeLexicon.to_ssml().  It's chunked without
+    ever splitting a tag, and each chunk is wrapped in <speak></speak> before it's sent.  lexicon_names are
+    uploaded lexicons (see lexicon_utils.sync_pls_lexicons()) to apply to every chunk.
+
+    Pass the PhonemeLexicon as lexicon and each chunk's audio is keyed on just the lexicon entries for words
+    it contains, so after a lexicon edit only the chunks containing an edited word are synthesized again.
+    In a joined file, every other chunk is spliced straight across from the previous run's file.
+
+    text can also be an iterable of text blocks, e.g. from text_utils.iter_file_text(), for a book too big to
+    read into memory.  It's then chunked as it's read, and only a few chunks per worker are read ahead of the
+    one being written out, so memory use stays flat however long the book is.
+
+    priority is passed on to every request (see synthesize_chunk()).  progress, if given, is called as
+    progress(basename, chunks finished, total chunks or None if not known yet) after every chunk.
+
+    With speech_marks=True (joined files only), each chunk's sentence and word speech marks are requested too
+    (cached like the audio, but billed as a request of their own), and {basename}_marks.idx is built from them
+    once the file is finished: a seek index from any word to its time and byte offset, see speech_marks.py.
+
+    Pass a SynthesisPlan as plan for a dry run: every chunk is worked out and looked up in the manifest and cache
+    as usual, and what would have happened to it is added to the plan, but nothing is requested or written."""
+
+    if backend is None:
+        backend = get_default_backend()
+
+    total_char_limit = AWS_POLLY_TOTAL_CHAR_LIMIT - len("".join(SSML_WRAPPER))
+    if isinstance(text, str):
+        # Breaks a long chunk of text into lists of text that are each under the limit, ending on sentence punctuation.
+        text_chunks = chunk_text_to_lists(char_limit=AWS_POLLY_BILLED_CHAR_LIMIT, text=text,
+                                          total_char_limit=total_char_limit, with_breaks=True)
+        total_chunks = len(text_chunks)
+    else:
+        # Streamed: chunked as it's read, so the first request goes out as soon as the first chunk is read
+        text_chunks = iter_text_chunks(text, char_limit=AWS_POLLY_BILLED_CHAR_LIMIT, total_char_limit=total_char_limit,
+                                       with_breaks=True)
+        total_chunks = "?"
+
+    extension = AUDIO_FILE_EXTENSIONS[output_format]
+
+    def chunk_output_path(idx):
+        return os.path.join(output_path, basename + "_" + str(idx+1) + "." + extension)
+
+    cache_engine = _cache_engine(backend)
+
+    def chunk_lexicon_version(words):
+        if not words:
+            return lexicon_version
+        words = ",".join(f"{word}={entry_hash}" for word, entry_hash in words.items())
+        return f"{lexicon_version or ''};{words}"
+
+    manifest = SynthesisManifest.load(output_path, basename)
+    old_words = manifest.dependencies()
+    had_chunks = bool(manifest.chunks)
+
+    # Separate files: any chunk already written by an earlier run is skipped outright.
+    # Joined file: chunks that are unchanged since the last run are copied across from the last joined
+    # file (their byte ranges are in the manifest), everything else is synthesized (or taken from the cache).
+    joined_path = os.path.join(output_path, basename + "." + extension)
+    splice_joined = join_chunks and manifest.output_matches(joined_path)
+    manifest.begin()
+    speech_marks = speech_marks and join_chunks
+
+    def prepare(chunk, paragraph):
+        # Adds the next chunk to the manifest.  Returns (request text, audio hash, speech marks hash or None).
+        if text_type == "ssml":
+            chunk = SSML_WRAPPER[0] + chunk + SSML_WRAPPER[1]
+
+        # Which lexicon entries the chunk depends on: word -> hash of its pronunciation
+        words = lexicon.dependencies(chunk) if lexicon is not None else {}
 
-    # Breaks a long chunk of text into lists of text that are each under the limit, ending on sentence punctuation.
-    text_chunks_list = chunk_text_to_lists(char_limit=AWS_POLLY_TEXT_LIMIT, text=text)
+        # Same hash the cache uses, so the manifest can tell when a chunk's text (or voice, etc.) changed
+        # (the text hashed is the request text, so SSML chunks don't share entries with plain text ones)
+        chunk_hash = SynthesisCache.make_key(text=chunk, voice_id=voice_id, engine=cache_engine,
+                                             output_format=output_format, lexicon_version=chunk_lexicon_version(words))
+        entry = manifest.add(chunk_hash)
+        entry["words"] = words
+        entry["paragraph"] = paragraph     # Ends a paragraph, for the gap after it (see audio_postprocess.py)
 
-    total_chunks = len(text_chunks_list)
-    for idx, chunk in enumerate(text_chunks_list):
+        marks_hash = None
+        if speech_marks:
+            marks_hash = SynthesisCache.make_key(text=chunk, voice_id=voice_id, engine=cache_engine,
+                                                 output_format="json:" + ",".join(SPEECH_MARK_TYPES),
+                                                 lexicon_version=chunk_lexicon_version(words))
+        return chunk, chunk_hash, marks_hash
+
+    def reusable(idx):
+        # PLAN_SPLICED or PLAN_RESUMED if the chunk's audio from an earlier run can be kept as it is, else None
+        entry = manifest.chunks[idx]
+        if join_chunks and splice_joined and entry["status"] == CHUNK_DONE and entry.get("offset") is not None:
+            return PLAN_SPLICED
+        if not join_chunks and manifest.is_done(idx, chunk_output_path(idx)):
+            return PLAN_RESUMED
+        return None
+
+    if plan is not None:
+        # Dry run: the same chunks and lookups as below, then straight back out.  Not even the manifest is saved.
+        for idx, (chunk, paragraph) in enumerate(text_chunks):
+            chunk, chunk_hash, marks_hash = prepare(chunk, paragraph)
+            billed = count_billed_chars(chunk) if text_type == "ssml" else len(chunk)
+            requests = [("audio", chunk_hash, reusable(idx))]
+            if marks_hash is not None:
+                # Spliced chunks too, see below
+                requests.append(("marks", marks_hash, None))
+            for kind, key, action in requests:
+                if action is None:
+                    action = PLAN_CACHED if use_cache and SYNTHESIS_CACHE.contains(key) else PLAN_REQUEST
+                plan.add(os.path.join(output_path, basename), idx + 1, kind, action, billed, len(chunk))
+        return
+
+    def synthesize(idx, chunk, chunk_hash):
+        # Runs in a worker thread
+        return synthesize_chunk(chunk, chunk_hash, backend, voice_id, output_format=output_format,
+                                text_type=text_type, lexicon_names=lexicon_names, use_cache=use_cache, label=basename,
+                                chunk_no=idx + 1, total_chunks=total_chunks, priority=priority)
+
+    def synthesize_marks(idx, chunk, marks_hash):
+        # Same request, for the speech marks instead of the audio
+        return synthesize_chunk(chunk, marks_hash, backend, voice_id, output_format="json", text_type=text_type,
+                                lexicon_names=lexicon_names, use_cache=use_cache, label=basename, chunk_no=idx + 1,
+                                total_chunks=total_chunks, priority=priority, speech_mark_types=SPEECH_MARK_TYPES)
+
+    finished = 0
+
+    def report():
+        nonlocal finished
+        finished += 1
+        if progress is not None:
+            progress(basename, finished, total_chunks if isinstance(total_chunks, int) else None)
+
+    joined_writer = None
+    playback_index = None
+    new_ranges = {}     # idx -> (offset, length) in the new joined file
+    marks_spool = None
+    marks_failed = 0
+    holes = 0           # Chunks that failed this run.  Not manifest.failed_chunks(), which is the whole manifest's state.
+    marks_index_path = os.path.join(output_path, basename + SPEECH_MARK_INDEX_SUFFIX)
+    if join_chunks:
         try:
-            print(f"  requesting synthesis of length: {len(chunk)} chars..  ({idx+1}/{total_chunks})")
-            # Request speech synthesis
-            response = polly.synthesize_speech( Text=chunk,
-                                                Engine="neural",
-                                                OutputFormat="mp3",
-                                                VoiceId=voice_id
-                                                )
-        except (BotoCoreError, ClientError) as error:
-            # The service returned an error, exit gracefully
-            print("ERROR: Error requesting polly speech response.")
+            # Written next to the old file and swapped in at the end, since unchanged chunks are read out of it
+            joined_writer = AudioFileWriter(joined_path + PARTIAL_SUFFIX, output_format=output_format)
+            # Which chunks are in the .partial file so far, so it can be listened to while it's still growing
+            # (see audio_server.py).  Append only, one line per chunk as it lands, always in text order.
+            playback_index = open(os.path.join(output_path, basename + PLAYBACK_INDEX_SUFFIX), "w", encoding="utf8")
+            playback_index.write(json.dumps({"file": os.path.basename(joined_path), "format": output_format}) + "\n")
+            playback_index.flush()
+            if speech_marks:
+                # Each chunk's marks as it lands, turned into the seek index once the file is finished
+                marks_spool = open(os.path.join(output_path, basename + SPEECH_MARK_SPOOL_SUFFIX), "w", encoding="utf8")
+        except IOError as error:
+            print("ERROR: Could not write to file.")
             print(error)
             quit()
 
-        # # Access the audio stream from the response
-        # print(type(response))
-        # print(response)
-
-        # Example response:
-        # {
-        #     'ResponseMetadata': 
-        #         {
-        #             'RequestId': '260e15d3-1515-456a-aaca-1d5343fd90cf', 
-        #             'HTTPStatusCode': 200, 
-        #             'HTTPHeaders': {
-        #                             'x-amzn-requestid': '260e15d3-1515-456a-aaca-1d5343fd90cf', 
-        #                             'x-amzn-requestcharacters': '12', 
-        #                             'content-type': 'audio/mpeg', 
-        #                             'transfer-encoding': 'chunked', 
-        #                             'date': 'Fri, 17 Dec 2021 17:53:39 GMT'
-        #                             }, 
-        #             'RetryAttempts': 0
-        #         }, 
-        #     'ContentType': 'audio/mpeg', 
-        #     'RequestCharacters': '12', 
-        #     'AudioStream': <botocore.response.StreamingBody object at 0x00000237EE8D2B80>
-        # }
-
-        if "AudioStream" in response:
-            # Note: Closing the stream is important because the service throttles on the
-            # number of parallel connections. Here we are using contextlib.closing to
-            # ensure the close method of the stream object will be called automatically
-            # at the end of the with statement's scope.
-            with closing(response["AudioStream"]) as stream:
-                # output = os.path.join(gettempdir(), "speech.mp3")
-
-                try:
-                    # Open a file for writing the output as a binary stream
-                    with open(os.path.join(output_path, basename + "_" + str(idx+1) + ".mp3"), "wb") as file:
-                        file.write(stream.read())
-                except IOError as error:
-                    # Could not write to file, exit gracefully
-                    print("ERROR: Could not write to file.")
-                    print(error)
-                    quit()
+    def index_chunk(idx):
+        # Flushed first, so the bytes the index points at are really in the file
+        offset, length = new_ranges[idx]
+        joined_writer.flush()
+        header = WAV_HEADER_SIZE if output_format == "pcm" else 0
+        playback_index.write(json.dumps({"chunk": idx + 1, "offset": offset, "length": length,
+                                         "end": header + offset + length}) + "\n")
+        playback_index.flush()
 
-        else:
-            # The response didn't contain audio data, exit gracefully
-            print("ERROR: Could not stream audio.")
+    def collect(idx, future, marks_future=None):
+        # Writes out one chunk (future is None for one spliced across from the last joined file)
+        try:
+            write_chunk(idx, future)
+            if marks_future is not None:
+                write_marks(idx, marks_future)
+        finally:
+            report()
+
+    def write_marks(idx, marks_future):
+        # Spools the chunk's marks with where it landed in the joined file.  A chunk without marks only costs
+        # the seek index, not the audio, so it's a warning rather than a failed chunk.
+        nonlocal marks_failed
+        try:
+            result = marks_future.result()
+        except SynthesisError as error:
+            result = None
+            print(f"WARNING: Could not get speech marks for {basename} chunk {idx+1}: {error}")
+        if result is None:
+            marks_failed += 1
+            return
+
+        marks_path, cache_key, _ = result
+        try:
+            if idx in new_ranges and not marks_failed:
+                with open(marks_path, "r", encoding="utf8") as fr:
+                    marks = [json.loads(line) for line in fr if line.strip()]
+                offset, length = new_ranges[idx]
+                marks_spool.write(json.dumps({"chunk": idx + 1, "offset": offset, "length": length, "marks": marks}) + "\n")
+        finally:
+            release_chunk(marks_path, cache_key)
+
+    def write_chunk(idx, future):
+        nonlocal holes
+        entry = manifest.chunks[idx]
+        if future is None:
+            if not holes:
+                written_before = joined_writer.bytes_written
+                joined_writer.append_range(joined_path, entry["offset"], entry["length"])
+                new_ranges[idx] = (written_before, joined_writer.bytes_written - written_before)
+                index_chunk(idx)
+                METRICS.record_bytes_written(joined_writer.path, joined_writer.bytes_written - written_before)
+            return
+
+        try:
+            result = future.result()
+        except SynthesisError as error:
+            # The service returned an error even after retries.  Record it and keep going, so
+            # everything else is done (and cached) and a rerun only has to redo the failures.
+            print(f"ERROR: Error requesting polly speech response for {basename} chunk {idx+1}.")
+            print(error)
+            manifest.mark(idx, CHUNK_FAILED, attempts=getattr(error, "attempts", None), error=error)
+            holes += 1
+            manifest.save()
+            return
+
+        if result is None:
+            # The response didn't contain audio data
+            print(f"ERROR: Could not stream audio for {basename} chunk {idx+1}.")
+            manifest.mark(idx, CHUNK_FAILED, error="Response had no AudioStream")
+            holes += 1
+            manifest.save()
+            return
+
+        chunk_path, cache_key, attempts = result
+        try:
+            if joined_writer is None:
+                # Open a file for writing the output as a binary stream
+                with AudioFileWriter(chunk_output_path(idx), output_format=output_format) as chunk_writer:
+                    chunk_writer.append_file(chunk_path)
+                METRICS.record_bytes_written(chunk_writer.path, chunk_writer.bytes_written)
+                manifest.mark(idx, CHUNK_DONE, path=chunk_output_path(idx), attempts=attempts)
+            else:
+                # Once there's a hole in the joined file it gets thrown away anyway, but the rest of
+                # the chunks still finish so they're cached for the rerun.
+                if not holes:
+                    # Appended frame-aligned onto the one continuous file
+                    written_before = joined_writer.bytes_written
+                    joined_writer.append_file(chunk_path)
+                    new_ranges[idx] = (written_before, joined_writer.bytes_written - written_before)
+                    index_chunk(idx)
+                    METRICS.record_bytes_written(joined_writer.path, joined_writer.bytes_written - written_before)
+                manifest.mark(idx, CHUNK_DONE, path=chunk_path if cache_key else None, attempts=attempts)
+        except IOError as error:
+            # Could not write to file, exit gracefully
+            print("ERROR: Could not write to file.")
+            print(error)
+            manifest.save()
+            executor.shutdown(wait=False, cancel_futures=True)
             quit()
+        finally:
+            release_chunk(chunk_path, cache_key)
+
+        manifest.save(min_interval=MANIFEST_SAVE_INTERVAL)
+
+    # Chunks submitted but not written out yet, in text order: (idx, future or None if spliced[, marks future]).  Never more
+    # than a few per worker, so only the text of those chunks is held in memory however long the book is.
+    pending = deque()
+    window = max_workers * STREAM_CHUNKS_PER_WORKER
+    spliced = resumed = 0
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for idx, (chunk, paragraph) in enumerate(text_chunks):
+            chunk, chunk_hash, marks_hash = prepare(chunk, paragraph)
+
+            action = reusable(idx)
+            if action == PLAN_SPLICED:
+                pending.append((idx, None))
+                spliced += 1
+            elif action == PLAN_RESUMED:
+                resumed += 1
+                report()
+            else:
+                pending.append((idx, executor.submit(synthesize, idx, chunk, chunk_hash)))
+
+            if marks_hash is not None:
+                # Spliced chunks too, the index is rebuilt whole.  Normally these come straight from the cache.
+                pending[-1] += (executor.submit(synthesize_marks, idx, chunk, marks_hash),)
+
+            # Collect results in text order, so even though requests finish out of order,
+            # chunks are written in text order as soon as each one is ready.
+            while len(pending) >= window:
+                collect(*pending.popleft())
+
+        while pending:
+            collect(*pending.popleft())
+    finally:
+        executor.shutdown(wait=True)
+        if joined_writer is not None:
+            joined_writer.close()
+        if marks_spool is not None:
+            marks_spool.close()
+
+    manifest.finish()
+    total_chunks = len(manifest.chunks)
+    if progress is not None:
+        progress(basename, finished, total_chunks)
+    if spliced:
+        print(f"  [{basename}] {spliced}/{total_chunks} chunks were unchanged, spliced in from {joined_path}")
+    if resumed:
+        print(f"  [{basename}] {resumed}/{total_chunks} chunks were already done by an earlier run")
+
+    if lexicon is not None and had_chunks:
+        # Diff against the lexicon the last run used, and say how much of the book that touches
+        new_words = manifest.dependencies()
+        changed = sorted(word for word in set(old_words) | set(new_words) if old_words.get(word) != new_words.get(word))
+        if changed:
+            affected = sum(1 for entry in manifest.chunks if not set(entry["words"]).isdisjoint(changed))
+            print(f"  [{basename}] lexicon changed for {', '.join(changed)}: {affected}/{total_chunks} chunks affected")
+
+    failed = manifest.failed_chunks()
+    if failed:
+        manifest.save()
+        print(f"ERROR: {len(failed)}/{total_chunks} chunks of {basename} failed: {', '.join(str(entry['index']) for entry in failed)}")
+        print(f"See {manifest.path}.  Rerun to retry just those chunks.")
+        if joined_writer is not None:
+            # Incomplete, throw it away.  The last complete file (if any) is left alone, and the
+            # manifest still points into it, so the rerun can splice from it.
+            os.remove(joined_writer.path)
+            playback_index.write(json.dumps({"complete": False, "failed": len(failed)}) + "\n")
+            playback_index.close()
+            if marks_spool is not None:
+                os.remove(marks_spool.name)
+        quit()
+
+    if joined_writer is not None:
+        os.replace(joined_writer.path, joined_path)
+        playback_index.write(json.dumps({"complete": True}) + "\n")
+        playback_index.close()
+        for idx, (offset, length) in new_ranges.items():
+            manifest.chunks[idx]["offset"] = offset
+            manifest.chunks[idx]["length"] = length
+        manifest.set_output(joined_path)
+        manifest.save()
+        print(f"Saved {joined_path}")
+
+        # The old seek index (if any) points into the old file, so it goes either way
+        if marks_spool is not None and not marks_failed:
+            n_marks = build_speech_mark_index(marks_spool.name, joined_path, output_format, marks_index_path)
+            print(f"Saved {marks_index_path} ({n_marks} speech marks)")
+        else:
+            if marks_failed:
+                print(f"WARNING: {marks_failed}/{total_chunks} chunks of {basename} have no speech marks, so no "
+                      f"{marks_index_path}.  Rerun to try again.")
+            if os.path.exists(marks_index_path):
+                os.remove(marks_index_path)
+        if marks_spool is not None:
+            os.remove(marks_spool.name)
+    else:
+        manifest.save()
+
+
+# Columns of the clip review index, see save_polly_clips()
+CLIP_INDEX_FIELDS = ["word", "occurrence", "line", "clip", "status", "text", "hash"]
+
+
+@timed_stage("save_polly_clips")
+def save_polly_clips(clips, output_path, index_basename, voice_id=AWS_DEFAULT_POLLY_VOICE, max_workers=AWS_POLLY_MAX_CONNECTIONS,
+                     use_cache=True, output_format="mp3", backend=None, lexicon_names=None, lexicon_version=None,
+                     priority=DEFAULT_PRIORITY, progress=None, plan=None):
+    """Synthesizes each clip (a dict with "name" and SSML "text", see text_utils.get_tricky_clips()) into its own
+    {name}.mp3 in output_path, concurrently, and writes a review index of them to {index_basename}_index.json
+    and .csv: word, occurrence, line, clip path, SSML text.  Each clip is cached on its own, and a clip whose
+    text hasn't changed since the last run isn't touched at all, so fixing one phoneme only re-renders the clips
+    with that word in them.  Returns the index entries.  priority, progress and plan are the same as for save_polly_speech()."""
+
+    if backend is None:
+        backend = get_default_backend()
+
+    extension = AUDIO_FILE_EXTENSIONS[output_format]
+    json_path = os.path.join(output_path, index_basename + "_index.json")
+    csv_path = os.path.join(output_path, index_basename + "_index.csv")
+
+    try:
+        with open(json_path, "r", encoding="utf8") as fr:
+            old_entries = {entry["clip"]: entry for entry in json.load(fr)}
+    except (FileNotFoundError, json.JSONDecodeError):
+        old_entries = {}
+
+    entries = []
+    todo = []
+    for clip in clips:
+        request_text = SSML_WRAPPER[0] + clip["text"] + SSML_WRAPPER[1]
+        entry = {"word": clip.get("word"), "occurrence": clip.get("occurrence"), "line": clip.get("line"),
+                 "clip": os.path.join(output_path, clip["name"] + "." + extension), "status": CHUNK_DONE,
+                 "text": clip["text"],
+                 "hash": SynthesisCache.make_key(text=request_text, voice_id=voice_id, engine=_cache_engine(backend),
+                                                 output_format=output_format, lexicon_version=lexicon_version)}
+        old = old_entries.get(entry["clip"])
+        if not (old and old["hash"] == entry["hash"] and old["status"] == CHUNK_DONE and os.path.exists(entry["clip"])):
+            todo.append((len(entries), request_text))
+        entries.append(entry)
+
+    if plan is not None:
+        # Dry run, nothing is requested or written
+        todo_idx = {idx for idx, _ in todo}
+        for idx, (entry, clip) in enumerate(zip(entries, clips)):
+            request_text = SSML_WRAPPER[0] + clip["text"] + SSML_WRAPPER[1]
+            if idx not in todo_idx:
+                action = PLAN_RESUMED
+            elif use_cache and SYNTHESIS_CACHE.contains(entry["hash"]):
+                action = PLAN_CACHED
+            else:
+                action = PLAN_REQUEST
+            plan.add(os.path.join(output_path, index_basename), idx + 1, "clip", action, count_billed_chars(request_text),
+                     len(request_text))
+        return entries
+
+    os.makedirs(output_path, exist_ok=True)
+    print(f"  [{index_basename}] {len(entries) - len(todo)}/{len(entries)} clips unchanged, synthesizing {len(todo)}..")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(synthesize_chunk, request_text, entries[idx]["hash"], backend, voice_id,
+                                   output_format=output_format, text_type="ssml", lexicon_names=lexicon_names,
+                                   use_cache=use_cache, label=index_basename, chunk_no=n + 1, total_chunks=len(todo),
+                                   priority=priority)
+                   for n, (idx, request_text) in enumerate(todo)]
+
+        for n, ((idx, _), future) in enumerate(zip(todo, futures)):
+            if progress is not None and n:
+                progress(index_basename, n, len(todo))     # The ones before this one are done
+            entry = entries[idx]
+            try:
+                result = future.result()
+            except SynthesisError as error:
+                print(f"ERROR: Could not synthesize clip {entry['clip']}: {error}")
+                entry["status"] = CHUNK_FAILED
+                continue
+            if result is None:
+                print(f"ERROR: Could not stream audio for clip {entry['clip']}.")
+                entry["status"] = CHUNK_FAILED
+                continue
+
+            chunk_path, cache_key, _ = result
+            try:
+                with AudioFileWriter(entry["clip"], output_format=output_format) as writer:
+                    writer.append_file(chunk_path)
+                METRICS.record_bytes_written(writer.path, writer.bytes_written)
+            except IOError as error:
+                print(f"ERROR: Could not write clip {entry['clip']}: {error}")
+                entry["status"] = CHUNK_FAILED
+            finally:
+                release_chunk(chunk_path, cache_key)
+
+    # Clips for words/occurrences that are gone now (deleted from the lexicon, text edited) would just be confusing
+    current = {entry["clip"] for entry in entries}
+    for old_clip in old_entries:
+        if old_clip not in current and os.path.exists(old_clip):
+            os.remove(old_clip)
+
+    with open(json_path, "w", encoding="utf8") as fw:
+        json.dump(entries, fw, indent=2, ensure_ascii=False)
+    with open(csv_path, "w", encoding="utf8", newline="") as fw:
+        writer = csv.DictWriter(fw, fieldnames=CLIP_INDEX_FIELDS)
+        writer.writeheader()
+        writer.writerows(entries)
+
+    if progress is not None:
+        progress(index_basename, len(todo), len(todo))
+
+    failed = [entry for entry in entries if entry["status"] == CHUNK_FAILED]
+    if failed:
+        print(f"ERROR: {len(failed)}/{len(entries)} clips failed, rerun to retry just those.")
+    print(f"Saved {len(entries) - len(failed)} clips, index in {json_path}")
+    return entries
+
+
+def save_chapters_polly_speech(chapters, output_path, voice_id=AWS_DEFAULT_POLLY_VOICE, max_parallel_chapters=MAX_PARALLEL_CHAPTERS,
+                               **kwargs):
+    """Synthesizes each chapter into its own joined {name}.mp3, several chapters at a time.  chapters is a list
+    of (name, title, text) tuples, see text_utils.get_book_chapters() or stream_book_chapters().  All chapters share the process-wide
+    rate and connection limits, and a failed chapter doesn't stop the others.  Returns a dict of
+    chapter name -> True if it finished, False if it failed.  Other arguments go to save_polly_speech()."""
+
+    def synthesize_chapter(name, title, text):
+        print(f"Starting {name} ({title})..")
+        try:
+            save_polly_speech(basename=name, text=text, output_path=output_path, voice_id=voice_id,
+                              join_chunks=True, **kwargs)
+        except SystemExit:
+            # save_polly_speech() quits on errors it can't get past.  Here that only ends this chapter,
+            # its manifest says which chunks to redo.
+            print(f"Chapter {name} failed, the other chapters carry on.")
+            return False
+        print(f"Finished {name} ({title}).")
+        return True
+
+    with ThreadPoolExecutor(max_workers=max_parallel_chapters) as executor:
+        futures = {name: executor.submit(synthesize_chapter, name, title, text) for name, title, text in chapters}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def report_synthesis_plan(plan, output_dir):
+    """Prints a dry run's plan (see synthesis_plan.py) against the current rate and connection limits, timed with
+    the requests in {output_dir}/metrics.jsonl from earlier runs, and saves it to {output_dir}/dry_run_plan.csv."""
 
-        # Throttle to keep lil' Polly happy.  Neural voice has burst limit of 10 transactions / second.
-        sleep(0.15)
\ No newline at end of file
+    latency_model = load_latency_model(os.path.join(output_dir, "metrics.jsonl"))
+    print(plan.summary(rate=POLLY_RATE_LIMITER.rate, burst=POLLY_RATE_LIMITER.capacity,
+                       connections=POLLY_CONNECTION_LIMITER.value, latency_model=latency_model,
+                       char_limit=AWS_POLLY_BILLED_CHAR_LIMIT))
+    csv_path = os.path.join(output_dir, "dry_run_plan.csv")
+    plan.save_csv(csv_path)
+    print(f"Saved the plan for every chunk to {csv_path}")
@@ -0,0 +1,97 @@
+"""Compact, memory-mapped English dictionary for fast word lookups."""
+
+import json
+import mmap
+import os
+
+# GLOBALS
+
+# Got a JSON file of English words from this site
+# https://github.com/dwyl/english-words
+ENGLISH_DICTIONARY_JSON = "words_english_dictionary.json"
+
+# Compiled once from the JSON: every word, sorted, one per line.  Memory-mapped and binary searched,
+# so loading it is instant and it costs almost no RAM no matter how many books we check.
+ENGLISH_DICTIONARY_SORTED = "words_english_dictionary.sorted"
+
+# Loaded dictionaries, keyed on compiled file path, so every book in a process shares one mapping
+_loaded_dictionaries = {}
+
+
+class SortedWordFile:
+    """Read-only set of words backed by a sorted, newline separated UTF-8 file.
+    `word in dictionary` is an O(log n) binary search over the memory-mapped file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fr:
+            size = os.fstat(fr.fileno()).st_size
+            # Can't mmap an empty file
+            self._data = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __contains__(self, word):
+        target = word.encode("utf8")
+        data = self._data
+
+        # lo and hi always sit on the start of a line
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            # Back up to the start of the line mid landed in, then read that line
+            newline = data.rfind(b"\n", lo, mid)
+            start = newline + 1 if newline != -1 else lo
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = len(data)
+
+            line = data[start:end]
+            if line == target:
+                return True
+            elif line < target:
+                lo = end + 1
+            else:
+                hi = start
+
+        return False
+
+
+def compile_word_dictionary(json_path, sorted_path):
+    """Builds the sorted word file from a JSON dictionary (either a list of words, or a dict keyed on word)."""
+
+    print(f"Compiling {json_path} to {sorted_path}, only needed once..")
+
+    with open(json_path, "r", encoding="utf8") as fr:
+        words = json.load(fr)
+
+    # Sorting the str gives the same order as sorting the UTF-8 bytes, which is what the lookup compares
+    sorted_words = sorted(set(word for word in words if word and "\n" not in word))
+
+    # Write to a temp file and rename, so an interrupted build never leaves a half written dictionary
+    tmp_path = sorted_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf8", newline="\n") as fw:
+        fw.write("\n".join(sorted_words))
+    os.replace(tmp_path, sorted_path)
+
+
+def load_english_dictionary(json_path=ENGLISH_DICTIONARY_JSON, sorted_path=ENGLISH_DICTIONARY_SORTED):
+    """Returns the English dictionary as a SortedWordFile, compiling it first if the JSON is newer."""
+
+    try:
+        stale = (not os.path.exists(sorted_path)) or (os.path.getmtime(json_path) > os.path.getmtime(sorted_path))
+    except FileNotFoundError:
+        # No JSON, but a compiled dictionary on its own is fine
+        stale = not os.path.exists(sorted_path)
+        if stale:
+            print(f"Cannot find English dictionary file: {json_path}")
+            print("Download words_dictionary.json from https://github.com/dwyl/english-words and rename it.")
+            quit()
+
+    if stale:
+        compile_word_dictionary(json_path, sorted_path)
+        _loaded_dictionaries.pop(sorted_path, None)
+
+    if sorted_path not in _loaded_dictionaries:
+        _loaded_dictionaries[sorted_path] = SortedWordFile(sorted_path)
+
+    return _loaded_dictionaries[sorted_path]